@@ -0,0 +1,282 @@
+"""
+In-process fake of the ECS API, for benchmarks without an AWS account.
+
+FakeEcsBackend implements the boto3 ECS client operations used by EcsClient
+and plugs into it as its boto_client. Rollouts progress with the wall clock:
+a new deployment starts its tasks over rollout_seconds, then the old
+deployment is drained and a steady state event is added. All calls share a
+token bucket; calls exceeding it fail with a ThrottlingException, just like
+the real API.
+"""
+import threading
+from collections import Counter
+from copy import deepcopy
+from datetime import datetime
+from time import monotonic, sleep
+
+from botocore.exceptions import ClientError
+from dateutil.tz import tzlocal
+
+from ecs_deploy.ecs import EcsClient
+
+ACCOUNT = u'123456789012'
+REGION = u'us-east-1'
+
+
+def arn(resource):
+    return u'arn:aws:ecs:%s:%s:%s' % (REGION, ACCOUNT, resource)
+
+
+class FakeEcsBackend(object):
+    def __init__(self, cluster=u'benchmark', services=10, desired_count=2,
+                 rollout_seconds=1.0, rate=50.0, burst=100, latency=0.0,
+                 families=None):
+        self.cluster = cluster
+        self.rollout_seconds = rollout_seconds
+        self.rate = rate
+        self.burst = burst
+        self.latency = latency
+        self.calls = Counter()
+        self.throttles = Counter()
+        self._tokens = float(burst)
+        self._refilled_at = monotonic()
+        self._lock = threading.Lock()
+        self._task_definitions = {}
+        self._revisions = Counter()
+        self._services = {}
+        self._ids = 0
+
+        # services share a task definition family if families is given
+        for i in range(services):
+            name = u'service-%04d' % i
+            family = u'family-%04d' % (i % families if families else i)
+            task_definition = self._task_definition_arn(family) or self._register(
+                family=family,
+                containerDefinitions=[{u'name': u'app', u'image': u'app:1', u'command': u'run'}],
+                volumes=[]
+            )[u'taskDefinitionArn']
+            self._services[name] = {
+                u'serviceName': name,
+                u'serviceArn': arn(u'service/%s/%s' % (cluster, name)),
+                u'desiredCount': desired_count,
+                u'taskDefinition': task_definition,
+                u'deployments': [self._deployment(task_definition, desired_count, rolled_out=True)],
+                u'events': [],
+            }
+
+    @property
+    def service_names(self):
+        return sorted(self._services)
+
+    def client(self, **kwargs):
+        return EcsClient(boto_client=self, **kwargs)
+
+    # boto3 ECS client operations
+
+    def describe_services(self, cluster, services):
+        self._request(u'DescribeServices')
+        if len(services) > 10:
+            raise self._error(u'InvalidParameterException', u'DescribeServices')
+        response = {u'services': [], u'failures': []}
+        with self._lock:
+            for name in services:
+                service = self._services.get(name)
+                if service is None:
+                    response[u'failures'].append({u'arn': arn(u'service/%s' % name), u'reason': u'MISSING'})
+                    continue
+                self._progress(service)
+                response[u'services'].append(self._public(service))
+        return response
+
+    def describe_task_definition(self, taskDefinition):
+        self._request(u'DescribeTaskDefinition')
+        with self._lock:
+            task_definition_arn = self._task_definition_arn(taskDefinition)
+            if task_definition_arn is None:
+                raise self._error(u'ClientException', u'DescribeTaskDefinition')
+            return {u'taskDefinition': deepcopy(self._task_definitions[task_definition_arn])}
+
+    def list_task_definitions(self, familyPrefix, status=u'ACTIVE', sort=u'ASC', maxResults=100, nextToken=None):
+        self._request(u'ListTaskDefinitions')
+        with self._lock:
+            task_definitions = [
+                task_definition
+                for task_definition in self._task_definitions.values()
+                if task_definition[u'family'].startswith(familyPrefix) and task_definition[u'status'] == status
+            ]
+        # like ECS, by family name and revision
+        task_definitions.sort(key=lambda t: (t[u'family'], t[u'revision']), reverse=sort == u'DESC')
+        arns = [task_definition[u'taskDefinitionArn'] for task_definition in task_definitions]
+        start = int(nextToken or 0)
+        page = {u'taskDefinitionArns': arns[start:start + maxResults]}
+        if start + maxResults < len(arns):
+            page[u'nextToken'] = str(start + maxResults)
+        return page
+
+    def register_task_definition(self, family, containerDefinitions, volumes, **kwargs):
+        self._request(u'RegisterTaskDefinition')
+        with self._lock:
+            return {u'taskDefinition': deepcopy(self._register(family, containerDefinitions, volumes, **kwargs))}
+
+    def deregister_task_definition(self, taskDefinition):
+        self._request(u'DeregisterTaskDefinition')
+        with self._lock:
+            task_definition = self._task_definitions[self._task_definition_arn(taskDefinition)]
+            task_definition[u'status'] = u'INACTIVE'
+            return {u'taskDefinition': deepcopy(task_definition)}
+
+    def update_service(self, cluster, service, desiredCount=None, taskDefinition=None,
+                       forceNewDeployment=False):
+        self._request(u'UpdateService')
+        with self._lock:
+            payload = self._services[service]
+            self._progress(payload)
+            if desiredCount is not None:
+                payload[u'desiredCount'] = desiredCount
+            if (taskDefinition is not None and taskDefinition != payload[u'taskDefinition']) or forceNewDeployment:
+                payload[u'taskDefinition'] = taskDefinition or payload[u'taskDefinition']
+                for deployment in payload[u'deployments']:
+                    deployment[u'status'] = u'ACTIVE'
+                primary = self._deployment(payload[u'taskDefinition'], payload[u'desiredCount'])
+                payload[u'deployments'].insert(0, primary)
+            else:
+                primary = payload[u'deployments'][0]
+                primary[u'desiredCount'] = payload[u'desiredCount']
+                primary[u'rolloutState'] = u'IN_PROGRESS'
+                primary[u'_started'] = monotonic()
+                primary[u'_from'] = primary[u'runningCount']
+            return {u'service': self._public(payload)}
+
+    def list_tasks(self, cluster, serviceName, nextToken=None):
+        self._request(u'ListTasks')
+        with self._lock:
+            service = self._services[serviceName]
+            self._progress(service)
+            task_arns = [
+                arn(u'task/%s/%s-%s-%d' % (self.cluster, serviceName, deployment[u'id'], i))
+                for deployment in service[u'deployments']
+                for i in range(deployment[u'runningCount'])
+            ]
+        start = int(nextToken or 0)
+        page = {u'taskArns': task_arns[start:start + 100]}
+        if start + 100 < len(task_arns):
+            page[u'nextToken'] = str(start + 100)
+        return page
+
+    def describe_tasks(self, cluster, tasks):
+        self._request(u'DescribeTasks')
+        if len(tasks) > 100:
+            raise self._error(u'InvalidParameterException', u'DescribeTasks')
+        with self._lock:
+            deployments = dict(
+                (deployment[u'id'], deployment[u'taskDefinition'])
+                for service in self._services.values()
+                for deployment in service[u'deployments']
+            )
+        response = {u'tasks': [], u'failures': []}
+        for task_arn in tasks:
+            deployment_id = u'ecs-svc/' + task_arn.rsplit(u'-ecs-svc/', 1)[-1].rsplit(u'-', 1)[0]
+            response[u'tasks'].append({
+                u'taskArn': task_arn,
+                u'lastStatus': u'RUNNING',
+                u'taskDefinitionArn': deployments.get(deployment_id),
+            })
+        return response
+
+    # simulation
+
+    def _request(self, operation):
+        if self.latency:
+            sleep(self.latency)
+        with self._lock:
+            self.calls[operation] += 1
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self._tokens < 1:
+                self.throttles[operation] += 1
+                raise self._error(u'ThrottlingException', operation)
+            self._tokens -= 1
+
+    def _register(self, family, containerDefinitions, volumes, **kwargs):
+        self._revisions[family] += 1
+        revision = self._revisions[family]
+        task_definition = dict(
+            kwargs,
+            family=family,
+            revision=revision,
+            status=u'ACTIVE',
+            taskDefinitionArn=arn(u'task-definition/%s:%d' % (family, revision)),
+            containerDefinitions=deepcopy(containerDefinitions),
+            volumes=deepcopy(volumes),
+        )
+        self._task_definitions[task_definition[u'taskDefinitionArn']] = task_definition
+        return task_definition
+
+    def _task_definition_arn(self, task_definition):
+        if task_definition in self._task_definitions:
+            return task_definition
+        family, _, revision = task_definition.rpartition(u'/')[2].partition(u':')
+        if not revision:
+            revision = self._revisions.get(family)
+        candidate = arn(u'task-definition/%s:%s' % (family, revision))
+        return candidate if candidate in self._task_definitions else None
+
+    def _deployment(self, task_definition, desired_count, rolled_out=False):
+        self._ids += 1
+        now = datetime.now(tz=tzlocal())
+        return {
+            u'id': u'ecs-svc/%019d' % self._ids,
+            u'status': u'PRIMARY',
+            u'taskDefinition': task_definition,
+            u'desiredCount': desired_count,
+            u'runningCount': desired_count if rolled_out else 0,
+            u'pendingCount': 0 if rolled_out else desired_count,
+            u'rolloutState': u'COMPLETED' if rolled_out else u'IN_PROGRESS',
+            u'createdAt': now,
+            u'updatedAt': now,
+            u'_started': monotonic(),
+            u'_from': desired_count if rolled_out else 0,
+        }
+
+    def _progress(self, service):
+        primary = service[u'deployments'][0]
+        if primary[u'rolloutState'] == u'COMPLETED' and primary[u'runningCount'] == primary[u'desiredCount']:
+            return
+        elapsed = monotonic() - primary[u'_started']
+        share = min(1.0, elapsed / self.rollout_seconds) if self.rollout_seconds else 1.0
+        desired = primary[u'desiredCount']
+        running = int(round(primary[u'_from'] + (desired - primary[u'_from']) * share))
+        if running != primary[u'runningCount']:
+            started = running - primary[u'runningCount']
+            primary[u'runningCount'] = running
+            primary[u'pendingCount'] = max(desired - running, 0)
+            primary[u'updatedAt'] = datetime.now(tz=tzlocal())
+            if started > 0:
+                self._event(service, u'(service %s) has started %d tasks.' % (service[u'serviceName'], started))
+        if share >= 1.0:
+            primary[u'rolloutState'] = u'COMPLETED'
+            primary[u'pendingCount'] = 0
+            service[u'deployments'] = [primary]
+            self._event(service, u'(service %s) has reached a steady state.' % service[u'serviceName'])
+
+    def _event(self, service, message):
+        self._ids += 1
+        service[u'events'].insert(0, {
+            u'id': u'event-%d' % self._ids,
+            u'createdAt': datetime.now(tz=tzlocal()),
+            u'message': message,
+        })
+        del service[u'events'][100:]
+
+    @staticmethod
+    def _public(service):
+        service = deepcopy(service)
+        for deployment in service[u'deployments']:
+            for key in [key for key in deployment if key.startswith(u'_')]:
+                del deployment[key]
+        return service
+
+    @staticmethod
+    def _error(code, operation):
+        return ClientError({u'Error': {u'Code': code, u'Message': code}}, operation)
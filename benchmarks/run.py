@@ -0,0 +1,180 @@
+"""
+Benchmarks deploy, scale and deploy_many against the fake ECS backend.
+
+    python -m benchmarks.run --sizes 10 100 500 --output results.json
+    python -m benchmarks.run --baseline results.json
+
+For every scenario it reports the wall time, ECS API calls (in total and per
+service), throttling errors, peak thread count and peak memory allocated by
+Python. With --baseline the run fails if a scenario needs more API calls per
+service or more threads than the baseline allows, so regressions show up in
+CI. Wall time depends on the machine, it is only compared with
+--check-wall-time, e.g. on a dedicated benchmark runner.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import tracemalloc
+from time import monotonic, sleep
+from unittest.mock import patch
+
+os.environ.setdefault('SLACK_MUTED', '1')
+
+from click.testing import CliRunner  # noqa: E402
+
+from benchmarks.fake_ecs import FakeEcsBackend  # noqa: E402
+from ecs_deploy import cli  # noqa: E402
+from ecs_deploy.ratelimit import RateLimiter  # noqa: E402
+
+# compared against the baseline, wall time and memory depend on the machine
+CHECKED_RESULTS = ('api_calls_per_service', 'peak_threads')
+
+
+class ThreadMonitor(object):
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stopped.is_set():
+            # the monitor thread itself is not counted
+            self.peak = max(self.peak, threading.active_count() - 1)
+            sleep(self.interval)
+
+
+def run_scenario(name, command, args, backend, services):
+    client = backend.client(rate_limiter=RateLimiter())
+
+    tracemalloc.start()
+    started_at = monotonic()
+    with patch.object(cli, 'get_client', return_value=client), ThreadMonitor() as threads:
+        result = CliRunner().invoke(command, args)
+    wall_time = monotonic() - started_at
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    if result.exit_code != 0:
+        raise RuntimeError('%s failed: %s\n%s' % (name, result.exception, result.output[-2000:]))
+
+    api_calls = sum(backend.calls.values())
+    return {
+        'scenario': name,
+        'services': services,
+        'wall_time': round(wall_time, 3),
+        'api_calls': api_calls,
+        'api_calls_per_service': round(float(api_calls) / services, 2),
+        'api_calls_by_operation': dict(backend.calls),
+        'throttles': sum(backend.throttles.values()),
+        'peak_threads': threads.peak,
+        'peak_memory_mb': round(peak_memory / 1024.0 / 1024.0, 2),
+    }
+
+
+def run(sizes, rollout_seconds, rate, burst, latency, engine, worker_count):
+    poll_interval = ['--poll-interval', '1', '2']
+    results = []
+
+    backend = FakeEcsBackend(services=1, rollout_seconds=rollout_seconds, rate=rate, burst=burst,
+                             latency=latency)
+    results.append(run_scenario(
+        'deploy', cli.deploy,
+        ['--cluster', backend.cluster, '--service', backend.service_names[0], '-t', 'benchmark'] + poll_interval,
+        backend, 1
+    ))
+
+    backend = FakeEcsBackend(services=1, rollout_seconds=rollout_seconds, rate=rate, burst=burst,
+                             latency=latency)
+    results.append(run_scenario(
+        'scale', cli.scale,
+        [backend.cluster, backend.service_names[0], '4'] + poll_interval,
+        backend, 1
+    ))
+
+    for size in sizes:
+        backend = FakeEcsBackend(services=size, rollout_seconds=rollout_seconds, rate=rate, burst=burst,
+                                 latency=latency)
+        results.append(run_scenario(
+            'deploy_many-%d' % size, cli.deploy_many,
+            ['--cluster', backend.cluster, '--services', ','.join(backend.service_names),
+             '-i', 'app', 'app:2', '--engine', engine, '--worker_count', str(worker_count)] + poll_interval,
+            backend, size
+        ))
+    return results
+
+
+def compare(results, baseline, tolerance, checked=CHECKED_RESULTS):
+    baseline = dict((result['scenario'], result) for result in baseline)
+    regressions = []
+    for result in results:
+        expected = baseline.get(result['scenario'])
+        if expected is None:
+            continue
+        for key in checked:
+            if result[key] > expected[key] * (1 + tolerance):
+                regressions.append('%s: %s %s > %s' % (result['scenario'], key, result[key], expected[key]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 500],
+                        help='Number of services deployed by deploy_many (default: 10 100 500)')
+    parser.add_argument('--rollout-seconds', type=float, default=2.0,
+                        help='Seconds until the fake backend has started all tasks of a deployment (default: 2)')
+    parser.add_argument('--rate', type=float, default=40.0,
+                        help='Requests per second the fake backend accepts before throttling (default: 40)')
+    parser.add_argument('--burst', type=int, default=100,
+                        help='Requests the fake backend accepts at once before throttling (default: 100)')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Seconds every fake API call takes (default: 0.01)')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--worker-count', type=int, default=16)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Fail if the results are worse than in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed deviation from the baseline (default: 0.2)')
+    parser.add_argument('--check-wall-time', action='store_true',
+                        help='Also fail if a scenario takes more time than in the baseline')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.rollout_seconds, args.rate, args.burst, args.latency,
+                  args.engine, args.worker_count)
+
+    print('%-20s %8s %10s %10s %12s %10s %8s %10s' % (
+        'scenario', 'services', 'wall time', 'API calls', 'per service', 'throttles', 'threads', 'memory MB'))
+    for result in results:
+        print('%-20s %8d %10.2f %10d %12.2f %10d %8d %10.2f' % (
+            result['scenario'], result['services'], result['wall_time'], result['api_calls'],
+            result['api_calls_per_service'], result['throttles'], result['peak_threads'],
+            result['peak_memory_mb']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            checked = CHECKED_RESULTS + ('wall_time',) if args.check_wall_time else CHECKED_RESULTS
+            regressions = compare(results, json.load(f), args.tolerance, checked)
+        for regression in regressions:
+            print('Regression: %s' % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
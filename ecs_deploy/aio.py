@@ -0,0 +1,307 @@
+"""
+asyncio based deployment engine.
+
+boto3 is synchronous, so AsyncEcsClient runs the API calls of an EcsClient on
+a small thread pool, which bounds the number of calls in flight. Everything
+else - waiting for deployments, batching DescribeServices and sharing new
+task definition revisions - runs as coroutines on a single thread.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import partial
+
+from botocore.exceptions import ClientError, NoCredentialsError
+
+from ecs_deploy.ecs import EcsAction, EcsService, EcsTaskDefinition, \
+    EcsConnectionError, EcsError, DESCRIBE_TASKS_BATCH_SIZE, chunked
+
+
+class AsyncEcsClient(object):
+    def __init__(self, client, max_in_flight=10):
+        self._client = client
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    @property
+    def client(self):
+        return self._client
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._executor,
+            partial(method, *args, **kwargs)
+        )
+
+    async def describe_services(self, cluster_name, service_name):
+        return await self._run(
+            self._client.describe_services,
+            cluster_name=cluster_name,
+            service_name=service_name
+        )
+
+    async def describe_services_batch(self, cluster_name, service_names):
+        return await self._run(
+            self._client.describe_services_batch,
+            cluster_name=cluster_name,
+            service_names=service_names
+        )
+
+    async def describe_task_definition(self, task_definition_arn):
+        return await self._run(
+            self._client.describe_task_definition,
+            task_definition_arn=task_definition_arn
+        )
+
+    async def list_task_arns(self, cluster_name, service_name):
+        return await self._run(
+            lambda: list(self._client.list_task_arns(cluster_name, service_name))
+        )
+
+    async def describe_tasks(self, cluster_name, task_arns):
+        return await self._run(
+            self._client.describe_tasks,
+            cluster_name=cluster_name,
+            task_arns=task_arns
+        )
+
+    async def list_task_definition_arns(self, family, max_results):
+        return await self._run(
+            self._client.list_task_definition_arns,
+            family=family,
+            max_results=max_results
+        )
+
+    async def register_task_definition(self, family, containers, volumes,
+                                       role_arn, additional_properties):
+        return await self._run(
+            self._client.register_task_definition,
+            family=family,
+            containers=containers,
+            volumes=volumes,
+            role_arn=role_arn,
+            additional_properties=additional_properties
+        )
+
+    async def deregister_task_definition(self, task_definition_arn):
+        return await self._run(
+            self._client.deregister_task_definition,
+            task_definition_arn
+        )
+
+    async def update_service(self, cluster, service, desired_count,
+                             task_definition, force_new_deployment=False):
+        return await self._run(
+            self._client.update_service,
+            cluster=cluster,
+            service=service,
+            desired_count=desired_count,
+            task_definition=task_definition,
+            force_new_deployment=force_new_deployment
+        )
+
+
+class AsyncServicePoller(object):
+    """
+    Collects the services requested within batch_window seconds and describes
+    them with as few DescribeServices calls as possible.
+    """
+
+    def __init__(self, client, cluster_name, batch_window=0.5):
+        self._client = client
+        self._cluster_name = cluster_name
+        self._batch_window = batch_window
+        self._requests = {}
+        self._flush = None
+
+    async def get_service(self, service_name):
+        future = asyncio.get_event_loop().create_future()
+        self._requests.setdefault(service_name, []).append(future)
+        if self._flush is None:
+            self._flush = asyncio.ensure_future(self._poll())
+        return await future
+
+    async def _poll(self):
+        await asyncio.sleep(self._batch_window)
+        requests, self._requests = self._requests, {}
+        self._flush = None
+
+        try:
+            response = await self._client.describe_services_batch(
+                cluster_name=self._cluster_name,
+                service_names=sorted(requests)
+            )
+        except Exception as e:
+            for futures in requests.values():
+                for future in futures:
+                    future.set_exception(e)
+            return
+
+        services = {s[u'serviceName']: s for s in response[u'services']}
+        for service_name, futures in requests.items():
+            for future in futures:
+                if service_name in services:
+                    future.set_result(EcsService(
+                        cluster=self._cluster_name,
+                        service_definition=services[service_name]
+                    ))
+                else:
+                    future.set_exception(IndexError(service_name))
+
+
+class AsyncTaskDefinitionRegistry(object):
+    """
+    Coroutine counterpart of TaskDefinitionRegistry: the first deploy
+    registers a revision, all others with the same family and content await
+    it and receive a copy.
+    """
+
+    def __init__(self):
+        self._registrations = {}
+
+    async def register(self, task_definition, create):
+        key = (task_definition.family, task_definition.content_hash)
+        registration = self._registrations.get(key)
+        if registration is None:
+            registration = asyncio.ensure_future(create())
+            self._registrations[key] = registration
+        return deepcopy(await asyncio.shield(registration))
+
+
+class AsyncEcsAction(object):
+    def __init__(self, client, cluster_name, service_name, poller=None,
+                 task_definition_cache=None):
+        self._client = client
+        self._cluster_name = cluster_name
+        self._service_name = service_name
+        self._poller = poller
+        self._task_definition_cache = task_definition_cache
+        self._service = None
+
+    async def load(self):
+        try:
+            self._service = await self.get_service()
+        except IndexError:
+            raise EcsConnectionError(
+                u'An error occurred when calling the DescribeServices '
+                u'operation: Service not found.'
+            )
+        except ClientError as e:
+            raise EcsConnectionError(str(e))
+        except NoCredentialsError:
+            raise EcsConnectionError(
+                u'Unable to locate credentials. Configure credentials '
+                u'by running "aws configure".'
+            )
+        return self
+
+    async def get_service(self):
+        if self._poller:
+            return await self._poller.get_service(self._service_name)
+        services_definition = await self._client.describe_services(
+            cluster_name=self._cluster_name,
+            service_name=self._service_name
+        )
+        return EcsService(
+            cluster=self._cluster_name,
+            service_definition=services_definition[u'services'][0]
+        )
+
+    async def get_current_task_definition(self, service):
+        return await self.get_task_definition(service.task_definition)
+
+    async def get_task_definition(self, task_definition):
+        cache = self._task_definition_cache
+        payload = cache.get(task_definition) if cache else None
+        if payload is None:
+            response = await self._client.describe_task_definition(
+                task_definition_arn=task_definition
+            )
+            payload = response[u'taskDefinition']
+            if cache:
+                cache.set(task_definition, payload)
+        return EcsTaskDefinition(**payload)
+
+    async def find_task_definition(self, task_definition, depth=5):
+        content_hash = task_definition.content_hash
+        task_definition_arns = await self._client.list_task_definition_arns(
+            family=task_definition.family,
+            max_results=depth
+        )
+        for task_definition_arn in task_definition_arns:
+            revision = await self.get_task_definition(task_definition_arn)
+            if revision.content_hash == content_hash:
+                return revision
+        return None
+
+    async def update_task_definition(self, task_definition):
+        response = await self._client.register_task_definition(
+            family=task_definition.family,
+            containers=task_definition.containers,
+            volumes=task_definition.volumes,
+            role_arn=task_definition.role_arn,
+            additional_properties=task_definition.additional_properties
+        )
+        if self._task_definition_cache:
+            self._task_definition_cache.set(
+                response[u'taskDefinition'][u'taskDefinitionArn'],
+                response[u'taskDefinition']
+            )
+        return EcsTaskDefinition(**response[u'taskDefinition'])
+
+    async def deregister_task_definition(self, task_definition):
+        await self._client.deregister_task_definition(task_definition.arn)
+
+    async def update_service(self, service, force_new_deployment=False):
+        response = await self._client.update_service(
+            cluster=service.cluster,
+            service=service.name,
+            desired_count=service.desired_count,
+            task_definition=service.task_definition,
+            force_new_deployment=force_new_deployment,
+        )
+        return EcsService(self._cluster_name, response[u'service'])
+
+    async def is_deployed(self, service, strict=False):
+        if len(service[u'deployments']) != 1:
+            return False
+        if not strict:
+            return EcsAction.is_deployed_by_counters(service)
+        task_arns = await self._client.list_task_arns(
+            cluster_name=service.cluster,
+            service_name=service.name
+        )
+        responses = await asyncio.gather(*[
+            self._client.describe_tasks(cluster_name=self._cluster_name, task_arns=chunk)
+            for chunk in chunked(task_arns, DESCRIBE_TASKS_BATCH_SIZE)
+        ])
+        tasks = [task for response in responses for task in response[u'tasks']]
+        return service.desired_count == EcsAction.count_running_tasks(service, tasks)
+
+    @property
+    def client(self):
+        return self._client
+
+    @property
+    def service(self):
+        return self._service
+
+    @property
+    def cluster_name(self):
+        return self._cluster_name
+
+    @property
+    def service_name(self):
+        return self._service_name
+
+
+class AsyncDeployAction(AsyncEcsAction):
+    async def deploy(self, task_definition, force_new_deployment=False):
+        try:
+            self._service.set_task_definition(task_definition)
+            return await self.update_service(self._service, force_new_deployment=force_new_deployment)
+        except ClientError as e:
+            raise EcsError(str(e))
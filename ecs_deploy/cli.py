@@ -1,13 +1,13 @@
 from __future__ import print_function, absolute_import
 
 from os import getenv
-from time import sleep
+from time import monotonic, sleep
 
 import queue
 import threading
 import traceback
-import time
-import random
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import copy
 import click
@@ -15,11 +15,30 @@ import getpass
 from datetime import datetime, timedelta
 
 from ecs_deploy import VERSION
-from ecs_deploy.ecs import DeployAction, ScaleAction, RunAction, EcsClient, \
+from ecs_deploy.ecs import DeployAction, ScaleAction, RunAction, EcsClientPool, \
+    EcsServicePoller, EcsEventCursor, PollingPolicy, TaskDefinitionCache, TaskDefinitionRegistry, \
     TaskPlacementError, EcsError
-from ecs_deploy.slack import SlackLogger, SlackException
-
-SLACK_LOGGER = SlackLogger()
+from ecs_deploy.dependencies import DependencyGraph, DependencyError
+from ecs_deploy.manifest import Manifest, ManifestPlanner
+from ecs_deploy.metrics import DeployMetrics, sinks_from_env
+from ecs_deploy.ratelimit import RegionalRateLimiter
+from ecs_deploy.replay import TrafficRecorder, ReplayClient, ReplayError
+from ecs_deploy.slack import SlackLogger, SlackDashboard, SlackException
+
+# created on first use, see get_slack_logger
+SLACK_LOGGER = None
+SLACK_LOGGER_LOCK = threading.Lock()
+# The ECS API calls of this process share one adaptive rate limit per region
+RATE_LIMITER = RegionalRateLimiter()
+# Exported to StatsD and/or Prometheus, if configured by environment variables
+METRICS = DeployMetrics(sinks=sinks_from_env())
+CLIENT_POOL = EcsClientPool(rate_limiter=RATE_LIMITER, metrics=METRICS)
+# ECS API traffic may be recorded to a file, and replayed without network access,
+# configured on first use, see configure_traffic
+TRAFFIC_CONFIGURED = False
+TRAFFIC_LOCK = threading.Lock()
+# Task definition revisions are immutable and may be persisted between runs
+TASK_DEFINITION_CACHE = TaskDefinitionCache(path=getenv('ECS_DEPLOY_TASK_DEFINITION_CACHE'))
 
 @click.group()
 @click.version_option(version=VERSION, prog_name='ecs-deploy')
@@ -27,48 +46,333 @@ def ecs():  # pragma: no cover
     pass
 
 
+def get_slack_logger():
+    global SLACK_LOGGER
+    with SLACK_LOGGER_LOCK:
+        if SLACK_LOGGER is None:
+            SLACK_LOGGER = SlackLogger()
+        return SLACK_LOGGER
+
+
 def get_client(access_key_id, secret_access_key, region, profile):
-    return EcsClient(access_key_id, secret_access_key, region, profile)
+    configure_traffic()
+    return CLIENT_POOL.get_client(access_key_id, secret_access_key, region, profile)
+
+
+def configure_traffic():
+    """
+    Records or replays the ECS API traffic, if ECS_DEPLOY_RECORD or
+    ECS_DEPLOY_REPLAY is set.
+    """
+    global TRAFFIC_CONFIGURED
+    with TRAFFIC_LOCK:
+        if TRAFFIC_CONFIGURED:
+            return
+        try:
+            if getenv('ECS_DEPLOY_REPLAY'):
+                CLIENT_POOL.boto_client = ReplayClient(
+                    getenv('ECS_DEPLOY_REPLAY'),
+                    speed=getenv('ECS_DEPLOY_REPLAY_SPEED', 1)
+                )
+        except (ValueError, IOError, OSError, ReplayError) as e:
+            raise click.UsageError('Cannot replay ECS_DEPLOY_REPLAY=%s at ECS_DEPLOY_REPLAY_SPEED=%s: %s' % (
+                getenv('ECS_DEPLOY_REPLAY'), getenv('ECS_DEPLOY_REPLAY_SPEED', 1), e))
+        if getenv('ECS_DEPLOY_RECORD'):
+            CLIENT_POOL.recorder = TrafficRecorder(getenv('ECS_DEPLOY_RECORD'))
+        TRAFFIC_CONFIGURED = True
 
 
 @click.command()
-@click.option('--cluster', required=True)
-@click.option('--services', required=True, help='Comma separated list of services')
+@click.option('--cluster', help='Cluster of the --services')
+@click.option('--services', help='Comma separated list of services')
+@click.option('--target', type=(str, str, str), multiple=True, help='Deploys services of a cluster in another region, may be given multiple times: <region> <cluster> <comma separated services>')
 @click.option('-i', '--image', type=(str, str), multiple=True, help='Overwrites the image for a container: <container> <image>')
 @click.option('--timeout', required=False, default=900, type=int, help='Amount of seconds to wait for deployment before command fails (default: 900)')
-@click.option('--worker_count', required=False, default=16, type=int, help='Number of worker threads to run')
+@click.option('--worker_count', required=False, default=16, type=int, help='Number of services to deploy concurrently')
+@click.option('--canary', default=0, type=int, help='Number of services to deploy in a first wave, before all others (default: 0)')
+@click.option('--wave-size', callback=lambda ctx, param, value: parse_wave_size(ctx, value), help='Number (e.g. 10) or percentage (e.g. 25%) of the services to deploy per wave, after the canary (default: all)')
+@click.option('--depends-on', type=(str, str), multiple=True, help='Deploys a service after another service of the same region has been deployed, may be given multiple times: <service> <dependency>')
+@click.option('--engine', type=click.Choice(['threads', 'asyncio']), default='threads', help='Deploy every service in its own worker thread, or all of them as coroutines on one thread (default: threads)')
+@click.option('--max-in-flight', default=10, type=int, help='Maximum number of concurrent ECS API calls of the asyncio engine (default: 10)')
+@click.option('--max-deploys', type=int, help='Maximum number of services the asyncio engine deploys at once, --worker_count limits the threads engine (default: all services)')
+@click.option('--rollback/--no-rollback', default=False, help='Rollback to previous revision, if deployment failed (default: --no-rollback)')
 @click.option('--ignore-warnings', is_flag=True, help='Do not fail deployment on warnings (port already in use or insufficient memory/CPU)')
 @click.option('--force-new-deployment/--no-force-new-deployment', default=False, help='Recycle containers')
+@click.option('--strict/--no-strict', default=False, help='Count the RUNNING tasks to detect a finished deployment, instead of the deployment counters (default: --no-strict)')
+@click.option('--poll-interval', type=(int, int), default=(2, 30), callback=lambda ctx, param, value: parse_poll_interval(ctx, value), help='Minimum and maximum seconds between two status checks, backing off while the deployment does not change (default: 2 30)')
+@click.option('--slack-dashboard/--no-slack-dashboard', default=False, help='Report all services in one Slack message, updated in place, instead of separate messages per service (default: --no-slack-dashboard)')
+@click.option('--timings', envvar='ECS_DEPLOY_TIMINGS', help='Write the wall time of every deploy phase and ECS API call as JSON to this file, "-" writes to stderr')
 @click.pass_context
-def deploy_many(ctx, cluster, services, **kwargs):
+def deploy_many(ctx, cluster, services, target, **kwargs):
     """
     Redeploy/modify many services in parallel.
-    Services must be of the same cluster.
+    Services are either given with --cluster and --services, or with --target
+    for every region and cluster.
     This command calls the `deploy` command for every service in the list.
+
+    \b
+    Every region is deployed in parallel, with its own workers, ECS clients
+    and rate limit, e.g.
+    ecs deploy_many --target us-east-1 web app,worker --target eu-west-1 web app,worker
+
+    \b
+    With --canary and/or --wave-size the services are deployed in waves,
+    every wave starts when all deployments of the previous one are finished.
+    The rollout stops, if a deployment of a wave fails.
+
+    \b
+    With --depends-on a service starts as soon as all its dependencies are
+    deployed, services without dependencies start right away, e.g.
+    ecs deploy_many --cluster web --services api,worker,cron --depends-on worker api
+    If a deployment fails, the services depending on it are skipped.
+    Together with waves, the dependencies of a service are moved into the same
+    or an earlier wave.
+    """
+    if bool(cluster) != bool(services):
+        ctx.fail('--cluster and --services must be given together')
+    targets = get_targets(cluster, services, target)
+    if not targets:
+        ctx.fail('Either --cluster and --services or --target is required')
+    click.secho(f'Deploying to targets={targets} args={kwargs}')
+    num_worker_threads = kwargs.pop('worker_count')
+    engine = kwargs.pop('engine')
+    max_in_flight = kwargs.pop('max_in_flight')
+    max_deploys = kwargs.pop('max_deploys')
+    if max_deploys is not None and engine != 'asyncio':
+        ctx.fail('--max-deploys requires --engine asyncio, the threads engine is limited by --worker_count')
+    if max_deploys is not None and max_deploys <= 0:
+        ctx.fail('--max-deploys must be positive')
+    timings = kwargs.pop('timings')
+    # before the workers start, so that an invalid configuration is reported once
+    configure_traffic()
+    try:
+        dependencies = get_dependencies(targets, kwargs.pop('depends_on'))
+        graph = DependencyGraph(targets, dependencies)
+    except DependencyError as e:
+        ctx.fail(str(e))
+    # dependencies are deployed in the same or an earlier wave than their dependents
+    waves = get_waves(graph.ordered(), kwargs.pop('canary'), kwargs.pop('wave_size'))
+
+    dashboard = None
+    if kwargs.pop('slack_dashboard'):
+        clusters = list(dict.fromkeys((t.region, t.cluster) for t in targets))
+        dashboard = SlackDashboard(get_slack_logger(), clusters, [str(t) for t in targets])
+        dashboard.start()
+    try:
+        for number, wave in enumerate(waves, 1):
+            if len(waves) > 1:
+                click.secho(f'Deploying wave {number}/{len(waves)} with {len(wave)} services', fg='green')
+            with METRICS.phase('wave'):
+                if engine == 'asyncio':
+                    from ecs_deploy.cli_async import deploy_many_async
+                    failures = deploy_many_async(wave, max_deploys, max_in_flight,
+                                                 slack_logger=dashboard, dependencies=dependencies,
+                                                 **kwargs)
+                else:
+                    failures = deploy_many_threads(ctx, wave, num_worker_threads,
+                                                   slack_logger=dashboard, dependencies=dependencies,
+                                                   **kwargs)
+            if failures and len(waves) > 1:
+                skipped = sum(len(w) for w in waves[number:])
+                click.secho(
+                    f'Wave {number}/{len(waves)} failed for {", ".join(map(str, failures))}, stopping the rollout, '
+                    f'{skipped} services were not deployed',
+                    fg='red'
+                )
+                exit(1)
+            elif failures:
+                click.secho(f'Deployment failed for {", ".join(map(str, failures))}', fg='red')
+                exit(1)
+    finally:
+        if dashboard is not None:
+            with METRICS.phase('slack'):
+                dashboard.stop()
+        report_metrics(timings)
+
+
+def skip_dependents(graph, item, failures, slack_logger=None):
+    """
+    Records the failed deployment of item and skips all services depending on it.
+    """
+    failures.append(item)
+    if slack_logger is not None:
+        slack_logger.log_deploy_failure(str(item))
+    for skipped in graph.failed(item):
+        click.secho(f'Skipping deploy cluster={skipped.cluster} service={skipped.service}, {item.service} failed',
+                    fg='red')
+        failures.append(skipped)
+        if slack_logger is not None:
+            slack_logger.log_deploy_failure(str(skipped))
+
+
+class Target(namedtuple('Target', ['region', 'cluster', 'service'])):
+    def __str__(self):
+        return '/'.join(part for part in self if part)
+
+
+def get_targets(cluster, services, target):
+    """
+    Returns the Target of every service to deploy.
+    """
+    targets = []
+    if cluster:
+        targets.extend((None, cluster, service) for service in services.split(','))
+    for region, target_cluster, target_services in target:
+        targets.extend((region, target_cluster, service) for service in target_services.split(','))
+    return [Target(region, c, service.strip()) for region, c, service in targets if service.strip()]
+
+
+def get_dependencies(targets, depends_on):
+    """
+    Maps every target to the targets it depends on, given the (service, dependency)
+    names. A service depends on its dependencies in the same region.
+    """
+    names = set(service for _, _, service in targets)
+    dependencies = {}
+    for service, dependency in depends_on:
+        for name in (service, dependency):
+            if name not in names:
+                raise DependencyError('Unknown service in --depends-on: %s' % name)
+        for target in targets:
+            if target.service == service:
+                dependencies.setdefault(target, set()).update(
+                    other for other in targets
+                    if other.service == dependency and other.region == target.region
+                )
+    return dependencies
+
+
+def parse_wave_size(ctx, value):
+    """
+    Returns the wave size as (number, is_percentage), or None.
+    """
+    if value is None:
+        return None
+    is_percentage = value.endswith('%')
+    try:
+        number = int(value.rstrip('%'))
+    except ValueError:
+        number = 0
+    if number <= 0 or (is_percentage and number > 100):
+        raise click.BadParameter('must be a positive number or percentage, e.g. 10 or 25%', ctx=ctx)
+    return number, is_percentage
+
+
+def parse_poll_interval(ctx, value):
+    """
+    Returns the (minimum, maximum) poll interval, a minimum of 0 would poll
+    without pause.
+    """
+    if value[0] <= 0:
+        raise click.BadParameter('the minimum must be at least 1 second, e.g. 2 30', ctx=ctx)
+    return value
+
+
+def get_waves(targets, canary=0, wave_size=None):
+    """
+    Splits the targets into a canary wave and waves of wave_size.
+    """
+    waves = []
+    if canary > 0:
+        waves.append(targets[:canary])
+        targets = targets[canary:]
+    if wave_size is None:
+        size = len(targets)
+    else:
+        number, is_percentage = wave_size
+        # percentages are of all services, including the canary
+        size = -(-number * (len(targets) + canary) // 100) if is_percentage else number
+    for start in range(0, len(targets), max(size, 1)):
+        waves.append(targets[start:start + size])
+    return waves
+
+
+def group_by_region(targets):
+    regions = {}
+    for region, cluster, service in targets:
+        regions.setdefault(region, []).append((cluster, service))
+    return regions
+
+
+def deploy_many_threads(ctx, targets, num_worker_threads, slack_logger=None, dependencies=None, **kwargs):
+    regions = group_by_region(targets)
+
+    # The workers and pollers of a region share one client, one connection each
+    CLIENT_POOL.max_pool_connections = num_worker_threads + max(
+        len(set(cluster for cluster, _ in services)) for services in regions.values()
+    )
+
+    # ECS throttles per region, so the regions are deployed in parallel and the
+    # rollout takes as long as the slowest region
+    failures = []
+    threads = []
+    for region, services in regions.items():
+        t = threading.Thread(
+            target=deploy_region_threads,
+            args=(ctx, region, services, num_worker_threads, failures, slack_logger, dependencies),
+            kwargs=kwargs
+        )
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return failures
+
+
+def deploy_region_threads(ctx, region, services, num_worker_threads, failures, slack_logger=None,
+                          dependencies=None, **kwargs):
     """
-    slist = services.split(',')
-    click.secho(f'Deploying to cluster={cluster} services={slist} args={kwargs}')
-    num_worker_threads = kwargs['worker_count']
-    del kwargs['worker_count']
+    Deploys the (cluster, service) items of a region, failed ones are appended to failures.
+    """
+    graph = DependencyGraph([Target(region, cluster, service) for cluster, service in services], dependencies)
+
+    # All workers share one poller per cluster, which describes their services in batches
+    pollers = {}
+    try:
+        client = get_client(None, None, region, None)
+        for cluster, _ in services:
+            if cluster not in pollers:
+                pollers[cluster] = EcsServicePoller(client, cluster).start()
+    except Exception as e:
+        # an uncaught error would end the region's thread without reporting its services
+        tb = traceback.format_exc()
+        click.secho(f'Got error `{e}` for region={region} \n {tb}')
+        for poller in pollers.values():
+            poller.stop()
+        for item in graph.ready():
+            METRICS.record_failure(item.service, e)
+            skip_dependents(graph, item, failures, slack_logger)
+        return
+    # Services sharing a task definition family register each new revision once
+    registry = TaskDefinitionRegistry()
 
     def worker(q, tid):
-        # Before starting, sleep a random duration to avoid hitting rate limits
-        time.sleep(random.randint(1,15))
         while True:
             item = q.get()
             if item is None:
                 break
-            cluster, service = item
-            service = service.strip()
-            click.secho(f'Starting deploy cluster={cluster} service={service} tid={tid}')
+            _, cluster, service = item
+            click.secho(f'Starting deploy region={region} cluster={cluster} service={service} tid={tid}')
             try:
-                ctx.invoke(deploy, cluster=cluster, service=service, **kwargs)
+                ctx.invoke(deploy, cluster=cluster, service=service, region=region,
+                           poller=pollers[cluster], registry=registry,
+                           slack_logger=slack_logger.row(str(item)) if slack_logger is not None else None,
+                           timings=None, report=False, **kwargs)
+            except SystemExit:
+                # deploy exits after reporting a failed deployment
+                skip_dependents(graph, item, failures, slack_logger)
             except Exception as e:
                 tb = traceback.format_exc()
                 click.secho(f'Got error `{e}` for {service} tid={tid} \n {tb}')
+                METRICS.record_failure(service, e)
+                skip_dependents(graph, item, failures, slack_logger)
+            else:
+                # dependents are queued before this item is done, so q.join() waits for them
+                for ready in graph.done(item):
+                    q.put(ready)
             finally:
                 q.task_done()
-            click.secho(f'Done deploy cluster={cluster} service={service} tid={tid}')
+            click.secho(f'Done deploy region={region} cluster={cluster} service={service} tid={tid}')
 
     q = queue.Queue()
     threads = []
@@ -77,10 +381,8 @@ def deploy_many(ctx, cluster, services, **kwargs):
         t.start()
         threads.append(t)
 
-    for service in slist:
-        service = service.strip()
-        if service:
-            q.put((cluster, service))
+    for item in graph.ready():
+        q.put(item)
 
     # block until all tasks are done
     q.join()
@@ -90,6 +392,8 @@ def deploy_many(ctx, cluster, services, **kwargs):
         q.put(None)
     for t in threads:
         t.join()
+    for poller in pollers.values():
+        poller.stop()
 
 
 @click.command()
@@ -112,10 +416,14 @@ def deploy_many(ctx, cluster, services, **kwargs):
 @click.option('--comment', required=False, help='Description/comment for recording the deployment')
 @click.option('--user', required=False, help='User who executes the deployment (used for recording)')
 @click.option('--diff/--no-diff', default=True, help='Print which values were changed in the task definition (default: --diff)')
+@click.option('--reuse-revisions', default=5, type=int, help='Number of recent revisions to search for one identical to the new task definition, which is deployed instead of registering a new revision (default: 5, 0 disables)')
 @click.option('--deregister/--no-deregister', default=False, help='Deregister or keep the old task definition (default: --deregister)')
 @click.option('--rollback/--no-rollback', default=False, help='Rollback to previous revision, if deployment failed (default: --no-rollback)')
 @click.option('--force-new-deployment/--no-force-new-deployment', default=False, help='Recycle containers')
-def deploy(cluster, service, tag, image, command, env, role, task, region, access_key_id, secret_access_key, profile, timeout, newrelic_apikey, newrelic_appid, comment, user, ignore_warnings, diff, deregister, rollback, force_new_deployment):
+@click.option('--strict/--no-strict', default=False, help='Count the RUNNING tasks to detect a finished deployment, instead of the deployment counters (default: --no-strict)')
+@click.option('--poll-interval', type=(int, int), default=(2, 30), callback=lambda ctx, param, value: parse_poll_interval(ctx, value), help='Minimum and maximum seconds between two status checks, backing off while the deployment does not change (default: 2 30)')
+@click.option('--timings', envvar='ECS_DEPLOY_TIMINGS', help='Write the wall time of every deploy phase and ECS API call as JSON to this file, "-" writes to stderr')
+def deploy(cluster, service, tag, image, command, env, role, task, region, access_key_id, secret_access_key, profile, timeout, newrelic_apikey, newrelic_appid, comment, user, ignore_warnings, diff, reuse_revisions, deregister, rollback, force_new_deployment, strict, poll_interval, timings, poller=None, registry=None, slack_logger=None, report=True):
     """
     Redeploy or modify a service.
 
@@ -130,10 +438,13 @@ def deploy(cluster, service, tag, image, command, env, role, task, region, acces
 
     try:
         client = get_client(access_key_id, secret_access_key, region, profile)
-        deployment = DeployAction(client, cluster, service)
+        deployment = DeployAction(client, cluster, service, poller=poller,
+                                  task_definition_cache=TASK_DEFINITION_CACHE)
 
-        td = get_task_definition(deployment, task)
+        with METRICS.phase('get_task_definition', service):
+            td = get_task_definition(deployment, task)
         new_td = copy.deepcopy(td) # Make a copy if nothing need to be updated.
+        registered = False
 
         td.set_images(tag, **{key: value for (key, value) in image})
         td.set_commands(**{key: value for (key, value) in command})
@@ -142,7 +453,16 @@ def deploy(cluster, service, tag, image, command, env, role, task, region, acces
 
         if td.diff != []:
             print_diff(td)
-            new_td = create_task_definition(deployment, td)
+            with METRICS.phase('create_task_definition', service):
+                new_td, registered = create_task_definition(deployment, td, reuse_revisions, registry)
+            if new_td.arn == deployment.service.task_definition and not force_new_deployment:
+                click.secho(
+                    'Service already runs task definition %s, nothing to deploy\n' % new_td.family_revision,
+                    fg='green'
+                )
+                if slack_logger is not None:
+                    slack_logger.log_deploy_finish(deployment.service, new_td)
+                return
 
         try:
             deploy_task_definition(
@@ -152,16 +472,23 @@ def deploy(cluster, service, tag, image, command, env, role, task, region, acces
                 success_message='Deployment successful',
                 failure_message='Deployment failed',
                 timeout=timeout,
-                deregister=deregister,
+                deregister=deregister and new_td.arn != td.arn,
                 previous_task_definition=td,
                 ignore_warnings=ignore_warnings,
                 force_new_deployment=force_new_deployment,
+                strict=strict,
+                poll_interval=poll_interval,
+                slack_logger=slack_logger,
             )
 
         except TaskPlacementError as e:
             if rollback:
                 click.secho('%s\n' % str(e), fg='red')
-                rollback_task_definition(deployment, td, new_td)
+                METRICS.record_failure(service, e)
+                rollback_task_definition(deployment, td, new_td, strict=strict,
+                                         poll_interval=poll_interval,
+                                         slack_logger=slack_logger,
+                                         deregister=registered)
                 exit(1)
             else:
                 raise
@@ -170,7 +497,11 @@ def deploy(cluster, service, tag, image, command, env, role, task, region, acces
 
     except (EcsError, SlackException) as e:
         click.secho('%s\n' % str(e), fg='red')
+        METRICS.record_failure(service, e)
         exit(1)
+    finally:
+        if report:
+            report_metrics(timings)
 
 
 @click.command()
@@ -183,7 +514,10 @@ def deploy(cluster, service, tag, image, command, env, role, task, region, acces
 @click.option('--profile', help='AWS configuration profile name')
 @click.option('--timeout', default=900, type=int, help='AWS configuration profile')
 @click.option('--ignore-warnings', is_flag=True, help='Do not fail deployment on warnings (port already in use or insufficient memory/CPU)')
-def scale(cluster, service, desired_count, access_key_id, secret_access_key, region, profile, timeout, ignore_warnings):
+@click.option('--strict/--no-strict', default=False, help='Count the RUNNING tasks to detect a finished deployment, instead of the deployment counters (default: --no-strict)')
+@click.option('--poll-interval', type=(int, int), default=(2, 30), callback=lambda ctx, param, value: parse_poll_interval(ctx, value), help='Minimum and maximum seconds between two status checks, backing off while the deployment does not change (default: 2 30)')
+@click.option('--timings', envvar='ECS_DEPLOY_TIMINGS', help='Write the wall time of every deploy phase and ECS API call as JSON to this file, "-" writes to stderr')
+def scale(cluster, service, desired_count, access_key_id, secret_access_key, region, profile, timeout, ignore_warnings, strict, poll_interval, timings):
     """
     Scale a service up or down.
 
@@ -196,7 +530,8 @@ def scale(cluster, service, desired_count, access_key_id, secret_access_key, reg
         client = get_client(access_key_id, secret_access_key, region, profile)
         scaling = ScaleAction(client, cluster, service)
         click.secho('Updating service')
-        scaling.scale(desired_count)
+        with METRICS.phase('update_service', service):
+            scaling.scale(desired_count)
         click.secho(
             'Successfully changed desired count to: %s\n' % desired_count,
             fg='green'
@@ -207,56 +542,237 @@ def scale(cluster, service, desired_count, access_key_id, secret_access_key, reg
             title='Scaling service',
             success_message='Scaling successful',
             failure_message='Scaling failed',
-            ignore_warnings=ignore_warnings
+            ignore_warnings=ignore_warnings,
+            strict=strict,
+            poll_interval=poll_interval
         )
 
+    except EcsError as e:
+        click.secho('%s\n' % str(e), fg='red')
+        METRICS.record_failure(service, e)
+        exit(1)
+    finally:
+        report_metrics(timings)
+
+
+@click.command()
+@click.argument('manifest', type=click.Path(exists=True, dir_okay=False))
+@click.option('--worker_count', default=16, type=int, help='Number of services to plan concurrently')
+def plan(manifest, worker_count):
+    """
+    Show the changes of a deploy manifest.
+
+    \b
+    MANIFEST is a YAML or JSON file of clusters, services and their images,
+    environment variables and commands.
+    """
+    try:
+        manifest = Manifest.load(manifest)
+        planner = ManifestPlanner(get_client(None, None, manifest.region, manifest.profile),
+                                  workers=worker_count, task_definition_cache=TASK_DEFINITION_CACHE)
+        try:
+            plans = planner.plan(manifest)
+        finally:
+            planner.stop()
+        if not print_plan(plans):
+            exit(1)
     except EcsError as e:
         click.secho('%s\n' % str(e), fg='red')
         exit(1)
 
 
+@click.command()
+@click.argument('manifest', type=click.Path(exists=True, dir_okay=False))
+@click.option('--worker_count', default=16, type=int, help='Number of services to plan and deploy concurrently')
+@click.option('--timeout', default=900, type=int, help='Amount of seconds to wait for every deployment before it fails (default: 900)')
+@click.option('--ignore-warnings', is_flag=True, help='Do not fail deployment on warnings (port already in use or insufficient memory/CPU)')
+@click.option('--reuse-revisions', default=5, type=int, help='Number of recent revisions to search for one identical to the new task definition, which is deployed instead of registering a new revision (default: 5, 0 disables)')
+@click.option('--deregister/--no-deregister', default=False, help='Deregister or keep the old task definitions (default: --no-deregister)')
+@click.option('--strict/--no-strict', default=False, help='Count the RUNNING tasks to detect a finished deployment, instead of the deployment counters (default: --no-strict)')
+@click.option('--poll-interval', type=(int, int), default=(2, 30), callback=lambda ctx, param, value: parse_poll_interval(ctx, value), help='Minimum and maximum seconds between two status checks, backing off while the deployment does not change (default: 2 30)')
+@click.option('--timings', envvar='ECS_DEPLOY_TIMINGS', help='Write the wall time of every deploy phase and ECS API call as JSON to this file, "-" writes to stderr')
+def apply(manifest, worker_count, timeout, ignore_warnings, reuse_revisions, deregister, strict, poll_interval, timings):
+    """
+    Deploy the changes of a deploy manifest.
+
+    \b
+    MANIFEST is a YAML or JSON file of clusters, services and their images,
+    environment variables and commands.
+
+    All services are planned first, nothing is deployed if planning fails.
+    The changed services are deployed in parallel.
+    """
+    try:
+        manifest = Manifest.load(manifest)
+        CLIENT_POOL.max_pool_connections = worker_count + len(manifest.clusters)
+        client = get_client(None, None, manifest.region, manifest.profile)
+        planner = ManifestPlanner(client, workers=worker_count, task_definition_cache=TASK_DEFINITION_CACHE)
+        try:
+            with METRICS.phase('plan'):
+                plans = planner.plan(manifest)
+            if not print_plan(plans):
+                exit(1)
+            failures = apply_plans(
+                [planned for planned in plans if planned.changed],
+                workers=worker_count,
+                timeout=timeout,
+                ignore_warnings=ignore_warnings,
+                reuse_revisions=reuse_revisions,
+                deregister=deregister,
+                strict=strict,
+                poll_interval=poll_interval
+            )
+        finally:
+            planner.stop()
+        if failures:
+            click.secho('Deployment failed: %s\n' % ', '.join(failures), fg='red')
+            exit(1)
+    except EcsError as e:
+        click.secho('%s\n' % str(e), fg='red')
+        exit(1)
+    finally:
+        report_metrics(timings)
+
+
+def print_plan(plans):
+    for planned in plans:
+        if planned.error is not None:
+            click.secho('%s: %s\n' % (planned.entry.name, planned.error), fg='red')
+        elif planned.changed:
+            click.secho('%s: based on task definition %s' % (planned.entry.name, planned.current.family_revision))
+            if planned.modified:
+                print_diff(planned.task_definition, title='Updating task definition')
+            else:
+                click.secho('Deploying task definition %s\n' % planned.current.family_revision)
+        else:
+            click.secho('%s: no changes\n' % planned.entry.name, fg='green')
+
+    errors = len([planned for planned in plans if planned.error is not None])
+    changes = len([planned for planned in plans if planned.changed])
+    click.secho(
+        'Plan: %d to deploy, %d unchanged, %d failed' % (changes, len(plans) - changes - errors, errors),
+        fg='red' if errors else 'green'
+    )
+    return not errors
+
+
+def apply_plans(plans, workers, **kwargs):
+    # Services sharing a task definition family register each new revision once
+    registry = TaskDefinitionRegistry()
+    failures = []
+
+    def deploy_planned(planned):
+        try:
+            apply_plan(planned, registry, **kwargs)
+        except SystemExit:
+            # deploy_task_definition exits after reporting a failed deployment
+            failures.append(planned.entry.name)
+        except Exception as e:
+            click.secho('%s: %s\n' % (planned.entry.name, e), fg='red')
+            METRICS.record_failure(planned.entry.name, e)
+            failures.append(planned.entry.name)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(deploy_planned, plans))
+    return sorted(failures)
+
+
+def apply_plan(planned, registry, timeout, ignore_warnings, reuse_revisions, deregister,
+               strict, poll_interval):
+    deployment = planned.action
+    td = planned.task_definition
+    click.secho('Deploying %s' % planned.entry.name)
+
+    new_td = planned.current
+    if planned.modified:
+        with METRICS.phase('create_task_definition', deployment.service_name):
+            new_td, _ = create_task_definition(deployment, td, reuse_revisions, registry)
+        if new_td.arn == deployment.service.task_definition:
+            click.secho(
+                '%s already runs task definition %s, nothing to deploy\n'
+                % (planned.entry.name, new_td.family_revision),
+                fg='green'
+            )
+            return
+
+    deploy_task_definition(
+        deployment=deployment,
+        task_definition=new_td,
+        title='Deploying %s' % planned.entry.name,
+        success_message='Deployment of %s successful' % planned.entry.name,
+        failure_message='Deployment of %s failed' % planned.entry.name,
+        timeout=timeout,
+        deregister=deregister and new_td.arn != planned.current.arn,
+        previous_task_definition=planned.current,
+        ignore_warnings=ignore_warnings,
+        strict=strict,
+        poll_interval=poll_interval,
+    )
+
+
+def report_metrics(timings):
+    METRICS.flush()
+    if timings:
+        METRICS.write(timings)
+
+
 def wait_for_finish(action, timeout, title, success_message, failure_message,
-                    ignore_warnings, task_definition=None):
+                    ignore_warnings, task_definition=None, strict=False,
+                    poll_interval=(2, 30), slack_logger=None):
+    slack_logger = slack_logger or get_slack_logger()
     click.secho(title, nl=False)
     waiting = True
     waiting_timeout = datetime.now() + timedelta(seconds=timeout)
     service = action.get_service()
-    inspected_until = None
+    events = EcsEventCursor()
+    polling = PollingPolicy(*poll_interval)
+    started_at = monotonic()
+    polls = 0
 
-    chat_update = SLACK_LOGGER.log_deploy_progress(service, task_definition, None)
+    with METRICS.phase('slack', action.service_name):
+        chat_update = slack_logger.log_deploy_progress(service, task_definition, None)
     while waiting and datetime.now() < waiting_timeout:
         click.secho('.', nl=False)
-        service = action.get_service()
-        inspected_until = inspect_errors(
-            service=service,
-            failure_message=failure_message,
-            ignore_warnings=ignore_warnings,
-            since=inspected_until,
-            timeout=False
-        )
-        waiting = not action.is_deployed(service)
-        chat_update = SLACK_LOGGER.log_deploy_progress(service, task_definition, chat_update)
+        polls += 1
+        with METRICS.phase('poll', action.service_name):
+            service = action.get_service()
+            inspect_errors(
+                service=service,
+                failure_message=failure_message,
+                ignore_warnings=ignore_warnings,
+                events=events,
+                timeout=False
+            )
+            waiting = not action.is_deployed(service, strict=strict)
+        with METRICS.phase('slack', action.service_name):
+            chat_update = slack_logger.log_deploy_progress(service, task_definition, chat_update)
 
         if waiting:
-            sleep(30)
+            with METRICS.phase('wait', action.service_name):
+                sleep(polling.next_interval(service))
 
     inspect_errors(
         service=service,
         failure_message=failure_message,
         ignore_warnings=ignore_warnings,
-        since=inspected_until,
+        events=events,
         timeout=waiting
     )
+    METRICS.record_convergence(action.service_name, monotonic() - started_at, polls)
 
     click.secho('\n%s\n' % success_message, fg='green')
 
 
 def deploy_task_definition(deployment, task_definition, title, success_message,
                            failure_message, timeout, deregister,
-                           previous_task_definition, ignore_warnings, force_new_deployment=False):
+                           previous_task_definition, ignore_warnings, force_new_deployment=False,
+                           strict=False, poll_interval=(2, 30), slack_logger=None):
+    slack_logger = slack_logger or get_slack_logger()
     click.secho('Updating service')
-    SLACK_LOGGER.log_deploy_start(deployment.service, task_definition)
-    deployment.deploy(task_definition, force_new_deployment=force_new_deployment)
+    with METRICS.phase('slack', deployment.service_name):
+        slack_logger.log_deploy_start(deployment.service, task_definition)
+    with METRICS.phase('update_service', deployment.service_name):
+        deployment.deploy(task_definition, force_new_deployment=force_new_deployment)
 
     message = 'Successfully changed task definition to: %s:%s\n' % (
         task_definition.family,
@@ -273,11 +789,16 @@ def deploy_task_definition(deployment, task_definition, title, success_message,
         success_message=success_message,
         failure_message=failure_message,
         ignore_warnings=ignore_warnings,
+        strict=strict,
+        poll_interval=poll_interval,
+        slack_logger=slack_logger,
     )
 
-    SLACK_LOGGER.log_deploy_finish(deployment.service, task_definition)
+    with METRICS.phase('slack', deployment.service_name):
+        slack_logger.log_deploy_finish(deployment.service, task_definition)
     if deregister:
-        deregister_task_definition(deployment, previous_task_definition)
+        with METRICS.phase('deregister_task_definition', deployment.service_name):
+            deregister_task_definition(deployment, previous_task_definition)
 
 
 def get_task_definition(action, task):
@@ -292,7 +813,28 @@ def get_task_definition(action, task):
     return task_definition
 
 
-def create_task_definition(action, task_definition):
+def create_task_definition(action, task_definition, reuse_revisions=0, registry=None):
+    """
+    Returns the task definition to deploy and whether it was registered for
+    this deployment alone, a revision reused or shared through the registry
+    may be deployed by other services.
+    """
+    if registry is not None:
+        new_td, _ = registry.register(
+            task_definition,
+            lambda: create_task_definition(action, task_definition, reuse_revisions)
+        )
+        return new_td, False
+
+    if reuse_revisions > 0:
+        existing_td = action.find_task_definition(task_definition, depth=reuse_revisions)
+        if existing_td:
+            click.secho(
+                'Reusing identical revision: %d\n' % existing_td.revision,
+                fg='green'
+            )
+            return existing_td, False
+
     click.secho('Creating new task definition revision')
     new_td = action.update_task_definition(task_definition)
 
@@ -301,7 +843,7 @@ def create_task_definition(action, task_definition):
         fg='green'
     )
 
-    return new_td
+    return new_td, True
 
 
 def deregister_task_definition(action, task_definition):
@@ -313,7 +855,8 @@ def deregister_task_definition(action, task_definition):
     )
 
 
-def rollback_task_definition(deployment, old, new, timeout=900):
+def rollback_task_definition(deployment, old, new, timeout=900, strict=False,
+                             poll_interval=(2, 30), slack_logger=None, deregister=True):
     click.secho(
         'Rolling back to task definition: %s\n' % old.family_revision,
         fg='yellow',
@@ -325,9 +868,12 @@ def rollback_task_definition(deployment, old, new, timeout=900):
         success_message='Rollback successful',
         failure_message='Rollback failed. Please check ECS Console',
         timeout=timeout,
-        deregister=True,
+        deregister=deregister,
         previous_task_definition=new,
         ignore_warnings=False,
+        strict=strict,
+        poll_interval=poll_interval,
+        slack_logger=slack_logger,
     )
     click.secho(
         'Deployment failed, but service has been rolled back to previous '
@@ -358,16 +904,14 @@ def print_diff(task_definition, title='Updating task definition'):
         click.secho('')
 
 
-def inspect_errors(service, failure_message, ignore_warnings, since, timeout):
+def inspect_errors(service, failure_message, ignore_warnings, events, timeout):
     error = False
-    last_error_timestamp = since
 
-    warnings = service.get_warnings(since)
+    warnings = events.get_warnings(service)
     for timestamp in warnings:
         message = warnings[timestamp]
         click.secho('')
         if ignore_warnings:
-            last_error_timestamp = timestamp
             click.secho('%s\nWARNING: %s' % (timestamp, message))
             click.secho('Continuing.', nl=False)
         else:
@@ -389,12 +933,12 @@ def inspect_errors(service, failure_message, ignore_warnings, since, timeout):
     if error:
         raise TaskPlacementError(failure_message)
 
-    return last_error_timestamp
-
 
 ecs.add_command(deploy)
 ecs.add_command(deploy_many)
 ecs.add_command(scale)
+ecs.add_command(plan)
+ecs.add_command(apply)
 
 if __name__ == '__main__':  # pragma: no cover
     ecs()
@@ -0,0 +1,259 @@
+"""
+deploy_many with the asyncio engine. Kept apart from the CLI module, so that
+asyncio is only imported when the engine is used.
+"""
+import asyncio
+import copy
+import traceback
+from datetime import datetime, timedelta
+from time import monotonic
+
+import click
+
+from ecs_deploy import cli
+from ecs_deploy.aio import AsyncEcsClient, AsyncServicePoller, AsyncTaskDefinitionRegistry, \
+    AsyncDeployAction
+from ecs_deploy.dependencies import DependencyGraph
+from ecs_deploy.ecs import EcsEventCursor, PollingPolicy, EcsError, TaskPlacementError
+
+
+def deploy_many_async(targets, max_deploys, max_in_flight, **kwargs):
+    regions = cli.group_by_region(targets)
+    cli.CLIENT_POOL.max_pool_connections = max_in_flight + 1
+    # every region has its own client, with its own limit of calls in flight
+    clients = dict(
+        (region, AsyncEcsClient(cli.get_client(None, None, region, None), max_in_flight=max_in_flight))
+        for region in regions
+    )
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_deploy_regions_async(clients, regions, max_deploys, **kwargs))
+    finally:
+        loop.close()
+        for client in clients.values():
+            client.close()
+
+
+async def _deploy_regions_async(clients, regions, max_deploys, **kwargs):
+    failures = await asyncio.gather(*[
+        _deploy_many_async(clients[region], region, services, max_deploys, **kwargs)
+        for region, services in regions.items()
+    ])
+    return [failure for region_failures in failures for failure in region_failures]
+
+
+async def _deploy_many_async(client, region, services, max_deploys, slack_logger=None,
+                             dependencies=None, **kwargs):
+    graph = DependencyGraph([cli.Target(region, cluster, service) for cluster, service in services],
+                            dependencies)
+    pollers = {}
+    for cluster, _ in services:
+        if cluster not in pollers:
+            pollers[cluster] = AsyncServicePoller(client, cluster)
+    registry = AsyncTaskDefinitionRegistry()
+    # without a limit, all services of the region are deployed at once
+    semaphore = asyncio.Semaphore(max_deploys or len(services))
+    failures = []
+
+    tasks = []
+
+    def start(items):
+        tasks.extend(asyncio.ensure_future(worker(item)) for item in items)
+
+    async def worker(item):
+        _, cluster, service = item
+        async with semaphore:
+            click.secho(f'Starting deploy region={region} cluster={cluster} service={service}')
+            try:
+                await deploy_async(client, cluster, service, poller=pollers[cluster], registry=registry,
+                                   slack_logger=slack_logger.row(str(item)) if slack_logger is not None else None,
+                                   **kwargs)
+            except EcsError as e:
+                click.secho(f'Got error `{e}` for {service}', fg='red')
+                cli.METRICS.record_failure(service, e)
+                cli.skip_dependents(graph, item, failures, slack_logger)
+            except Exception as e:
+                tb = traceback.format_exc()
+                click.secho(f'Got error `{e}` for {service} \n {tb}')
+                cli.METRICS.record_failure(service, e)
+                cli.skip_dependents(graph, item, failures, slack_logger)
+            else:
+                start(graph.done(item))
+            click.secho(f'Done deploy region={region} cluster={cluster} service={service}')
+
+    start(graph.ready())
+    # workers start their dependents, which are appended to tasks
+    for task in tasks:
+        await task
+    return failures
+
+
+async def deploy_async(client, cluster, service, image, timeout, ignore_warnings,
+                       force_new_deployment, strict, poll_interval, rollback=False, poller=None,
+                       registry=None, reuse_revisions=5, slack_logger=None):
+    dashboard = slack_logger
+    slack_logger = slack_logger or cli.get_slack_logger()
+    deployment = AsyncDeployAction(client, cluster, service, poller=poller,
+                                   task_definition_cache=cli.TASK_DEFINITION_CACHE)
+    with cli.METRICS.phase('get_task_definition', service):
+        await deployment.load()
+        td = await deployment.get_current_task_definition(deployment.service)
+    click.secho('Deploying based on task definition: %s\n' % td.family_revision)
+    new_td = copy.deepcopy(td)
+
+    td.set_images(None, **{key: value for (key, value) in image})
+
+    if td.diff != []:
+        cli.print_diff(td)
+        with cli.METRICS.phase('create_task_definition', service):
+            new_td = await registry.register(
+                td,
+                lambda: create_task_definition_async(deployment, td, reuse_revisions)
+            )
+        if new_td.arn == deployment.service.task_definition and not force_new_deployment:
+            click.secho(
+                'Service already runs task definition %s, nothing to deploy\n' % new_td.family_revision,
+                fg='green'
+            )
+            if dashboard is not None:
+                dashboard.log_deploy_finish(deployment.service, new_td)
+            return
+
+    try:
+        await deploy_task_definition_async(
+            deployment=deployment,
+            task_definition=new_td,
+            title='Deploying new task definition',
+            success_message='Deployment successful',
+            failure_message='Deployment failed',
+            timeout=timeout,
+            ignore_warnings=ignore_warnings,
+            force_new_deployment=force_new_deployment,
+            strict=strict,
+            poll_interval=poll_interval,
+            slack_logger=slack_logger,
+        )
+    except TaskPlacementError as e:
+        if not rollback:
+            raise
+        click.secho('%s\n' % str(e), fg='red')
+        # like cli.deploy with a registry, the failed revision is not deregistered,
+        # other services may deploy it as well
+        click.secho('Rolling back to task definition: %s\n' % td.family_revision, fg='yellow')
+        await deploy_task_definition_async(
+            deployment=deployment,
+            task_definition=td,
+            title='Deploying previous task definition',
+            success_message='Rollback successful',
+            failure_message='Rollback failed. Please check ECS Console',
+            timeout=900,
+            ignore_warnings=False,
+            strict=strict,
+            poll_interval=poll_interval,
+            slack_logger=slack_logger,
+        )
+        click.secho(
+            'Deployment failed, but service has been rolled back to previous '
+            'task definition: %s\n' % td.family_revision, fg='yellow')
+        raise
+
+
+async def deploy_task_definition_async(deployment, task_definition, title, success_message,
+                                       failure_message, timeout, ignore_warnings,
+                                       force_new_deployment=False, strict=False,
+                                       poll_interval=(2, 30), slack_logger=None):
+    service = deployment.service_name
+    click.secho('Updating service')
+    with cli.METRICS.phase('slack', service):
+        await run_in_thread(slack_logger.log_deploy_start, deployment.service, task_definition)
+    with cli.METRICS.phase('update_service', service):
+        await deployment.deploy(task_definition, force_new_deployment=force_new_deployment)
+    click.secho(
+        'Successfully changed task definition to: %s:%s\n' % (task_definition.family, task_definition.revision),
+        fg='green'
+    )
+
+    await wait_for_finish_async(
+        action=deployment,
+        task_definition=task_definition,
+        timeout=timeout,
+        title=title,
+        success_message=success_message,
+        failure_message=failure_message,
+        ignore_warnings=ignore_warnings,
+        strict=strict,
+        poll_interval=poll_interval,
+        slack_logger=slack_logger,
+    )
+    with cli.METRICS.phase('slack', service):
+        await run_in_thread(slack_logger.log_deploy_finish, deployment.service, task_definition)
+
+
+async def create_task_definition_async(action, task_definition, reuse_revisions=0):
+    if reuse_revisions > 0:
+        existing_td = await action.find_task_definition(task_definition, depth=reuse_revisions)
+        if existing_td:
+            click.secho(
+                'Reusing identical revision: %d\n' % existing_td.revision,
+                fg='green'
+            )
+            return existing_td
+
+    click.secho('Creating new task definition revision')
+    new_td = await action.update_task_definition(task_definition)
+    click.secho(
+        'Successfully created revision: %d\n' % new_td.revision,
+        fg='green'
+    )
+    return new_td
+
+
+async def wait_for_finish_async(action, timeout, title, success_message, failure_message,
+                                ignore_warnings, task_definition=None, strict=False,
+                                poll_interval=(2, 30), slack_logger=None):
+    slack_logger = slack_logger or cli.get_slack_logger()
+    click.secho(title, nl=False)
+    waiting = True
+    waiting_timeout = datetime.now() + timedelta(seconds=timeout)
+    service = await action.get_service()
+    events = EcsEventCursor()
+    polling = PollingPolicy(*poll_interval)
+    started_at = monotonic()
+    polls = 0
+
+    with cli.METRICS.phase('slack', action.service_name):
+        chat_update = await run_in_thread(slack_logger.log_deploy_progress, service, task_definition, None)
+    while waiting and datetime.now() < waiting_timeout:
+        click.secho('.', nl=False)
+        polls += 1
+        with cli.METRICS.phase('poll', action.service_name):
+            service = await action.get_service()
+            cli.inspect_errors(
+                service=service,
+                failure_message=failure_message,
+                ignore_warnings=ignore_warnings,
+                events=events,
+                timeout=False
+            )
+            waiting = not await action.is_deployed(service, strict=strict)
+        with cli.METRICS.phase('slack', action.service_name):
+            chat_update = await run_in_thread(slack_logger.log_deploy_progress, service, task_definition, chat_update)
+
+        if waiting:
+            with cli.METRICS.phase('wait', action.service_name):
+                await asyncio.sleep(polling.next_interval(service))
+
+    cli.inspect_errors(
+        service=service,
+        failure_message=failure_message,
+        ignore_warnings=ignore_warnings,
+        events=events,
+        timeout=waiting
+    )
+    cli.METRICS.record_convergence(action.service_name, monotonic() - started_at, polls)
+
+    click.secho('\n%s\n' % success_message, fg='green')
+
+
+async def run_in_thread(func, *args):
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
@@ -0,0 +1,104 @@
+"""
+Dependencies between the services of a deploy_many run.
+"""
+import threading
+
+
+class DependencyError(Exception):
+    pass
+
+
+class DependencyGraph(object):
+    """
+    Schedules deployments, so that every service starts as soon as all its
+    dependencies are deployed.
+
+    dependencies maps an item to the items it depends on, dependencies on
+    items which are not part of the graph are ignored. When a deployment
+    fails, all items depending on it, directly or indirectly, are skipped.
+    """
+
+    def __init__(self, items, dependencies=None):
+        self.items = list(items)
+        dependencies = dependencies or {}
+        self._dependencies = {}
+        self._dependents = dict((item, []) for item in self.items)
+        for item in self.items:
+            self._dependencies[item] = set(
+                dependency for dependency in dependencies.get(item, ())
+                if dependency in self._dependents and dependency != item
+            )
+            for dependency in self._dependencies[item]:
+                self._dependents[dependency].append(item)
+        self._pending = dict((item, len(self._dependencies[item])) for item in self.items)
+        self._skipped = set()
+        self._lock = threading.Lock()
+        self._check_cycles()
+
+    def ready(self):
+        """
+        Returns the items without dependencies, which can start right away.
+        """
+        return [item for item in self.items if not self._dependencies[item]]
+
+    def ordered(self):
+        """
+        Returns all items, every item after its dependencies and otherwise in
+        the given order.
+        """
+        position = dict((item, i) for i, item in enumerate(self.items))
+        ordered = []
+        placed = set()
+
+        def place(item):
+            if item not in placed:
+                placed.add(item)
+                for dependency in sorted(self._dependencies[item], key=position.get):
+                    place(dependency)
+                ordered.append(item)
+
+        for item in self.items:
+            place(item)
+        return ordered
+
+    def done(self, item):
+        """
+        Marks item as deployed and returns the items, which can start now.
+        """
+        ready = []
+        with self._lock:
+            for dependent in self._dependents[item]:
+                self._pending[dependent] -= 1
+                if self._pending[dependent] == 0 and dependent not in self._skipped:
+                    ready.append(dependent)
+        return ready
+
+    def failed(self, item):
+        """
+        Marks item as failed and returns the items, which are skipped because of it.
+        """
+        skipped = []
+        with self._lock:
+            stack = list(self._dependents[item])
+            while stack:
+                dependent = stack.pop()
+                if dependent not in self._skipped:
+                    self._skipped.add(dependent)
+                    skipped.append(dependent)
+                    stack.extend(self._dependents[dependent])
+        return skipped
+
+    def _check_cycles(self):
+        pending = dict(self._pending)
+        ready = self.ready()
+        visited = 0
+        while ready:
+            item = ready.pop()
+            visited += 1
+            for dependent in self._dependents[item]:
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    ready.append(dependent)
+        if visited < len(self.items):
+            cycle = sorted(str(item) for item, count in pending.items() if count > 0)
+            raise DependencyError(u'Circular dependencies between: %s' % u', '.join(cycle))
@@ -1,28 +1,127 @@
+import json
+import os
+import tempfile
+from hashlib import sha256
+import threading
+from collections import deque
+from copy import deepcopy
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from itertools import islice
+from time import monotonic, sleep
 
-from boto3.session import Session
 from botocore.exceptions import ClientError, NoCredentialsError
-from dateutil.tz import tzlocal
+
+from ecs_deploy.ratelimit import RegionalRateLimiter, is_throttling_error
+from ecs_deploy.replay import RecordingClient
+
+# DescribeServices accepts at most 10 services per call
+DESCRIBE_SERVICES_BATCH_SIZE = 10
+# DescribeTasks accepts at most 100 tasks per call
+DESCRIBE_TASKS_BATCH_SIZE = 100
+DESCRIBE_TASKS_WORKERS = 4
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
 
 
 class EcsClient(object):
     def __init__(self, access_key_id=None, secret_access_key=None,
-                 region=None, profile=None):
-        session = Session(aws_access_key_id=access_key_id,
-                          aws_secret_access_key=secret_access_key,
-                          region_name=region,
-                          profile_name=profile)
-        self.boto = session.client(u'ecs')
+                 region=None, profile=None, rate_limiter=None,
+                 max_pool_connections=None, metrics=None, boto_client=None,
+                 recorder=None):
+        if boto_client is None:
+            # boto3 takes long to import, only load it to talk to AWS
+            from boto3.session import Session
+            from botocore.config import Config
+            session = Session(aws_access_key_id=access_key_id,
+                              aws_secret_access_key=secret_access_key,
+                              region_name=region,
+                              profile_name=profile)
+            config = {}
+            if max_pool_connections:
+                config[u'max_pool_connections'] = max_pool_connections
+            if rate_limiter is not None:
+                # the shared rate limiter backs off, botocore retrying on its own
+                # would bypass the bucket and multiply the calls
+                config[u'retries'] = {u'total_max_attempts': 1}
+            client_options = {}
+            if config:
+                client_options[u'config'] = Config(**config)
+            boto_client = session.client(u'ecs', **client_options)
+        if recorder is not None:
+            boto_client = RecordingClient(boto_client, recorder)
+        self.boto = boto_client
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+
+    def _call(self, operation, **kwargs):
+        method = getattr(self.boto, operation)
+        if self.metrics is None:
+            return self._send(method, **kwargs)
+
+        stats = {u'attempts': 0, u'throttles': 0}
+
+        def send(**kwargs):
+            stats[u'attempts'] += 1
+            try:
+                return method(**kwargs)
+            except ClientError as e:
+                if is_throttling_error(e):
+                    stats[u'throttles'] += 1
+                raise
+
+        started_at = monotonic()
+        response = None
+        try:
+            response = self._send(send, **kwargs)
+            return response
+        finally:
+            # retries of the rate limiter and of botocore itself
+            retries = max(stats[u'attempts'] - 1, 0)
+            if response:
+                retries += response.get(u'ResponseMetadata', {}).get(u'RetryAttempts', 0)
+            self.metrics.record_call(
+                operation,
+                monotonic() - started_at,
+                retries=retries,
+                throttles=stats[u'throttles'],
+                error=response is None
+            )
+
+    def _send(self, method, **kwargs):
+        if self.rate_limiter is None:
+            return method(**kwargs)
+        return self.rate_limiter.call(method, **kwargs)
 
     def describe_services(self, cluster_name, service_name):
-        return self.boto.describe_services(
+        return self._call(
+            u'describe_services',
             cluster=cluster_name,
             services=[service_name]
         )
 
+    def describe_services_batch(self, cluster_name, service_names):
+        response = {u'services': [], u'failures': []}
+        for chunk in chunked(service_names, DESCRIBE_SERVICES_BATCH_SIZE):
+            batch = self._call(
+                u'describe_services',
+                cluster=cluster_name,
+                services=chunk
+            )
+            response[u'services'].extend(batch.get(u'services', []))
+            response[u'failures'].extend(batch.get(u'failures', []))
+        return response
+
     def describe_task_definition(self, task_definition_arn):
         try:
-            return self.boto.describe_task_definition(
+            return self._call(
+                u'describe_task_definition',
                 taskDefinition=task_definition_arn
             )
         except ClientError:
@@ -31,17 +130,56 @@ class EcsClient(object):
             )
 
     def list_tasks(self, cluster_name, service_name):
-        return self.boto.list_tasks(
+        return self._call(
+            u'list_tasks',
             cluster=cluster_name,
             serviceName=service_name
         )
 
+    def list_task_arns(self, cluster_name, service_name):
+        pagination = {}
+        while True:
+            page = self._call(
+                u'list_tasks',
+                cluster=cluster_name,
+                serviceName=service_name,
+                **pagination
+            )
+            for task_arn in page[u'taskArns']:
+                yield task_arn
+            if not page.get(u'nextToken'):
+                return
+            pagination = dict(nextToken=page[u'nextToken'])
+
     def describe_tasks(self, cluster_name, task_arns):
-        return self.boto.describe_tasks(cluster=cluster_name, tasks=task_arns)
+        return self._call(u'describe_tasks', cluster=cluster_name, tasks=task_arns)
+
+    def list_task_definition_arns(self, family, max_results):
+        # familyPrefix also matches other families starting with the name,
+        # which are listed first in descending order, so they are skipped
+        task_definition_arns = []
+        pagination = {}
+        while len(task_definition_arns) < max_results:
+            page = self._call(
+                u'list_task_definitions',
+                familyPrefix=family,
+                status=u'ACTIVE',
+                sort=u'DESC',
+                maxResults=100,
+                **pagination
+            )
+            for task_definition_arn in page[u'taskDefinitionArns']:
+                if task_definition_arn.rsplit(u'/', 1)[-1].rsplit(u':', 1)[0] == family:
+                    task_definition_arns.append(task_definition_arn)
+            if not page.get(u'nextToken'):
+                break
+            pagination = dict(nextToken=page[u'nextToken'])
+        return task_definition_arns[:max_results]
 
     def register_task_definition(self, family, containers, volumes, role_arn,
                                  additional_properties):
-        return self.boto.register_task_definition(
+        return self._call(
+            u'register_task_definition',
             family=family,
             containerDefinitions=containers,
             volumes=volumes,
@@ -50,12 +188,14 @@ class EcsClient(object):
         )
 
     def deregister_task_definition(self, task_definition_arn):
-        return self.boto.deregister_task_definition(
+        return self._call(
+            u'deregister_task_definition',
             taskDefinition=task_definition_arn
         )
 
     def update_service(self, cluster, service, desired_count, task_definition, force_new_deployment=False):
-        return self.boto.update_service(
+        return self._call(
+            u'update_service',
             cluster=cluster,
             service=service,
             desiredCount=desired_count,
@@ -64,7 +204,8 @@ class EcsClient(object):
         )
 
     def run_task(self, cluster, task_definition, count, started_by, overrides):
-        return self.boto.run_task(
+        return self._call(
+            u'run_task',
             cluster=cluster,
             taskDefinition=task_definition,
             count=count,
@@ -73,9 +214,63 @@ class EcsClient(object):
         )
 
 
+class EcsClientPool(object):
+    """
+    Process wide cache of EcsClients, keyed by region, profile and credentials.
+
+    boto3 clients are thread safe, so all workers deploying with the same
+    configuration share one client and its warm HTTPS connection pool instead
+    of resolving credentials and loading the service model again.
+
+    rate_limiter is shared by all clients, unless it is a RegionalRateLimiter,
+    which gives the clients of every region their own rate limit.
+    """
+
+    def __init__(self, rate_limiter=None, max_pool_connections=None, metrics=None,
+                 boto_client=None, recorder=None):
+        self.rate_limiter = rate_limiter
+        self.max_pool_connections = max_pool_connections
+        self.metrics = metrics
+        self.boto_client = boto_client
+        self.recorder = recorder
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get_client(self, access_key_id=None, secret_access_key=None,
+                   region=None, profile=None):
+        key = (region, profile, access_key_id, secret_access_key)
+        # creating boto3 sessions is not thread safe
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = EcsClient(
+                    access_key_id=access_key_id,
+                    secret_access_key=secret_access_key,
+                    region=region,
+                    profile=profile,
+                    rate_limiter=self.get_rate_limiter(region),
+                    max_pool_connections=self.max_pool_connections,
+                    metrics=self.metrics,
+                    boto_client=self.boto_client,
+                    recorder=self.recorder
+                )
+                self._clients[key] = client
+        return client
+
+    def get_rate_limiter(self, region):
+        if isinstance(self.rate_limiter, RegionalRateLimiter):
+            return self.rate_limiter.get(region)
+        return self.rate_limiter
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+
 class EcsService(dict):
     def __init__(self, cluster, service_definition=None, **kwargs):
         self._cluster = cluster
+        self._older_errors = None
         super(EcsService, self).__init__(service_definition, **kwargs)
 
     def set_desired_count(self, desired_count):
@@ -114,6 +309,12 @@ class EcsService(dict):
                 return deployment.get(u'updatedAt')
         return datetime.now()
 
+    @property
+    def primary_deployment(self):
+        for deployment in self.get(u'deployments'):
+            if deployment.get(u'status') == u'PRIMARY':
+                return deployment
+
     @property
     def deployments(self):
         for deployment in self.get(u'deployments'):
@@ -128,16 +329,20 @@ class EcsService(dict):
 
     @property
     def older_errors(self):
-        return self.get_warnings(
-            since=self.deployment_created_at,
-            until=self.deployment_updated_at
-        )
+        if self._older_errors is None:
+            self._older_errors = self.get_warnings(
+                since=self.deployment_created_at,
+                until=self.deployment_updated_at
+            )
+        return self._older_errors
 
-    def get_warnings(self, since=None, until=None):
+    def get_warnings(self, since=None, until=None, events=None):
         since = since or self.deployment_created_at
-        until = until or datetime.now(tz=tzlocal())
+        if until is None:
+            from dateutil.tz import tzlocal
+            until = datetime.now(tz=tzlocal())
         errors = {}
-        for event in self.get(u'events'):
+        for event in self.get(u'events') if events is None else events:
             if u'unable' not in event[u'message']:
                 continue
             if since < event[u'createdAt'] < until:
@@ -145,7 +350,143 @@ class EcsService(dict):
         return errors
 
 
+class EcsEventCursor(object):
+    """
+    Remembers the newest service event that has been inspected.
+
+    ECS returns the events of a service newest first, so every poll only has
+    to look at the events in front of the last one seen.
+    """
+
+    def __init__(self):
+        self._event_id = None
+        self._created_at = None
+
+    def get_new_events(self, service):
+        events = []
+        for event in service.get(u'events') or []:
+            if event.get(u'id') == self._event_id:
+                break
+            if self._created_at and event[u'createdAt'] <= self._created_at:
+                break
+            events.append(event)
+        if events:
+            self._event_id = events[0].get(u'id')
+            self._created_at = events[0][u'createdAt']
+        return events
+
+    def get_warnings(self, service):
+        return service.get_warnings(events=self.get_new_events(service))
+
+
+class TaskDefinitionCache(object):
+    """
+    Cache for DescribeTaskDefinition responses.
+
+    Task definition revisions are immutable, so lookups by full ARN are cached
+    forever and, if a path is given, persisted to a local JSON file. Other
+    lookups (e.g. a family, which resolves to its latest revision) are only
+    cached in memory for family_ttl seconds, which is off by default.
+
+    The file is only read on first use, so that a broken cache file does not
+    affect commands which never describe a task definition.
+    """
+
+    def __init__(self, path=None, family_ttl=0):
+        self.path = path
+        self.family_ttl = family_ttl
+        self._payloads = {}
+        self._lookups = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    @staticmethod
+    def is_arn(task_definition):
+        return task_definition.startswith(u'arn:')
+
+    def get(self, task_definition):
+        self._ensure_loaded()
+        with self._lock:
+            payload = self._payloads.get(task_definition)
+            if payload is None and task_definition in self._lookups:
+                expires_at, arn = self._lookups[task_definition]
+                if expires_at > monotonic():
+                    payload = self._payloads.get(arn)
+        return deepcopy(payload)
+
+    def set(self, task_definition, payload):
+        self._ensure_loaded()
+        arn = payload[u'taskDefinitionArn']
+        with self._lock:
+            is_new = arn not in self._payloads
+            self._payloads[arn] = deepcopy(payload)
+            if not self.is_arn(task_definition) and self.family_ttl > 0:
+                self._lookups[task_definition] = (monotonic() + self.family_ttl, arn)
+        if is_new and self.path:
+            # the cache is an optimization, failing to persist it must not fail a deployment
+            try:
+                self.save()
+            except (IOError, OSError) as e:
+                print(u'Failed to save the task definition cache: %s' % e)
+
+    def load(self):
+        # a truncated or edited file starts an empty cache, it is replaced on the next save
+        try:
+            with open(self.path) as cache_file:
+                payloads = json.load(cache_file, object_hook=self._decode)
+            if not isinstance(payloads, dict):
+                raise ValueError(u'expected a JSON object')
+        except (ValueError, IOError, OSError) as e:
+            print(u'Ignoring the task definition cache %s: %s' % (self.path, e))
+            return
+        with self._lock:
+            self._payloads.update(payloads)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                if self.path and os.path.exists(self.path):
+                    self.load()
+                self._loaded = True
+
+    def save(self):
+        # one write at a time, every one to its own temporary file
+        with self._save_lock:
+            with self._lock:
+                data = json.dumps(self._payloads, default=self._encode)
+            cache_file = tempfile.NamedTemporaryFile(
+                u'w', dir=os.path.dirname(os.path.abspath(self.path)), suffix=u'.tmp', delete=False
+            )
+            try:
+                with cache_file:
+                    cache_file.write(data)
+                os.replace(cache_file.name, self.path)
+            except Exception:
+                os.unlink(cache_file.name)
+                raise
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, datetime):
+            return {u'__datetime__': value.isoformat()}
+        raise TypeError(repr(value))
+
+    @staticmethod
+    def _decode(value):
+        if u'__datetime__' in value:
+            from dateutil.parser import parse as parse_datetime
+            return parse_datetime(value[u'__datetime__'])
+        return value
+
+
 class EcsTaskDefinition(object):
+    # returned by DescribeTaskDefinition, but not part of the definition
+    READ_ONLY_PROPERTIES = (u'registeredAt', u'registeredBy', u'deregisteredAt')
+
     def __init__(self, containerDefinitions, volumes, family, revision,
                  status, taskDefinitionArn, requiresAttributes=None,
                  taskRoleArn=None, compatibilities=None, **kwargs):
@@ -178,6 +519,29 @@ class EcsTaskDefinition(object):
     def diff(self):
         return self._diff
 
+    @property
+    def content_hash(self):
+        containers = []
+        for container in self.containers:
+            container = dict(container)
+            if container.get(u'environment'):
+                container[u'environment'] = sorted(
+                    container[u'environment'],
+                    key=lambda env: env[u'name']
+                )
+            containers.append(container)
+        content = dict(
+            containers=containers,
+            volumes=self.volumes,
+            role_arn=self.role_arn,
+            additional_properties={
+                key: value for key, value in self.additional_properties.items()
+                if key not in self.READ_ONLY_PROPERTIES
+            }
+        )
+        serialized = json.dumps(content, sort_keys=True, default=str)
+        return sha256(serialized.encode(u'utf-8')).hexdigest()
+
     def get_overrides(self):
         override = dict()
         overrides = []
@@ -309,6 +673,35 @@ class EcsTaskDefinition(object):
             self._diff.append(diff)
 
 
+class TaskDefinitionRegistry(object):
+    """
+    Registers every distinct task definition only once.
+
+    Shared by the deploys of a deploy_many run: the first deploy registers
+    the revision for a family and content, all others with the same family
+    and content wait for it and receive a copy of the same revision.
+    """
+
+    def __init__(self):
+        self._registrations = {}
+        self._lock = threading.Lock()
+
+    def register(self, task_definition, create):
+        key = (task_definition.family, task_definition.content_hash)
+        with self._lock:
+            registration = self._registrations.get(key)
+            is_owner = registration is None
+            if is_owner:
+                registration = self._registrations[key] = Future()
+
+        if is_owner:
+            try:
+                registration.set_result(create())
+            except Exception as e:
+                registration.set_exception(e)
+        return deepcopy(registration.result())
+
+
 class EcsTaskDefinitionDiff(object):
     def __init__(self, container, field, value, old_value):
         self.container = container
@@ -349,11 +742,137 @@ class EcsTaskDefinitionDiff(object):
         return diffs
 
 
+class EcsServicePoller(object):
+    """
+    Shares DescribeServices calls between many actions of the same cluster.
+
+    Every call to get_service() registers the service for the next poll. The
+    background thread collects all registered services, describes them in
+    batches of 10 and hands the results back to the waiting callers.
+    """
+
+    def __init__(self, client, cluster_name, batch_window=0.5):
+        self._client = client
+        self._cluster_name = cluster_name
+        self._batch_window = batch_window
+        self._condition = threading.Condition()
+        self._requested = set()
+        self._results = {}
+        self._generation = 0
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join()
+
+    def get_service(self, service_name):
+        with self._condition:
+            if self._stopped:
+                raise EcsError(u'Service poller has been stopped')
+            generation = self._generation
+            self._requested.add(service_name)
+            self._condition.notify_all()
+            while self._results.get(service_name, (-1, None))[0] <= generation:
+                if self._stopped:
+                    raise EcsError(u'Service poller has been stopped')
+                self._condition.wait()
+            result = self._results[service_name][1]
+
+        if isinstance(result, Exception):
+            raise result
+        return EcsService(cluster=self._cluster_name, service_definition=result)
+
+    def poll(self):
+        with self._condition:
+            service_names = sorted(self._requested)
+            self._requested.clear()
+
+        results = {}
+        try:
+            response = self._client.describe_services_batch(
+                cluster_name=self._cluster_name,
+                service_names=service_names
+            )
+            for service_definition in response[u'services']:
+                results[service_definition[u'serviceName']] = service_definition
+        except Exception as e:
+            results = dict.fromkeys(service_names, e)
+
+        with self._condition:
+            self._generation += 1
+            for service_name in service_names:
+                result = results.get(service_name, IndexError(service_name))
+                self._results[service_name] = (self._generation, result)
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._requested and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+            # give concurrently polling actions the chance to join this batch
+            sleep(self._batch_window)
+            self.poll()
+
+
+class PollingPolicy(object):
+    """
+    Interval between two polls of a deployment.
+
+    Polls quickly right after the service has been updated, backs off
+    exponentially while the deployments do not change and starts polling
+    quickly again as soon as the task counts move.
+    """
+
+    def __init__(self, min_interval=2, max_interval=30, backoff=2):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self._interval = min_interval
+        self._state = None
+
+    def next_interval(self, service):
+        state = self.get_state(service)
+        if state != self._state:
+            self._interval = self.min_interval
+        else:
+            self._interval = min(self.max_interval, self._interval * self.backoff)
+        self._state = state
+        return self._interval
+
+    @staticmethod
+    def get_state(service):
+        return tuple(
+            (
+                deployment.get(u'id'),
+                deployment.get(u'runningCount'),
+                deployment.get(u'pendingCount'),
+                deployment.get(u'desiredCount'),
+            )
+            for deployment in service.get(u'deployments') or []
+        )
+
+
 class EcsAction(object):
-    def __init__(self, client, cluster_name, service_name):
+    def __init__(self, client, cluster_name, service_name, poller=None,
+                 task_definition_cache=None):
         self._client = client
         self._cluster_name = cluster_name
         self._service_name = service_name
+        self._poller = poller
+        self._task_definition_cache = task_definition_cache
 
         try:
             if service_name:
@@ -372,6 +891,8 @@ class EcsAction(object):
             )
 
     def get_service(self):
+        if self._poller:
+            return self._poller.get_service(self._service_name)
         services_definition = self._client.describe_services(
             cluster_name=self._cluster_name,
             service_name=self._service_name
@@ -385,13 +906,16 @@ class EcsAction(object):
         return self.get_task_definition(service.task_definition)
 
     def get_task_definition(self, task_definition):
-        task_definition_payload = self._client.describe_task_definition(
-            task_definition_arn=task_definition
-        )
-
-        task_definition = EcsTaskDefinition(
-            **task_definition_payload[u'taskDefinition']
-        )
+        cache = self._task_definition_cache
+        payload = cache.get(task_definition) if cache else None
+        if payload is None:
+            payload = self._client.describe_task_definition(
+                task_definition_arn=task_definition
+            )[u'taskDefinition']
+            if cache:
+                cache.set(task_definition, payload)
+
+        task_definition = EcsTaskDefinition(**payload)
         return task_definition
 
     def update_task_definition(self, task_definition):
@@ -402,9 +926,30 @@ class EcsAction(object):
             role_arn=task_definition.role_arn,
             additional_properties=task_definition.additional_properties
         )
+        if self._task_definition_cache:
+            self._task_definition_cache.set(
+                response[u'taskDefinition'][u'taskDefinitionArn'],
+                response[u'taskDefinition']
+            )
         new_task_definition = EcsTaskDefinition(**response[u'taskDefinition'])
         return new_task_definition
 
+    def find_task_definition(self, task_definition, depth=5):
+        """
+        Returns the newest of the last `depth` active revisions of the family,
+        which has the same content as the given task definition, or None.
+        """
+        content_hash = task_definition.content_hash
+        task_definition_arns = self._client.list_task_definition_arns(
+            family=task_definition.family,
+            max_results=depth
+        )
+        for task_definition_arn in task_definition_arns:
+            revision = self.get_task_definition(task_definition_arn)
+            if revision.content_hash == content_hash:
+                return revision
+        return None
+
     def deregister_task_definition(self, task_definition):
         self._client.deregister_task_definition(task_definition.arn)
 
@@ -418,34 +963,74 @@ class EcsAction(object):
         )
         return EcsService(self._cluster_name, response[u'service'])
 
-    def is_deployed(self, service):
+    def is_deployed(self, service, strict=False):
+        """
+        Checks whether the service has converged to its PRIMARY deployment.
+
+        By default only the deployment counters returned by DescribeServices
+        are used, so no additional API call is made. In strict mode the
+        RUNNING tasks of the current task definition are counted instead.
+        """
         if len(service[u'deployments']) != 1:
             return False
-        running_tasks = self._client.list_tasks(
+        if strict:
+            return self.is_deployed_by_tasks(service)
+        return self.is_deployed_by_counters(service)
+
+    @staticmethod
+    def is_deployed_by_counters(service):
+        primary = service.primary_deployment
+        if not primary or primary.get(u'rolloutState') == u'FAILED':
+            return False
+        return primary.get(u'runningCount') == service.desired_count and \
+            not primary.get(u'pendingCount')
+
+    def is_deployed_by_tasks(self, service):
+        task_arns = self._client.list_task_arns(
             cluster_name=service.cluster,
             service_name=service.name
         )
-        if not running_tasks[u'taskArns']:
-            return service.desired_count == 0
         running_count = self.get_running_tasks_count(
             service=service,
-            task_arns=running_tasks[u'taskArns']
+            task_arns=task_arns
         )
         return service.desired_count == running_count
 
     def get_running_tasks_count(self, service, task_arns):
+        return self.count_running_tasks(service, self.describe_tasks(task_arns))
+
+    @staticmethod
+    def count_running_tasks(service, tasks):
         running_count = 0
-        tasks_details = self._client.describe_tasks(
-            cluster_name=self._cluster_name,
-            task_arns=task_arns
-        )
-        for task in tasks_details[u'tasks']:
+        for task in tasks:
             arn = task[u'taskDefinitionArn']
             status = task[u'lastStatus']
             if arn == service.task_definition and status == u'RUNNING':
                 running_count += 1
         return running_count
 
+    def describe_tasks(self, task_arns):
+        """
+        Describes the given tasks in chunks of 100 on a small thread pool.
+
+        task_arns may be any iterable (e.g. the list_task_arns paginator), the
+        tasks are yielded as the chunks are described.
+        """
+        with ThreadPoolExecutor(max_workers=DESCRIBE_TASKS_WORKERS) as executor:
+            pending = deque()
+            for chunk in chunked(task_arns, DESCRIBE_TASKS_BATCH_SIZE):
+                pending.append(executor.submit(
+                    self._client.describe_tasks,
+                    cluster_name=self._cluster_name,
+                    task_arns=chunk
+                ))
+                if len(pending) >= DESCRIBE_TASKS_WORKERS:
+                    for task in pending.popleft().result()[u'tasks']:
+                        yield task
+            while pending:
+                for task in pending.popleft().result()[u'tasks']:
+                    yield task
+
     @property
     def client(self):
         return self._client
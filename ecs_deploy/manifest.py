@@ -0,0 +1,230 @@
+"""
+Deploy manifests, which describe the changes to many services at once.
+
+A manifest is a YAML (requires PyYAML) or JSON file::
+
+    region: eu-central-1
+    clusters:
+      my-cluster:
+        tag: 1.2.3                  # settings for all services of the cluster
+        services:
+          my-app:
+            images:
+              webserver: nginx:1.19
+            env:
+              webserver:
+                DEBUG: "false"
+            commands:
+              webserver: nginx -g 'daemon off;'
+            role: arn:aws:iam::123456789012:role/my-app
+          my-worker: {}
+
+Every service supports tag, images, env, commands, role and task (a task
+definition ARN or family:revision to deploy instead of the current one).
+Settings of a cluster apply to all its services, images, env and commands
+are merged per container and env per variable.
+"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+from ecs_deploy.ecs import DeployAction, EcsServicePoller, EcsError
+
+SERVICE_SETTINGS = (u'tag', u'images', u'env', u'commands', u'role', u'task')
+# settings by container, a service overrides the containers it names
+CONTAINER_SETTINGS = (u'images', u'env', u'commands')
+MANIFEST_SETTINGS = (u'region', u'profile', u'clusters')
+
+
+class ManifestError(EcsError):
+    pass
+
+
+class ManifestService(object):
+    def __init__(self, cluster, service, tag=None, images=None, env=None,
+                 commands=None, role=None, task=None):
+        self.cluster = cluster
+        self.service = service
+        self.tag = tag
+        self.images = images or {}
+        self.env = env or {}
+        self.commands = commands or {}
+        self.role = role
+        self.task = task
+
+    @property
+    def name(self):
+        return u'%s/%s' % (self.cluster, self.service)
+
+    @property
+    def environment(self):
+        return tuple(
+            (container, name, self._env_value(container, name, value))
+            for container, variables in sorted(self.env.items())
+            for name, value in sorted(variables.items())
+        )
+
+    def _env_value(self, container, name, value):
+        # YAML reads unquoted true/false as booleans, which str() would turn into True/False
+        if isinstance(value, bool):
+            return u'true' if value else u'false'
+        if isinstance(value, (dict, list)) or value is None:
+            raise ManifestError(
+                u'Environment variable %s of container %s in %s must be a string' % (name, container, self.name)
+            )
+        return str(value)
+
+    def apply_to(self, task_definition):
+        task_definition.set_images(self.tag, **self.images)
+        task_definition.set_commands(**self.commands)
+        task_definition.set_environment(self.environment)
+        task_definition.set_role_arn(self.role)
+
+
+class Manifest(object):
+    def __init__(self, services, region=None, profile=None):
+        self.services = services
+        self.region = region
+        self.profile = profile
+
+    @property
+    def clusters(self):
+        return sorted(set(service.cluster for service in self.services))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            if path.endswith((u'.yml', u'.yaml')):
+                try:
+                    import yaml
+                except ImportError:
+                    raise ManifestError(u'Reading YAML manifests requires PyYAML: pip install ecs-deploy[yaml]')
+                content = yaml.safe_load(f)
+            else:
+                content = json.load(f)
+        return cls.parse(content)
+
+    @classmethod
+    def parse(cls, content):
+        if not isinstance(content, dict) or not isinstance(content.get(u'clusters'), dict):
+            raise ManifestError(u'The manifest must contain a mapping of clusters')
+        cls._validate(u'manifest', content, MANIFEST_SETTINGS)
+
+        services = []
+        for cluster, cluster_settings in sorted(content[u'clusters'].items()):
+            if not isinstance(cluster_settings or {}, dict):
+                raise ManifestError(u'Cluster %s must be a mapping of settings' % cluster)
+            cluster_settings = dict(cluster_settings or {})
+            cluster_services = cluster_settings.pop(u'services', None)
+            if not isinstance(cluster_services, dict) or not cluster_services:
+                raise ManifestError(u'Cluster %s must contain a mapping of services' % cluster)
+            cls._validate(u'cluster %s' % cluster, cluster_settings, SERVICE_SETTINGS)
+
+            for service, service_settings in sorted(cluster_services.items()):
+                service_settings = service_settings or {}
+                if not isinstance(service_settings, dict):
+                    raise ManifestError(u'Service %s/%s must be a mapping of settings' % (cluster, service))
+                cls._validate(u'service %s/%s' % (cluster, service), service_settings, SERVICE_SETTINGS)
+                settings = cls._merge(cluster_settings, service_settings)
+                entry = ManifestService(cluster, service, **settings)
+                entry.environment  # rejects invalid environment values before planning
+                services.append(entry)
+
+        return cls(services, region=content.get(u'region'), profile=content.get(u'profile'))
+
+    @staticmethod
+    def _validate(name, settings, allowed):
+        unknown = sorted(set(settings) - set(allowed))
+        if unknown:
+            raise ManifestError(u'Unknown settings for %s: %s' % (name, u', '.join(unknown)))
+        for key in CONTAINER_SETTINGS:
+            containers = settings.get(key) or {}
+            if not isinstance(containers, dict):
+                raise ManifestError(u'%s of %s must be a mapping of containers' % (key, name))
+            if key == u'env' and not all(isinstance(v or {}, dict) for v in containers.values()):
+                raise ManifestError(u'env of %s must map every container to its variables' % name)
+
+    @staticmethod
+    def _merge(cluster_settings, service_settings):
+        settings = dict(cluster_settings, **service_settings)
+        for key in CONTAINER_SETTINGS:
+            merged = dict(cluster_settings.get(key) or {})
+            for container, value in (service_settings.get(key) or {}).items():
+                if key == u'env':
+                    value = dict(merged.get(container) or {}, **(value or {}))
+                merged[container] = value
+            settings[key] = merged
+        return settings
+
+
+class PlannedDeployment(object):
+    def __init__(self, entry, action=None, current=None, task_definition=None, error=None):
+        self.entry = entry
+        self.action = action
+        self.current = current
+        self.task_definition = task_definition
+        self.error = error
+
+    @property
+    def diff(self):
+        return self.task_definition.diff if self.modified else []
+
+    @property
+    def modified(self):
+        # setting an image or variable to its current value is listed in the diff
+        if self.error is not None:
+            return False
+        return self.task_definition.content_hash != self.current.content_hash
+
+    @property
+    def changed(self):
+        if self.error is not None:
+            return False
+        return self.modified or self.current.arn != self.action.service.task_definition
+
+
+class ManifestPlanner(object):
+    """
+    Resolves the current state of all services of a manifest concurrently.
+
+    The services of every cluster are described in batches by one poller per
+    cluster, which stays available to wait for the deployments on apply.
+    """
+
+    def __init__(self, client, workers=16, task_definition_cache=None):
+        self._client = client
+        self._workers = workers
+        self._task_definition_cache = task_definition_cache
+        self._pollers = {}
+
+    def plan(self, manifest):
+        for cluster in manifest.clusters:
+            if cluster not in self._pollers:
+                self._pollers[cluster] = EcsServicePoller(self._client, cluster).start()
+
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            return list(executor.map(self.plan_service, manifest.services))
+
+    def plan_service(self, entry):
+        try:
+            action = DeployAction(
+                self._client,
+                entry.cluster,
+                entry.service,
+                poller=self._pollers.get(entry.cluster),
+                task_definition_cache=self._task_definition_cache
+            )
+            if entry.task:
+                current = action.get_task_definition(entry.task)
+            else:
+                current = action.get_current_task_definition(action.service)
+            task_definition = deepcopy(current)
+            entry.apply_to(task_definition)
+        except EcsError as e:
+            return PlannedDeployment(entry, error=e)
+        return PlannedDeployment(entry, action, current, task_definition)
+
+    def stop(self):
+        for poller in self._pollers.values():
+            poller.stop()
+        self._pollers = {}
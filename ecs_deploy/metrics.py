@@ -0,0 +1,258 @@
+import json
+import os
+import re
+import socket
+import sys
+import threading
+from contextlib import contextmanager
+from os import getenv
+from time import monotonic
+
+
+class DeployMetrics(object):
+    """
+    Wall time of the deploy phases and ECS API calls of this process.
+
+    Phases are timed with the phase() context manager, API calls are reported
+    by the EcsClient. summary() aggregates both per name, with the number of
+    retries and throttling errors of every API operation. Every measurement
+    is also passed on to the sinks, which export it to monitoring systems.
+    """
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self._started_at = monotonic()
+        self._phases = {}
+        self._services = {}
+        self._calls = {}
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, service=None):
+        started_at = monotonic()
+        try:
+            yield
+        finally:
+            self.record_phase(name, monotonic() - started_at, service)
+
+    def record_phase(self, name, duration, service=None):
+        with self._lock:
+            self._add(self._phases.setdefault(name, self._timer()), duration)
+            if service is not None:
+                phases = self._services.setdefault(service, {})
+                phases[name] = phases.get(name, 0) + duration
+        for sink in self.sinks:
+            sink.timing(u'phase', duration, phase=name)
+
+    def record_call(self, operation, duration, retries=0, throttles=0, error=False):
+        with self._lock:
+            call = self._calls.setdefault(
+                operation,
+                dict(self._timer(), retries=0, throttles=0, errors=0)
+            )
+            self._add(call, duration)
+            call[u'retries'] += retries
+            call[u'throttles'] += throttles
+            call[u'errors'] += int(error)
+        for sink in self.sinks:
+            sink.timing(u'api_call', duration, operation=operation)
+            if retries:
+                sink.increment(u'api_retries', retries, operation=operation)
+            if throttles:
+                sink.increment(u'api_throttles', throttles, operation=operation)
+            if error:
+                sink.increment(u'api_errors', operation=operation)
+
+    def record_convergence(self, service, duration, polls):
+        self.record_phase(u'converge', duration, service)
+        for sink in self.sinks:
+            sink.timing(u'converge', duration, service=service)
+            sink.increment(u'polls', polls, service=service)
+
+    def record_failure(self, service, error):
+        error_type = type(error).__name__
+        with self._lock:
+            self._failures[error_type] = self._failures.get(error_type, 0) + 1
+        for sink in self.sinks:
+            sink.increment(u'failures', service=service, type=error_type)
+
+    def flush(self):
+        for sink in self.sinks:
+            try:
+                sink.flush()
+            except Exception as e:
+                print('Failed to export metrics: %s' % e)
+
+    def summary(self):
+        with self._lock:
+            return {
+                u'wall_time': round(monotonic() - self._started_at, 3),
+                u'phases': self._rounded(self._phases),
+                u'api_calls': self._rounded(self._calls),
+                u'failures': dict(self._failures),
+                u'services': dict(
+                    (service, dict((name, round(total, 3)) for name, total in phases.items()))
+                    for service, phases in self._services.items()
+                ),
+            }
+
+    def write(self, path):
+        """
+        Writes the summary as JSON to path, or to stderr if path is '-'.
+        """
+        summary = json.dumps(self.summary(), indent=2, sort_keys=True)
+        if path == u'-':
+            sys.stderr.write(summary + u'\n')
+        else:
+            with open(path, u'w') as f:
+                f.write(summary + u'\n')
+
+    @staticmethod
+    def _timer():
+        return {u'count': 0, u'total': 0.0, u'max': 0.0}
+
+    @staticmethod
+    def _add(timer, duration):
+        timer[u'count'] += 1
+        timer[u'total'] += duration
+        timer[u'max'] = max(timer[u'max'], duration)
+
+    @staticmethod
+    def _rounded(timers):
+        return dict(
+            (name, dict(timer, total=round(timer[u'total'], 3), max=round(timer[u'max'], 3)))
+            for name, timer in timers.items()
+        )
+
+
+class StatsdSink(object):
+    """
+    Sends every measurement as a StatsD UDP packet, e.g.
+    ecs_deploy.api_call.describe_services:12|ms
+    """
+
+    def __init__(self, host, port=8125, prefix=u'ecs_deploy'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, name, seconds, **labels):
+        self._send(name, labels, u'%d|ms' % round(seconds * 1000))
+
+    def increment(self, name, value=1, **labels):
+        self._send(name, labels, u'%d|c' % value)
+
+    def flush(self):
+        pass
+
+    def _send(self, name, labels, value):
+        path = [self.prefix, name] + [self._sanitize(labels[key]) for key in sorted(labels)]
+        try:
+            self._socket.sendto((u'%s:%s' % (u'.'.join(path), value)).encode(u'utf-8'), self.address)
+        except socket.error as e:
+            print('Failed to send metric to StatsD: %s' % e)
+
+    @staticmethod
+    def _sanitize(value):
+        return re.sub(r'[^A-Za-z0-9_-]', u'_', str(value))
+
+
+class PrometheusSink(object):
+    """
+    Aggregates the measurements as Prometheus counters and summaries and
+    exports them on flush(), to a node exporter textfile and/or a Pushgateway.
+    """
+
+    def __init__(self, textfile=None, pushgateway=None, job=u'ecs_deploy',
+                 prefix=u'ecs_deploy', timeout=5):
+        self.textfile = textfile
+        self.pushgateway = pushgateway
+        self.job = job
+        self.prefix = prefix
+        self.timeout = timeout
+        self._counters = {}
+        self._summaries = {}
+        self._lock = threading.Lock()
+
+    def timing(self, name, seconds, **labels):
+        key = (u'%s_%s_seconds' % (self.prefix, name), tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.setdefault(key, [0, 0.0])
+            summary[0] += 1
+            summary[1] += seconds
+
+    def increment(self, name, value=1, **labels):
+        key = (u'%s_%s_total' % (self.prefix, name), tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            summaries = sorted(self._summaries.items())
+
+        lines = []
+        for name, samples in self._group(counters):
+            lines.append(u'# TYPE %s counter' % name)
+            for labels, value in samples:
+                lines.append(u'%s%s %s' % (name, self._labels(labels), value))
+        for name, samples in self._group(summaries):
+            lines.append(u'# TYPE %s summary' % name)
+            for labels, (count, total) in samples:
+                lines.append(u'%s_count%s %s' % (name, self._labels(labels), count))
+                lines.append(u'%s_sum%s %s' % (name, self._labels(labels), round(total, 6)))
+        return u'\n'.join(lines) + u'\n'
+
+    def flush(self):
+        metrics = self.render()
+        if self.textfile:
+            # the node exporter must never read a partially written file
+            tmp_path = u'%s.%d.tmp' % (self.textfile, os.getpid())
+            with open(tmp_path, u'w') as f:
+                f.write(metrics)
+            os.replace(tmp_path, self.textfile)
+        if self.pushgateway:
+            import requests
+            response = requests.put(
+                u'%s/metrics/job/%s' % (self.pushgateway.rstrip(u'/'), self.job),
+                data=metrics.encode(u'utf-8'),
+                headers={u'Content-Type': u'text/plain; version=0.0.4'},
+                timeout=self.timeout
+            )
+            response.raise_for_status()
+
+    @staticmethod
+    def _group(samples):
+        grouped = []
+        for (name, labels), value in samples:
+            if not grouped or grouped[-1][0] != name:
+                grouped.append((name, []))
+            grouped[-1][1].append((labels, value))
+        return grouped
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return u''
+        return u'{%s}' % u','.join(
+            u'%s="%s"' % (key, str(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"'))
+            for key, value in labels
+        )
+
+
+def sinks_from_env():
+    """
+    Sinks configured by ECS_DEPLOY_STATSD (host:port),
+    ECS_DEPLOY_PROMETHEUS_TEXTFILE and ECS_DEPLOY_PROMETHEUS_PUSHGATEWAY.
+    """
+    sinks = []
+    statsd = getenv(u'ECS_DEPLOY_STATSD')
+    if statsd:
+        host, _, port = statsd.partition(u':')
+        sinks.append(StatsdSink(host, port or 8125))
+    textfile = getenv(u'ECS_DEPLOY_PROMETHEUS_TEXTFILE')
+    pushgateway = getenv(u'ECS_DEPLOY_PROMETHEUS_PUSHGATEWAY')
+    if textfile or pushgateway:
+        sinks.append(PrometheusSink(textfile=textfile, pushgateway=pushgateway))
+    return sinks
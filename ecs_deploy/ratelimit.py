@@ -0,0 +1,110 @@
+import threading
+from time import monotonic, sleep
+
+from botocore.exceptions import ClientError
+
+THROTTLING_ERROR_CODES = (
+    u'Throttling',
+    u'ThrottlingException',
+    u'TooManyRequestsException',
+    u'RequestLimitExceeded',
+)
+
+
+def is_throttling_error(error):
+    return isinstance(error, ClientError) and \
+        error.response.get(u'Error', {}).get(u'Code') in THROTTLING_ERROR_CODES
+
+
+class RateLimiter(object):
+    """
+    Adaptive token bucket for the ECS API calls of all workers.
+
+    Every call waits for a token before it is sent. A throttling error halves
+    the refill rate, empties the bucket and retries the call. Every successful
+    call raises the rate again, until it is back at the initial rate.
+    """
+
+    def __init__(self, rate=20.0, capacity=50, min_rate=1.0, recovery=0.1,
+                 max_retries=5):
+        self.max_rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.capacity = capacity
+        self.recovery = recovery
+        self.max_retries = max_retries
+        self._rate = self.max_rate
+        self._tokens = float(capacity)
+        self._updated_at = monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            sleep(wait)
+
+    def throttled(self, retry_after=None):
+        with self._lock:
+            self._refill()
+            if retry_after is None:
+                self._rate = max(self.min_rate, self._rate / 2)
+                self._tokens = min(self._tokens, 0)
+            else:
+                # the server told when to retry, the next call waits that long
+                self._tokens = min(self._tokens, 1 - retry_after * self._rate)
+
+    def succeeded(self):
+        with self._lock:
+            self._rate = min(self.max_rate, self._rate + self.recovery)
+
+    def call(self, method, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                response = method(**kwargs)
+            except ClientError as e:
+                if not is_throttling_error(e) or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.throttled()
+                continue
+            self.succeeded()
+            return response
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(
+            self.capacity,
+            self._tokens + (now - self._updated_at) * self._rate
+        )
+        self._updated_at = now
+
+
+class RegionalRateLimiter(object):
+    """
+    One RateLimiter per AWS region.
+
+    ECS throttles the API calls of an account per region, so deployments to
+    one region neither wait for nor slow down the calls to another region.
+    """
+
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._rate_limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, region):
+        with self._lock:
+            rate_limiter = self._rate_limiters.get(region)
+            if rate_limiter is None:
+                rate_limiter = self._rate_limiters[region] = RateLimiter(**self._kwargs)
+        return rate_limiter
@@ -0,0 +1,274 @@
+"""
+Record and replay of ECS API traffic.
+
+TrafficRecorder writes every request and response of an EcsClient, with its
+latency and time offset, as JSON lines (gzip compressed if the file name
+ends with .gz). ReplayClient serves a recording in place of the boto3 client
+without network access. For every call it returns the response that was
+current at the same (optionally scaled) point in time of the recording, so
+changes to polling or batching can be compared against real traffic.
+Throttling errors are recorded, but not replayed, they depend on the load of
+the recorded run.
+
+The batches of DescribeServices and DescribeTasks depend on the timing of the
+workers, so their responses are also indexed per service and task. A batch is
+answered with the newest recorded state of every service or task in it.
+The state of a service is replayed relative to its UpdateService call: before
+the call it is the state recorded before the update, afterwards the rollout
+progresses at the replay speed from the recorded update on.
+"""
+import atexit
+import gzip
+import json
+import threading
+from bisect import bisect_right
+from copy import deepcopy
+from datetime import datetime
+from time import monotonic, sleep
+
+from botocore.exceptions import ClientError
+
+from ecs_deploy.ratelimit import THROTTLING_ERROR_CODES
+
+FORMAT_VERSION = 1
+
+# operation: (request parameter, response field, identifying fields of an item)
+BATCHED_OPERATIONS = {
+    u'describe_services': (u'services', u'services', (u'serviceName', u'serviceArn')),
+    u'describe_tasks': (u'tasks', u'tasks', (u'taskArn',)),
+}
+
+
+class ReplayError(Exception):
+    pass
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {u'__datetime__': value.isoformat()}
+    raise TypeError(repr(value))
+
+
+def _decode(value):
+    if u'__datetime__' in value:
+        from dateutil.parser import parse as parse_datetime
+        return parse_datetime(value[u'__datetime__'])
+    return value
+
+
+def _open(path, mode):
+    if path.endswith(u'.gz'):
+        return gzip.open(path, mode + u't', encoding=u'utf-8')
+    return open(path, mode)
+
+
+def request_key(operation, params):
+    return operation, json.dumps(params, sort_keys=True, default=_encode)
+
+
+class TrafficRecorder(object):
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._started_at = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def record(self, operation, params, started_at, latency, response=None, error=None):
+        entry = {
+            u'op': operation,
+            u'params': params,
+            u'latency': round(latency, 6),
+        }
+        if error is not None:
+            entry[u'error'] = error
+        else:
+            entry[u'response'] = dict(
+                (key, value) for key, value in response.items() if key != u'ResponseMetadata'
+            )
+        with self._lock:
+            if self._file is None:
+                self._file = _open(self.path, u'w')
+                self._file.write(json.dumps({u'version': FORMAT_VERSION}) + u'\n')
+                self._started_at = started_at
+            entry[u't'] = round(started_at - self._started_at, 6)
+            self._file.write(json.dumps(entry, default=_encode, separators=(u',', u':')) + u'\n')
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class RecordingClient(object):
+    """
+    Proxy of a boto3 client, which passes every call to the recorder.
+    """
+
+    def __init__(self, client, recorder):
+        self._client = client
+        self._recorder = recorder
+
+    def __getattr__(self, operation):
+        method = getattr(self._client, operation)
+
+        def call(**params):
+            started_at = monotonic()
+            try:
+                response = method(**params)
+            except ClientError as e:
+                self._recorder.record(operation, params, started_at, monotonic() - started_at,
+                                      error=e.response)
+                raise
+            self._recorder.record(operation, params, started_at, monotonic() - started_at,
+                                  response=response)
+            return response
+
+        return call
+
+
+class ReplayClient(object):
+    """
+    Serves the responses of a recording in place of a boto3 client.
+
+    speed scales the timing of the recording: 1 replays the original
+    latencies and rollout durations, 10 replays ten times faster.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.speed = float(speed)
+        self._entries = {}
+        self._started_at = None
+        # (cluster, service): recorded and replayed time of the update
+        self._recorded_updates = {}
+        self._updates = {}
+        self._lock = threading.Lock()
+
+        with _open(path, u'r') as f:
+            header = json.loads(f.readline())
+            if header.get(u'version') != FORMAT_VERSION:
+                raise ReplayError(u'Unsupported recording format: %s' % header)
+            for line in f:
+                entry = json.loads(line, object_hook=_decode)
+                if entry.get(u'error', {}).get(u'Error', {}).get(u'Code') in THROTTLING_ERROR_CODES:
+                    continue
+                key = request_key(entry[u'op'], entry[u'params'])
+                self._entries.setdefault(key, []).append(entry)
+                if entry[u'op'] in BATCHED_OPERATIONS and u'response' in entry:
+                    self._add_items(entry, *BATCHED_OPERATIONS[entry[u'op']])
+                if entry[u'op'] == u'update_service':
+                    service = (entry[u'params'].get(u'cluster'), entry[u'params'].get(u'service'))
+                    self._recorded_updates[service] = min(
+                        entry[u't'], self._recorded_updates.get(service, entry[u't'])
+                    )
+
+        # entries are written when the calls finish, not when they started
+        for entries in self._entries.values():
+            entries.sort(key=lambda entry: entry[u't'])
+        self._offsets = dict(
+            (key, [entry[u't'] for entry in entries]) for key, entries in self._entries.items()
+        )
+
+    def __getattr__(self, operation):
+        if operation.startswith(u'_'):
+            raise AttributeError(operation)
+
+        def call(**params):
+            return self._replay(operation, params)
+
+        return call
+
+    def _add_items(self, entry, param, field, id_fields):
+        items = {}
+        for item in entry[u'response'].get(field, []):
+            for id_field in id_fields:
+                items[item.get(id_field)] = item
+        failures = entry[u'response'].get(u'failures', [])
+
+        for name in entry[u'params'].get(param, []):
+            item = items.get(name)
+            failure = None
+            if item is None:
+                failure = next((
+                    failure for failure in failures
+                    if failure.get(u'arn') == name or failure.get(u'arn', u'').endswith(u'/' + name)
+                ), None)
+                if failure is None:
+                    continue
+            key = (entry[u'op'], entry[u'params'].get(u'cluster'), name)
+            self._entries.setdefault(key, []).append({
+                u't': entry[u't'],
+                u'latency': entry[u'latency'],
+                u'item': item,
+                u'failure': failure,
+            })
+
+    def _replay(self, operation, params):
+        now = monotonic()
+        with self._lock:
+            if self._started_at is None:
+                self._started_at = now
+            if operation == u'update_service':
+                self._updates.setdefault((params.get(u'cluster'), params.get(u'service')), now)
+        elapsed = (now - self._started_at) * self.speed
+
+        if operation == u'list_tasks':
+            elapsed = self._service_time(params.get(u'cluster'), params.get(u'serviceName'), now, elapsed)
+        if operation in BATCHED_OPERATIONS:
+            response = self._replay_batch(operation, params, now, elapsed, *BATCHED_OPERATIONS[operation])
+            if response is not None:
+                return response
+
+        key = request_key(operation, params)
+        if key not in self._entries:
+            raise ReplayError(u'No recorded %s call with parameters %s' % key)
+        entry = self._newest(key, elapsed)
+
+        sleep(entry[u'latency'] / self.speed)
+        if u'error' in entry:
+            raise ClientError(entry[u'error'], entry[u'op'])
+        return deepcopy(entry[u'response'])
+
+    def _replay_batch(self, operation, params, now, elapsed, param, field, id_fields):
+        response = {field: [], u'failures': []}
+        latency = None
+        for name in params.get(param, []):
+            key = (operation, params.get(u'cluster'), name)
+            if key not in self._entries:
+                response[u'failures'].append({u'arn': name, u'reason': u'MISSING'})
+                continue
+            item_elapsed = elapsed
+            if operation == u'describe_services':
+                item_elapsed = self._service_time(params.get(u'cluster'), name, now, elapsed)
+            entry = self._newest(key, item_elapsed)
+            latency = max(latency or 0, entry[u'latency'])
+            if entry[u'item'] is not None:
+                response[field].append(entry[u'item'])
+            else:
+                response[u'failures'].append(entry[u'failure'])
+
+        # none of the items was recorded, e.g. only errors
+        if latency is None:
+            return None
+        sleep(latency / self.speed)
+        return deepcopy(response)
+
+    def _service_time(self, cluster, service, now, elapsed):
+        """
+        Returns the point of the recording to replay the state of a service at.
+        """
+        recorded_update = self._recorded_updates.get((cluster, service))
+        if recorded_update is None:
+            return elapsed
+        with self._lock:
+            update = self._updates.get((cluster, service))
+        if update is None:
+            # the newest state before the recorded update
+            return min(elapsed, recorded_update - 1e-6)
+        return recorded_update + (now - update) * self.speed
+
+    def _newest(self, key, elapsed):
+        # the newest response recorded up to this point of the recording
+        index = max(bisect_right(self._offsets[key], elapsed) - 1, 0)
+        return self._entries[key][index]
@@ -1,6 +1,12 @@
-import requests
+import atexit
+import threading
+import weakref
+from collections import OrderedDict
 from os import getenv
-from slacker import Slacker
+from queue import Queue, Full
+from time import monotonic
+
+from ecs_deploy.ratelimit import RateLimiter
 
 
 class SlackException(Exception):
@@ -11,34 +17,84 @@ class SlackDeploymentException(SlackException):
     pass
 
 
+class SlackMessage(dict):
+    '''
+        Handle of a queued Slack message. It is filled with the response body
+        (channel, ts, ...) once the sender thread has posted the message, so it
+        can be passed as chat_update for later updates right away.
+    '''
+    # last (message, attachments) queued for this message
+    rendered = None
+    # set, if the message could not be posted, its updates are dropped
+    failed = False
+
+
+# loggers with a running sender thread, their queued messages are delivered at exit
+_LOGGERS = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_loggers():
+    for logger in list(_LOGGERS):
+        logger.flush()
+
+
 class SlackWebhookLogger:
+    '''
+        Posts messages to an incoming webhook over one keep-alive session, so
+        only the first message pays for the connection and TLS handshake.
+    '''
+
+    def __init__(self, connect_timeout=3.05, read_timeout=10, retries=3, backoff_factor=0.5):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
 
-    def __init__(self):
         self.slack_webhook_endpoint = getenv('SLACK_WEBHOOK_ENDPOINT')
+        self.timeout = (connect_timeout, read_timeout)
+        # a read timeout is not retried, the message might have been posted
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(['POST']),
+            raise_on_status=False
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(max_retries=retry))
+        self.session.mount('http://', HTTPAdapter(max_retries=retry))
 
     def post_to_slack(self, message, attachments):
-        from urllib import request, parse
-        import json
+        import requests
 
         post = {"text": "{0}".format(message)}
+        if attachments:
+            post["attachments"] = attachments
 
         try:
-            json_data = json.dumps(post)
-            req = request.Request(self.slack_webhook_endpoint,
-                                  data=json_data.encode('ascii'),
-                                  headers={'Content-Type': 'application/json'})
-            resp = request.urlopen(req)
+            resp = self.session.post(self.slack_webhook_endpoint, json=post, timeout=self.timeout)
+            resp.raise_for_status()
             print("Post to slack webhook response: " + str(resp))
+        except requests.HTTPError as em:
+            if em.response is not None and em.response.status_code == 429:
+                # the sender thread slows down and retries
+                raise
+            print("EXCEPTION: " + str(em))
         except Exception as em:
             print("EXCEPTION: " + str(em))
 
 
 class SlackLogger(object):
 
-    def __init__(self):
+    def __init__(self, queue_size=1000, messages_per_second=1, progress_interval=60):
         self.muted = getenv('SLACK_MUTED', False)
         if getenv('SLACK_TOKEN', None) is not None:
             print('Initializing Slack Token based client')
+            # slacker and requests are only loaded, if Slack is configured
+            from slacker import Slacker
             self.slack = Slacker(getenv('SLACK_TOKEN'))
             self.slack_webhook_endpoint = None
         elif getenv('SLACK_WEBHOOK_ENDPOINT', None) is not None:
@@ -52,6 +108,21 @@ class SlackLogger(object):
 
         self.channel = getenv('SLACK_CHANNEL', "test")
 
+        self._queue = Queue(maxsize=queue_size)
+        self._sender = None
+        self._sender_lock = threading.Lock()
+        # Slack allows about one message per second and channel
+        self.messages_per_second = messages_per_second
+        self._channel_limiters = {}
+        self._pending_updates = {}
+        self._pending_lock = threading.Lock()
+        # webhooks can not update messages, progress is posted as periodic summaries
+        self.progress_interval = float(getenv('SLACK_WEBHOOK_PROGRESS_INTERVAL', progress_interval))
+        self._progress = OrderedDict()
+        self._progress_changed = False
+        self._progress_posted_at = None
+        self._progress_lock = threading.Lock()
+
     def progress_bar(self, running, pending, desired):
         progress = round(float(running) * 100 / float(desired) / 5)
         pending = round(float(pending) * 100 / float(desired) / 5)
@@ -59,28 +130,165 @@ class SlackLogger(object):
 
     def post_to_slack(self, message, attachments, chat_update=None):
         '''
-            If chat_update is a chat object, this function will update that object
-            with the new text. Callers interested in updating chats can save the 
-            return value and send it in chat_update the next time.
+            Queues the message for the sender thread and returns immediately.
+            If chat_update is a chat object, the sender will update that object
+            with the new text. Callers interested in updating chats can save the
+            returned SlackMessage and send it in chat_update the next time.
         '''
         if self.muted:
             return
+        if self.slack is None and self.slack_webhook_endpoint is None:
+            raise Exception('SLACK_TOKEN (or) SLACK_WEBHOOK_ENDPOINT should to be specified!')
+
+        rendered = (message, attachments)
+        if chat_update is not None:
+            with self._pending_lock:
+                if chat_update.rendered == rendered:
+                    return chat_update
+                chat_update.rendered = rendered
+                # a queued update of this message just sends the newest state
+                is_queued = id(chat_update) in self._pending_updates
+                self._pending_updates[id(chat_update)] = rendered
+            if not is_queued:
+                self._enqueue((None, None, chat_update, chat_update))
+            return chat_update
+
+        slack_message = SlackMessage()
+        slack_message.rendered = rendered
+        self._enqueue((message, attachments, None, slack_message))
+        return slack_message
+
+    def _enqueue(self, item):
+        self._start_sender()
+        try:
+            self._queue.put_nowait(item)
+        except Full:
+            print('Slack delivery queue is full, dropping message: %s' % (item[0] or item[3].rendered[0]))
+            if item[2] is not None:
+                with self._pending_lock:
+                    self._pending_updates.pop(id(item[2]), None)
+            else:
+                item[3].failed = True
+
+    def send_to_slack(self, message, attachments, chat_update=None):
         if self.slack is not None:
             if chat_update is not None:
                 res = self.slack.chat.update(chat_update['channel'], text=message, attachments=attachments, as_user=True, ts=chat_update['ts'])
             else:
                 res = self.slack.chat.post_message(self.channel, text=message, attachments=attachments, as_user=True)
-            return res.body 
+            return res.body
         elif self.slack_webhook_endpoint is not None:
             self.slack_webhook_endpoint.post_to_slack(message, attachments)
+
+    def flush(self, timeout=30):
+        '''
+            Waits up to timeout seconds until all queued messages have been
+            delivered. Returns False if messages are still pending.
+        '''
+        deadline = monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _start_sender(self):
+        with self._sender_lock:
+            if self._sender is None:
+                self._sender = threading.Thread(target=self._send_queued_messages)
+                self._sender.daemon = True
+                self._sender.start()
+                _LOGGERS.add(self)
+
+    def _send_queued_messages(self):
+        while True:
+            item = self._queue.get()
+            try:
+                self._send_queued_message(*item)
+            except Exception as e:
+                if self._is_rate_limited(e):
+                    self._get_channel_limiter(item[2]).throttled(self._retry_after(e))
+                    self._requeue(*item)
+                else:
+                    print('Failed to post to Slack: %s' % e)
+                    if item[2] is None:
+                        item[3].failed = True
+            finally:
+                self._queue.task_done()
+
+    def _send_queued_message(self, message, attachments, chat_update, slack_message):
+        if chat_update is not None and 'ts' not in chat_update and self.slack is not None:
+            if chat_update.failed:
+                with self._pending_lock:
+                    self._pending_updates.pop(id(chat_update), None)
+            else:
+                # the message to update is queued again after a rate limit, it is posted before this update
+                self._requeue(message, attachments, chat_update, slack_message)
+            return
+
+        self._get_channel_limiter(chat_update).acquire()
+
+        if chat_update is not None:
+            # merge all updates queued while waiting into the newest one
+            with self._pending_lock:
+                message, attachments = self._pending_updates.pop(id(chat_update), (None, None))
+            if message is None and attachments is None:
+                return
+
+        body = self.send_to_slack(message, attachments, chat_update)
+        self._get_channel_limiter(chat_update).succeeded()
+        if chat_update is None and body:
+            slack_message.update(body)
+        if chat_update is None and self.slack is not None and 'ts' not in slack_message:
+            slack_message.failed = True
+
+    def _requeue(self, message, attachments, chat_update, slack_message):
+        if chat_update is not None:
+            with self._pending_lock:
+                self._pending_updates.setdefault(id(chat_update), chat_update.rendered)
+        self._enqueue((message, attachments, chat_update, slack_message))
+
+    def _get_channel_limiter(self, chat_update):
+        if self.slack is None:
+            channel = 'webhook'
+        elif chat_update is not None:
+            channel = chat_update['channel']
         else:
-            raise Exception('SLACK_TOKEN (or) SLACK_WEBHOOK_ENDPOINT should to be specified!')
+            channel = self.channel
+        with self._pending_lock:
+            if channel not in self._channel_limiters:
+                self._channel_limiters[channel] = RateLimiter(
+                    rate=self.messages_per_second,
+                    capacity=1,
+                    min_rate=self.messages_per_second / 10.0,
+                    recovery=self.messages_per_second / 10.0
+                )
+            return self._channel_limiters[channel]
+
+    @staticmethod
+    def _is_rate_limited(error):
+        import requests
+
+        response = getattr(error, 'response', None)
+        return isinstance(error, requests.HTTPError) and \
+            response is not None and response.status_code == 429
+
+    @staticmethod
+    def _retry_after(error):
+        # seconds to wait according to Slack, None if not given
+        try:
+            return float(error.response.headers['Retry-After'])
+        except (KeyError, TypeError, ValueError):
+            return None
 
     def service_url(self, cluster, service):
         return "https://us-west-2.console.aws.amazon.com/ecs/home?region=us-west-2#/clusters/%s/services/%s/deployments" % (cluster, service)
 
-    def cluster_url(self, cluster):
-        return "https://us-west-2.console.aws.amazon.com/ecs/home?region=us-west-2#/clusters/%s" % cluster
+    def cluster_url(self, cluster, region=None):
+        region = region or "us-west-2"
+        return "https://%s.console.aws.amazon.com/ecs/home?region=%s#/clusters/%s" % (region, region, cluster)
 
     def get_deploy_start_payload(self, service, task_definition):
         #import pdb;pdb.set_trace()
@@ -145,12 +353,192 @@ class SlackLogger(object):
             print('Desired Count of this service is Zero! Skipping Progress Bar Message Generation!')
             return
 
-        message, attachments = self.get_deploy_progress_payload(service, task_definition)
         if self.slack is not None:
+            message, attachments = self.get_deploy_progress_payload(service, task_definition)
             return self.post_to_slack(message, attachments, chat_update)
-        else:
-            print('Posting Deploy Progress to Slack Channel in Webhook Mode - Yet to be implemented! Waiting for Deploy to Complete!')
+        elif self.slack_webhook_endpoint is not None:
+            self.update_webhook_progress(service, (primary['runningCount'], primary['pendingCount'], des))
 
     def log_deploy_finish(self, service, task_definition):
+        if self.slack is None:
+            with self._progress_lock:
+                self._progress.pop((service.cluster, service.name), None)
         message, attachments = self.get_deploy_finish_payload(service, task_definition)
         self.post_to_slack(message, attachments)
+
+    def update_webhook_progress(self, service, counts):
+        '''
+            Records the progress of a service and posts a summary of all
+            services in progress, at most once per progress_interval and only
+            if any of them changed since the last summary.
+        '''
+        now = monotonic()
+        with self._progress_lock:
+            key = (service.cluster, service.name)
+            if self._progress.get(key) != counts:
+                self._progress[key] = counts
+                self._progress_changed = True
+            if self._progress_posted_at is None:
+                self._progress_posted_at = now
+            if not self._progress_changed or now - self._progress_posted_at < self.progress_interval:
+                return
+            self._progress_changed = False
+            self._progress_posted_at = now
+            progress = list(self._progress.items())
+        self.post_to_slack(*self.get_webhook_progress_payload(progress))
+
+    def get_webhook_progress_payload(self, progress):
+        width = max(len(name) for (_, name), _ in progress)
+        rows = []
+        for (cluster, name), (run, pend, des) in progress:
+            rows.append('%s %s %3s/%-3s' % (name.ljust(width), self.progress_bar(run, pend, des), run, des))
+        message = 'Deploy progress: %d services in progress' % len(progress)
+        return message, [{'text': '```\n%s\n```' % '\n'.join(rows), 'mrkdwn_in': ['text']}]
+
+
+class SlackDashboard(object):
+    '''
+        Aggregated Slack message of a deploy_many run. Deployments report to the
+        dashboard instead of posting their own messages. A single message shows
+        the progress of all services and is updated in place from a snapshot
+        every update_interval seconds, so the number of Slack API calls depends
+        on the duration of the run, not on the number of services.
+    '''
+
+    QUEUED = 'queued'
+    DEPLOYING = 'deploying'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+
+    def __init__(self, logger, clusters, services, update_interval=5):
+        '''
+            clusters are the (region, cluster) of the deployments, services
+            the names of the rows, e.g. region/cluster/service.
+        '''
+        self.logger = logger
+        self.clusters = clusters
+        self.update_interval = update_interval
+        self._states = OrderedDict(
+            (service, {'status': self.QUEUED, 'running': 0, 'pending': 0, 'desired': 0})
+            for service in services
+        )
+        self._lock = threading.Lock()
+        self._message = None
+        self._stopped = threading.Event()
+        self._refresher = None
+
+    @property
+    def supports_updates(self):
+        # webhooks can not update a message, they only get the final one
+        return self.logger.slack is not None
+
+    def start(self):
+        if self.supports_updates:
+            self._message = self.logger.post_to_slack(*self.render())
+            self._refresher = threading.Thread(target=self._refresh)
+            self._refresher.daemon = True
+            self._refresher.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._refresher is not None:
+            self._refresher.join()
+        if self.logger.slack is None and self.logger.slack_webhook_endpoint is None:
+            return
+        if self._message is not None:
+            self.logger.post_to_slack(*self.render(), chat_update=self._message)
+        else:
+            self.logger.post_to_slack(*self.render())
+
+    def _refresh(self):
+        while not self._stopped.wait(self.update_interval):
+            if self._message is not None:
+                self.logger.post_to_slack(*self.render(), chat_update=self._message)
+
+    def set_state(self, service_name, status, service=None):
+        with self._lock:
+            state = self._states.setdefault(service_name, {'running': 0, 'pending': 0, 'desired': 0})
+            state['status'] = status
+            primary = service.primary_deployment if service is not None else None
+            if primary:
+                state['running'] = primary['runningCount']
+                state['pending'] = primary['pendingCount']
+                state['desired'] = primary['desiredCount']
+
+    def log_deploy_start(self, service, task_definition):
+        self.set_state(service.name, self.DEPLOYING, service)
+
+    def log_deploy_progress(self, service, task_definition, chat_update):
+        self.set_state(service.name, self.DEPLOYING, service)
+
+    def log_deploy_finish(self, service, task_definition):
+        self.set_state(service.name, self.FINISHED, service)
+
+    def log_deploy_failure(self, service_name):
+        self.set_state(service_name, self.FAILED)
+
+    def row(self, name):
+        return SlackDashboardRow(self, name)
+
+    def snapshot(self):
+        with self._lock:
+            return [(name, dict(state)) for name, state in self._states.items()]
+
+    def render(self):
+        snapshot = self.snapshot()
+        counts = dict((status, 0) for status in (self.QUEUED, self.DEPLOYING, self.FINISHED, self.FAILED))
+        for _, state in snapshot:
+            counts[state['status']] += 1
+
+        width = max([len(name) for name, _ in snapshot] or [0])
+        rows = []
+        for name, state in snapshot:
+            if state['desired'] > 0:
+                bar = self.logger.progress_bar(state['running'], state['pending'], state['desired'])
+            else:
+                bar = 20 * chr(9617)
+            rows.append('%s %s %3s/%-3s %s' % (
+                name.ljust(width), bar, state['running'], state['desired'], state['status']
+            ))
+
+        cluster_links = ', '.join(
+            '<%s|%s>' % (self.logger.cluster_url(cluster, region), '%s/%s' % (region, cluster) if region else cluster)
+            for region, cluster in self.clusters
+        )
+        message = 'Deploying %d services to %s: %d finished, %d failed, %d deploying, %d queued' % (
+            len(snapshot), cluster_links, counts[self.FINISHED], counts[self.FAILED],
+            counts[self.DEPLOYING], counts[self.QUEUED]
+        )
+        if counts[self.FAILED]:
+            color = '#D00000'
+        elif counts[self.FINISHED] == len(snapshot):
+            color = '#7CD197'
+        else:
+            color = '#439FE0'
+        attachments = [{'color': color, 'text': '```\n%s\n```' % '\n'.join(rows), 'mrkdwn_in': ['text']}]
+        return message, attachments
+
+
+class SlackDashboardRow(object):
+    '''
+        Reports the deployment of one service to its row of a dashboard, which
+        is not necessarily named like the service, e.g. if the same service is
+        deployed to several regions.
+    '''
+
+    def __init__(self, dashboard, name):
+        self.dashboard = dashboard
+        self.name = name
+
+    def log_deploy_start(self, service, task_definition):
+        self.dashboard.set_state(self.name, SlackDashboard.DEPLOYING, service)
+
+    def log_deploy_progress(self, service, task_definition, chat_update):
+        self.dashboard.set_state(self.name, SlackDashboard.DEPLOYING, service)
+
+    def log_deploy_finish(self, service, task_definition):
+        self.dashboard.set_state(self.name, SlackDashboard.FINISHED, service)
+
+    def log_deploy_failure(self, service_name=None):
+        self.dashboard.set_state(self.name, SlackDashboard.FAILED)
@@ -17,11 +17,14 @@ setup(
     author_email='pypi@fabfuel.de',
     description='Simplify Amazon ECS deployments',
     long_description=__doc__,
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     include_package_data=True,
     zip_safe=False,
     platforms='any',
     install_requires=dependencies,
+    extras_require={
+        'yaml': ['PyYAML'],
+    },
     entry_points={
         'console_scripts': [
             'ecs = ecs_deploy.cli:ecs',
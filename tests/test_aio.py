@@ -0,0 +1,124 @@
+import asyncio
+from copy import deepcopy
+
+import pytest
+from mock.mock import Mock
+
+from ecs_deploy.aio import AsyncEcsClient, AsyncServicePoller, AsyncTaskDefinitionRegistry, \
+    AsyncEcsAction, AsyncDeployAction
+from ecs_deploy.ecs import EcsService, EcsTaskDefinition, EcsConnectionError
+from tests.test_ecs import EcsTestClient, CLUSTER_NAME, SERVICE_NAME, PAYLOAD_SERVICE, \
+    PAYLOAD_TASK_DEFINITION_1, PAYLOAD_TASK_DEFINITION_2, TASK_DEFINITION_ARN_1, TASK_DEFINITION_ARN_2
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def client():
+    client = AsyncEcsClient(EcsTestClient(u'access_key', u'secret_key'), max_in_flight=2)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def task_definition():
+    return EcsTaskDefinition(**deepcopy(PAYLOAD_TASK_DEFINITION_1))
+
+
+def test_client_runs_calls_on_executor(client):
+    response = run(client.describe_services(CLUSTER_NAME, SERVICE_NAME))
+    assert response[u'services'][0][u'serviceName'] == SERVICE_NAME
+
+
+def test_service_poller_batches_requests():
+    client = Mock()
+
+    async def describe_services_batch(cluster_name, service_names):
+        return {u'services': [dict(PAYLOAD_SERVICE, serviceName=name) for name in service_names]}
+
+    client.describe_services_batch.side_effect = describe_services_batch
+    poller = AsyncServicePoller(client, CLUSTER_NAME, batch_window=0)
+
+    async def get_services():
+        return await asyncio.gather(
+            poller.get_service(u'service-a'),
+            poller.get_service(u'service-b'),
+            poller.get_service(u'service-a'),
+        )
+
+    services = run(get_services())
+
+    assert [service.name for service in services] == [u'service-a', u'service-b', u'service-a']
+    assert all(isinstance(service, EcsService) for service in services)
+    client.describe_services_batch.assert_called_once_with(
+        cluster_name=CLUSTER_NAME,
+        service_names=[u'service-a', u'service-b']
+    )
+
+
+def test_service_poller_unknown_service(client):
+    poller = AsyncServicePoller(client, CLUSTER_NAME, batch_window=0)
+    action = AsyncEcsAction(client, CLUSTER_NAME, u'invalid-service', poller=poller)
+
+    with pytest.raises(EcsConnectionError) as excinfo:
+        run(action.load())
+    assert str(excinfo.value) == u'An error occurred when calling the DescribeServices operation: Service not found.'
+
+
+def test_registry_registers_once(task_definition):
+    registry = AsyncTaskDefinitionRegistry()
+    calls = []
+
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0)
+        return EcsTaskDefinition(**deepcopy(PAYLOAD_TASK_DEFINITION_2))
+
+    async def register_all():
+        return await asyncio.gather(*[
+            registry.register(deepcopy(task_definition), create) for _ in range(5)
+        ])
+
+    results = run(register_all())
+
+    assert len(calls) == 1
+    assert [result.arn for result in results] == [TASK_DEFINITION_ARN_2] * 5
+    assert len(set(id(result) for result in results)) == 5
+
+
+def test_action_get_task_definition(client):
+    action = run(AsyncEcsAction(client, CLUSTER_NAME, SERVICE_NAME).load())
+    task_definition = run(action.get_current_task_definition(action.service))
+    assert task_definition.arn == TASK_DEFINITION_ARN_1
+
+
+def test_action_is_deployed(client):
+    action = run(AsyncEcsAction(client, CLUSTER_NAME, SERVICE_NAME).load())
+    assert run(action.is_deployed(action.service)) is True
+    assert run(action.is_deployed(action.service, strict=True)) is True
+
+
+def test_deploy_action(task_definition):
+    test_client = EcsTestClient(u'access_key', u'secret_key')
+    test_client.update_service = Mock(return_value={u'service': deepcopy(PAYLOAD_SERVICE)})
+    client = AsyncEcsClient(test_client)
+    action = run(AsyncDeployAction(client, CLUSTER_NAME, SERVICE_NAME).load())
+    new_task_definition = EcsTaskDefinition(**deepcopy(PAYLOAD_TASK_DEFINITION_2))
+
+    updated_service = run(action.deploy(new_task_definition))
+    client.close()
+
+    assert isinstance(updated_service, EcsService)
+    test_client.update_service.assert_called_once_with(
+        cluster=CLUSTER_NAME,
+        service=SERVICE_NAME,
+        desired_count=action.service.desired_count,
+        task_definition=TASK_DEFINITION_ARN_2,
+        force_new_deployment=False
+    )
@@ -0,0 +1,81 @@
+from time import sleep
+from unittest.mock import patch
+
+import pytest
+from botocore.exceptions import ClientError
+
+from benchmarks.fake_ecs import FakeEcsBackend
+from ecs_deploy import cli
+from ecs_deploy.ecs import DeployAction, ScaleAction
+
+
+def test_fake_backend_rollout():
+    backend = FakeEcsBackend(services=1, desired_count=2, rollout_seconds=0.1)
+    action = DeployAction(backend.client(), backend.cluster, backend.service_names[0])
+    task_definition = action.get_current_task_definition(action.service)
+    task_definition.set_images(u'2')
+    new_task_definition = action.update_task_definition(task_definition)
+
+    action.deploy(new_task_definition)
+    service = action.get_service()
+    assert len(service[u'deployments']) == 2
+    assert not action.is_deployed(service)
+
+    sleep(0.15)
+    service = action.get_service()
+    assert service.task_definition == new_task_definition.arn
+    assert action.is_deployed(service)
+    assert action.is_deployed(service, strict=True)
+    assert service[u'events'][0][u'message'].endswith(u'has reached a steady state.')
+
+
+def test_fake_backend_scale():
+    backend = FakeEcsBackend(services=1, desired_count=2, rollout_seconds=0)
+    action = ScaleAction(backend.client(), backend.cluster, backend.service_names[0])
+
+    action.scale(5)
+
+    assert action.is_deployed(action.get_service(), strict=True)
+
+
+def test_fake_backend_throttles():
+    backend = FakeEcsBackend(services=1, rate=0.001, burst=2)
+    client = backend.client()
+    client.describe_services(backend.cluster, backend.service_names[0])
+    client.describe_services(backend.cluster, backend.service_names[0])
+
+    with pytest.raises(ClientError) as excinfo:
+        client.describe_services(backend.cluster, backend.service_names[0])
+    assert excinfo.value.response[u'Error'][u'Code'] == u'ThrottlingException'
+    assert backend.throttles[u'DescribeServices'] == 1
+
+
+@pytest.fixture
+def benchmarks(monkeypatch):
+    # benchmarks.run mutes Slack on import, the variable must not outlive the test
+    monkeypatch.setenv(u'SLACK_MUTED', u'1')
+    from benchmarks import run
+    return run
+
+
+def test_benchmarks_run(benchmarks):
+    with patch.object(cli, u'SLACK_LOGGER', None):
+        results = benchmarks.run(sizes=[3], rollout_seconds=0, rate=1000, burst=1000, latency=0,
+                                 engine=u'threads', worker_count=2)
+
+    assert [result[u'scenario'] for result in results] == [u'deploy', u'scale', u'deploy_many-3']
+    assert [result[u'services'] for result in results] == [1, 1, 3]
+    assert all(result[u'api_calls'] > 0 and result[u'throttles'] == 0 for result in results)
+
+
+def test_benchmarks_compare(benchmarks):
+    baseline = [{u'scenario': u'deploy_many-10', u'api_calls_per_service': 10, u'peak_threads': 20, u'wall_time': 1}]
+    results = [
+        {u'scenario': u'deploy_many-10', u'api_calls_per_service': 13, u'peak_threads': 22, u'wall_time': 5},
+        {u'scenario': u'deploy_many-100', u'api_calls_per_service': 50, u'peak_threads': 100, u'wall_time': 5},
+    ]
+
+    assert benchmarks.compare(results, baseline, tolerance=0.2) == [u'deploy_many-10: api_calls_per_service 13 > 10']
+    assert benchmarks.compare(results, baseline, tolerance=0.5) == []
+    assert benchmarks.compare(results, baseline, tolerance=0.5, checked=(u'wall_time',)) == \
+        [u'deploy_many-10: wall_time 5 > 1']
@@ -18,9 +18,15 @@ def runner():
 @patch.object(EcsClient, '__init__')
 def test_get_client(ecs_client):
     ecs_client.return_value = None
+    cli.CLIENT_POOL.clear()
     client = get_client('access_key_id', 'secret_access_key', 'region', 'profile')
-    ecs_client.assert_called_once_with('access_key_id', 'secret_access_key', 'region', 'profile')
+    ecs_client.assert_called_once_with(access_key_id='access_key_id', secret_access_key='secret_access_key',
+                                       region='region', profile='profile', rate_limiter=cli.RATE_LIMITER.get('region'),
+                                       max_pool_connections=cli.CLIENT_POOL.max_pool_connections,
+                                       metrics=cli.METRICS, boto_client=cli.CLIENT_POOL.boto_client,
+                                       recorder=cli.CLIENT_POOL.recorder)
     assert isinstance(client, EcsClient)
+    assert get_client('access_key_id', 'secret_access_key', 'region', 'profile') is client
 
 
 def test_ecs(runner):
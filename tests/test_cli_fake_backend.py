@@ -0,0 +1,331 @@
+# Command tests against the fake ECS backend. tests/test_cli.py depends on the
+# New Relic integration, which is not part of this package.
+from time import monotonic
+
+import pytest
+from click.testing import CliRunner
+from mock.mock import Mock, patch
+
+from benchmarks.fake_ecs import FakeEcsBackend
+from ecs_deploy import cli
+from ecs_deploy.ecs import TaskPlacementError
+from ecs_deploy.slack import SlackDashboard
+
+
+def deploy_with_failed_rollout(backend, *args):
+    with patch.object(cli, 'get_client', return_value=backend.client()), \
+            patch.object(cli, 'SLACK_LOGGER', None), \
+            patch.object(cli, 'deploy_task_definition',
+                         side_effect=[TaskPlacementError('unable to place task'), None]) as deploy_task_definition:
+        result = CliRunner().invoke(
+            cli.deploy, ('--cluster', 'benchmark', '--service', 'service-0000', '--rollback') + args
+        )
+    return result, deploy_task_definition.call_args_list[1][1]
+
+
+def test_deploy_rollback_deregisters_registered_revision(monkeypatch):
+    monkeypatch.setenv('SLACK_MUTED', '1')
+    backend = FakeEcsBackend(services=1, rollout_seconds=0)
+
+    result, rollback = deploy_with_failed_rollout(backend, '-i', 'app', 'app:2')
+
+    assert result.exit_code == 1
+    assert rollback['task_definition'].family_revision == 'family-0000:1'
+    assert rollback['previous_task_definition'].family_revision == 'family-0000:2'
+    assert rollback['deregister'] is True
+
+
+def test_deploy_rollback_keeps_reused_revision(monkeypatch):
+    monkeypatch.setenv('SLACK_MUTED', '1')
+    backend = FakeEcsBackend(services=1, rollout_seconds=0)
+    with patch.object(cli, 'get_client', return_value=backend.client()), patch.object(cli, 'SLACK_LOGGER', None):
+        result = CliRunner().invoke(cli.deploy, ('--cluster', 'benchmark', '--service', 'service-0000',
+                                                 '-i', 'app', 'app:2', '--poll-interval', '1', '1'))
+    assert result.exit_code == 0, result.output
+
+    result, rollback = deploy_with_failed_rollout(backend, '-i', 'app', 'app:1')
+
+    assert result.exit_code == 1
+    assert 'Reusing identical revision: 1' in result.output
+    assert rollback['task_definition'].family_revision == 'family-0000:2'
+    assert rollback['previous_task_definition'].family_revision == 'family-0000:1'
+    assert rollback['deregister'] is False
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_deploy_many_regions(engine, monkeypatch):
+    monkeypatch.setenv('SLACK_MUTED', '1')
+    regions = {
+        'us-east-1': FakeEcsBackend(cluster='web', services=2, rollout_seconds=0.2),
+        'eu-west-1': FakeEcsBackend(cluster='web', services=2, rollout_seconds=0.2),
+    }
+    clients = dict((region, backend.client()) for region, backend in regions.items())
+
+    def get_client(access_key_id, secret_access_key, region, profile):
+        return clients[region]
+
+    with patch.object(cli, 'get_client', get_client), patch.object(cli, 'SLACK_LOGGER', None):
+        result = CliRunner().invoke(cli.deploy_many, [
+            '--target', 'us-east-1', 'web', 'service-0000,service-0001',
+            '--target', 'eu-west-1', 'web', 'service-0001',
+            '-i', 'app', 'app:2', '--engine', engine, '--poll-interval', '1', '1',
+        ])
+
+    assert result.exit_code == 0, result.output
+    assert result.output.count('Deployment successful') == 3
+    assert regions['us-east-1'].calls['UpdateService'] == 2
+    assert regions['eu-west-1'].calls['UpdateService'] == 1
+    eu_services = regions['eu-west-1'].describe_services('web', ['service-0000', 'service-0001'])
+    assert [s['taskDefinition'][-2:] for s in eu_services['services']] == [':1', ':2']
+
+
+def test_deploy_many_dashboard_rows_per_region():
+    regions = {
+        'us-east-1': FakeEcsBackend(cluster='web', services=1, rollout_seconds=0),
+        'eu-west-1': FakeEcsBackend(cluster='web', services=1, rollout_seconds=0.5),
+    }
+    clients = dict((region, backend.client()) for region, backend in regions.items())
+    dashboards = []
+
+    class RecordingDashboard(SlackDashboard):
+        def __init__(self, *args, **kwargs):
+            super(RecordingDashboard, self).__init__(*args, **kwargs)
+            dashboards.append(self)
+
+    with patch.object(cli, 'get_client', lambda a, s, region, p: clients[region]), \
+            patch.object(cli, 'get_slack_logger', return_value=Mock(slack=None, slack_webhook_endpoint=None)), \
+            patch.object(cli, 'SlackDashboard', RecordingDashboard):
+        result = CliRunner().invoke(cli.deploy_many, [
+            '--target', 'us-east-1', 'web', 'service-0000',
+            '--target', 'eu-west-1', 'web', 'service-0000',
+            '-i', 'app', 'app:2', '--slack-dashboard', '--poll-interval', '1', '1',
+        ])
+
+    assert result.exit_code == 0, result.output
+    assert dashboards[0].clusters == [('us-east-1', 'web'), ('eu-west-1', 'web')]
+    assert [(name, state['status']) for name, state in dashboards[0].snapshot()] == [
+        ('us-east-1/web/service-0000', 'finished'),
+        ('eu-west-1/web/service-0000', 'finished'),
+    ]
+
+
+def test_deploy_many_requires_services():
+    result = CliRunner().invoke(cli.deploy_many, ['--cluster', 'web'])
+
+    assert result.exit_code == 2
+    assert '--cluster and --services must be given together' in result.output
+
+
+def test_get_waves():
+    targets = [(None, 'web', 'service-%d' % i) for i in range(10)]
+
+    assert cli.get_waves(targets) == [targets]
+    assert cli.get_waves(targets, canary=1) == [targets[:1], targets[1:]]
+    assert cli.get_waves(targets, canary=1, wave_size=(4, False)) == \
+        [targets[:1], targets[1:5], targets[5:9], targets[9:]]
+    assert cli.get_waves(targets, wave_size=(25, True)) == \
+        [targets[:3], targets[3:6], targets[6:9], targets[9:]]
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_deploy_many_waves_stop_on_failure(engine, monkeypatch):
+    monkeypatch.setenv('SLACK_MUTED', '1')
+    backend = FakeEcsBackend(cluster='web', services=3, rollout_seconds=0)
+
+    with patch.object(cli, 'get_client', return_value=backend.client()), \
+            patch.object(cli, 'SLACK_LOGGER', None):
+        result = CliRunner().invoke(cli.deploy_many, [
+            '--cluster', 'web', '--services', 'service-0000,missing,service-0001,service-0002',
+            '--canary', '1', '--wave-size', '50%', '-i', 'app', 'app:2',
+            '--engine', engine, '--poll-interval', '1', '1',
+        ])
+
+    assert result.exit_code == 1
+    assert 'Deploying wave 2/3 with 2 services' in result.output
+    assert 'Wave 2/3 failed' in result.output
+    assert '1 services were not deployed' in result.output
+    assert backend.calls['UpdateService'] == 2
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_deploy_many_fails_without_waves(engine, monkeypatch):
+    monkeypatch.setenv('SLACK_MUTED', '1')
+    backend = FakeEcsBackend(cluster='web', services=2, rollout_seconds=0)
+
+    with patch.object(cli, 'get_client', return_value=backend.client()), \
+            patch.object(cli, 'SLACK_LOGGER', None):
+        result = CliRunner().invoke(cli.deploy_many, [
+            '--cluster', 'web', '--services', 'service-0000,missing,service-0001',
+            '-i', 'app', 'app:2', '--engine', engine, '--poll-interval', '1', '1',
+        ])
+
+    assert result.exit_code == 1
+    assert 'Deployment failed for web/missing' in result.output
+    assert backend.calls['UpdateService'] == 2
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_deploy_many_rollback(engine, monkeypatch):
+    monkeypatch.setenv('SLACK_MUTED', '1')
+    backend = FakeEcsBackend(cluster='web', services=2, rollout_seconds=1.5)
+
+    with patch.object(cli, 'get_client', return_value=backend.client()), \
+            patch.object(cli, 'SLACK_LOGGER', None):
+        result = CliRunner().invoke(cli.deploy_many, [
+            '--cluster', 'web', '--services', 'service-0000,service-0001', '-i', 'app', 'app:2',
+            '--timeout', '1', '--rollback', '--engine', engine, '--poll-interval', '1', '1',
+        ])
+
+    assert result.exit_code == 1
+    assert result.output.count('Rollback successful') == 2
+    services = backend.describe_services('web', ['service-0000', 'service-0001'])
+    assert [s['taskDefinition'][-2:] for s in services['services']] == [':1', ':1']
+    assert backend.calls['DeregisterTaskDefinition'] == 0
+
+
+def test_deploy_many_max_deploys(monkeypatch):
+    monkeypatch.setenv('SLACK_MUTED', '1')
+    backend = FakeEcsBackend(cluster='web', services=4, rollout_seconds=0)
+
+    result = CliRunner().invoke(cli.deploy_many, ['--cluster', 'web', '--services', 'a', '--max-deploys', '2'])
+    assert result.exit_code == 2
+    assert '--max-deploys requires --engine asyncio' in result.output
+
+    with patch.object(cli, 'get_client', return_value=backend.client()), \
+            patch.object(cli, 'SLACK_LOGGER', None):
+        result = CliRunner().invoke(cli.deploy_many, [
+            '--cluster', 'web', '--services', ','.join(backend.service_names), '-i', 'app', 'app:2',
+            '--engine', 'asyncio', '--max-deploys', '2', '--poll-interval', '1', '1',
+        ])
+    assert result.exit_code == 0, result.output
+    assert backend.calls['UpdateService'] == 4
+
+
+def test_deploy_many_invalid_wave_size():
+    result = CliRunner().invoke(cli.deploy_many, ['--cluster', 'web', '--services', 'a', '--wave-size', '0%'])
+
+    assert result.exit_code == 2
+    assert 'must be a positive number or percentage' in result.output
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_deploy_many_dependencies(engine, monkeypatch):
+    monkeypatch.setenv('SLACK_MUTED', '1')
+    backend = FakeEcsBackend(cluster='web', services=4, rollout_seconds=0.2)
+    started = {}
+    update_service = backend.update_service
+
+    def record_update_service(cluster, service, **kwargs):
+        started[service] = monotonic()
+        return update_service(cluster, service, **kwargs)
+
+    with patch.object(cli, 'get_client', return_value=backend.client()), \
+            patch.object(cli, 'SLACK_LOGGER', None), \
+            patch.object(backend, 'update_service', record_update_service):
+        result = CliRunner().invoke(cli.deploy_many, [
+            '--cluster', 'web', '--services', 'service-0000,service-0001,service-0002,service-0003,missing',
+            '--depends-on', 'service-0001', 'service-0000',
+            '--depends-on', 'service-0003', 'missing',
+            '-i', 'app', 'app:2', '--engine', engine, '--poll-interval', '1', '1',
+        ])
+
+    assert result.exit_code == 1, result.output
+    assert sorted(started) == ['service-0000', 'service-0001', 'service-0002']
+    # service-0001 starts after service-0000 converged, service-0002 does not wait
+    assert started['service-0001'] - started['service-0000'] >= 0.2
+    assert started['service-0002'] - started['service-0000'] < 0.2
+    assert 'Skipping deploy cluster=web service=service-0003, missing failed' in result.output
+    assert 'Deployment failed for web/missing, web/service-0003' in result.output
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_deploy_many_client_error(engine, monkeypatch):
+    monkeypatch.setenv('SLACK_MUTED', '1')
+    backend = FakeEcsBackend(cluster='web', services=3, rollout_seconds=0)
+    update_service = backend.update_service
+
+    def deny_update_service(cluster, service, **kwargs):
+        if service == 'service-0000':
+            raise backend._error('AccessDeniedException', 'UpdateService')
+        return update_service(cluster, service, **kwargs)
+
+    with patch.object(cli, 'get_client', return_value=backend.client()), \
+            patch.object(cli, 'SLACK_LOGGER', None), \
+            patch.object(backend, 'update_service', deny_update_service):
+        result = CliRunner().invoke(cli.deploy_many, [
+            '--cluster', 'web', '--services', 'service-0000,service-0001,service-0002',
+            '--depends-on', 'service-0001', 'service-0000',
+            '-i', 'app', 'app:2', '--engine', engine, '--poll-interval', '1', '1',
+        ])
+
+    assert result.exit_code == 1
+    assert 'AccessDeniedException' in result.output
+    assert 'Skipping deploy cluster=web service=service-0001, service-0000 failed' in result.output
+    assert 'Deployment failed for web/service-0000, web/service-0001' in result.output
+    assert backend.calls['UpdateService'] == 1
+
+
+def test_deploy_many_region_error(monkeypatch):
+    monkeypatch.setenv('SLACK_MUTED', '1')
+    backend = FakeEcsBackend(cluster='web', services=1, rollout_seconds=0)
+    client = backend.client()
+
+    def get_client(access_key_id, secret_access_key, region, profile):
+        if region == 'eu-west-1':
+            raise backend._error('UnrecognizedClientException', 'DescribeServices')
+        return client
+
+    with patch.object(cli, 'get_client', get_client), patch.object(cli, 'SLACK_LOGGER', None):
+        result = CliRunner().invoke(cli.deploy_many, [
+            '--target', 'us-east-1', 'web', 'service-0000',
+            '--target', 'eu-west-1', 'web', 'service-0000',
+            '-i', 'app', 'app:2', '--poll-interval', '1', '1',
+        ])
+
+    assert result.exit_code == 1
+    assert 'Got error `An error occurred (UnrecognizedClientException)' in result.output
+    assert result.output.count('Deployment successful') == 1
+    assert 'Deployment failed for eu-west-1/web/service-0000' in result.output
+
+
+def test_deploy_many_waves_deploy_dependencies_first(monkeypatch):
+    monkeypatch.setenv('SLACK_MUTED', '1')
+    backend = FakeEcsBackend(cluster='web', services=3, rollout_seconds=0)
+    updated = []
+    update_service = backend.update_service
+
+    def record_update_service(cluster, service, **kwargs):
+        updated.append(service)
+        return update_service(cluster, service, **kwargs)
+
+    with patch.object(cli, 'get_client', return_value=backend.client()), \
+            patch.object(cli, 'SLACK_LOGGER', None), \
+            patch.object(backend, 'update_service', record_update_service):
+        result = CliRunner().invoke(cli.deploy_many, [
+            '--cluster', 'web', '--services', 'service-0001,service-0002,service-0000',
+            '--depends-on', 'service-0001', 'service-0000', '--canary', '1',
+            '-i', 'app', 'app:2', '--poll-interval', '1', '1',
+        ])
+
+    assert result.exit_code == 0, result.output
+    assert 'Deploying wave 1/2 with 1 services' in result.output
+    assert updated[0] == 'service-0000'
+    assert sorted(updated[1:]) == ['service-0001', 'service-0002']
+
+
+def test_deploy_many_circular_dependencies():
+    result = CliRunner().invoke(cli.deploy_many, [
+        '--cluster', 'web', '--services', 'a,b',
+        '--depends-on', 'a', 'b', '--depends-on', 'b', 'a',
+    ])
+
+    assert result.exit_code == 2
+    assert 'Circular dependencies between: web/a, web/b' in result.output
+
+
+def test_invalid_poll_interval():
+    for command in (cli.deploy_many, cli.apply):
+        result = CliRunner().invoke(command, ['--poll-interval', '0', '30'])
+
+        assert result.exit_code == 2
+        assert 'the minimum must be at least 1 second' in result.output
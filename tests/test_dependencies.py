@@ -0,0 +1,55 @@
+import pytest
+
+from ecs_deploy.dependencies import DependencyGraph, DependencyError
+
+
+def test_ready_without_dependencies():
+    graph = DependencyGraph([u'api', u'worker', u'cron'])
+
+    assert graph.ready() == [u'api', u'worker', u'cron']
+
+
+def test_done_starts_dependents():
+    graph = DependencyGraph(
+        [u'api', u'auth', u'worker', u'cron'],
+        {u'worker': {u'api', u'auth'}, u'cron': {u'worker'}}
+    )
+
+    assert graph.ready() == [u'api', u'auth']
+    assert graph.done(u'api') == []
+    assert graph.done(u'auth') == [u'worker']
+    assert graph.done(u'worker') == [u'cron']
+    assert graph.done(u'cron') == []
+
+
+def test_failed_skips_dependents():
+    graph = DependencyGraph(
+        [u'api', u'auth', u'worker', u'cron', u'other'],
+        {u'worker': {u'api'}, u'cron': {u'worker', u'auth'}, u'other': {u'auth'}}
+    )
+
+    assert sorted(graph.failed(u'api')) == [u'cron', u'worker']
+    assert graph.done(u'auth') == [u'other']
+
+
+def test_ordered_puts_dependencies_first():
+    graph = DependencyGraph(
+        [u'cron', u'api', u'worker', u'auth'],
+        {u'cron': {u'worker'}, u'worker': {u'auth', u'api'}}
+    )
+
+    assert graph.ordered() == [u'api', u'auth', u'worker', u'cron']
+    assert DependencyGraph([u'api', u'worker']).ordered() == [u'api', u'worker']
+
+
+def test_unknown_dependencies_are_ignored():
+    graph = DependencyGraph([u'worker'], {u'worker': {u'api'}})
+
+    assert graph.ready() == [u'worker']
+
+
+def test_circular_dependencies():
+    with pytest.raises(DependencyError) as e:
+        DependencyGraph([u'api', u'worker', u'cron'], {u'api': {u'worker'}, u'worker': {u'api'}})
+
+    assert str(e.value) == u'Circular dependencies between: api, worker'
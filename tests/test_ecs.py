@@ -1,17 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime, timedelta
+from threading import Thread
 
 import pytest
 
 from boto3.session import Session
+from botocore.awsrequest import AWSResponse
 from botocore.exceptions import ClientError, NoCredentialsError
 from dateutil.tz import tzlocal
-from mock.mock import patch
+from mock.mock import Mock, patch
 
 from ecs_deploy.ecs import EcsService, EcsTaskDefinition, \
     UnknownContainerError, EcsTaskDefinitionDiff, EcsClient, \
     EcsAction, EcsConnectionError, DeployAction, ScaleAction, RunAction, \
-    UnknownTaskDefinitionError
+    UnknownTaskDefinitionError, EcsServicePoller, EcsClientPool, PollingPolicy, \
+    EcsEventCursor, TaskDefinitionCache, TaskDefinitionRegistry, EcsError
+from ecs_deploy.metrics import DeployMetrics
+from ecs_deploy.ratelimit import RateLimiter, RegionalRateLimiter
 
 CLUSTER_NAME = u'test-cluster'
 CLUSTER_ARN = u'arn:aws:ecs:eu-central-1:123456789012:cluster/%s' % CLUSTER_NAME
@@ -135,6 +141,14 @@ PAYLOAD_SERVICE_WITH_ERRORS = {
     u'events': PAYLOAD_EVENTS
 }
 
+PAYLOAD_SERVICE_PENDING = {
+    u'serviceName': SERVICE_NAME,
+    u'desiredCount': DESIRED_COUNT,
+    u'taskDefinition': TASK_DEFINITION_ARN_1,
+    u'deployments': [dict(PAYLOAD_DEPLOYMENTS[0], runningCount=0, pendingCount=DESIRED_COUNT)],
+    u'events': []
+}
+
 PAYLOAD_SERVICE_WITHOUT_DEPLOYMENTS = {
     u'serviceName': SERVICE_NAME,
     u'desiredCount': DESIRED_COUNT,
@@ -264,6 +278,32 @@ def test_service_older_errors(service_with_errors):
     assert len(service_with_errors.older_errors) == 1
 
 
+def test_service_older_errors_are_computed_once(service_with_errors):
+    older_errors = service_with_errors.older_errors
+    service_with_errors[u'events'] = []
+    assert service_with_errors.older_errors is older_errors
+
+
+def test_event_cursor_returns_only_new_events(service_with_errors):
+    cursor = EcsEventCursor()
+    assert len(cursor.get_new_events(service_with_errors)) == 2
+    assert cursor.get_new_events(service_with_errors) == []
+
+    new_event = {
+        u'id': u'new_error',
+        u'createdAt': datetime.now(tz=tzlocal()),
+        u'message': u'Service was unable to Dolor Sit'
+    }
+    service_with_errors[u'events'] = [new_event] + service_with_errors[u'events']
+    assert cursor.get_new_events(service_with_errors) == [new_event]
+
+
+def test_event_cursor_warnings(service_with_errors):
+    cursor = EcsEventCursor()
+    assert len(cursor.get_warnings(service_with_errors)) == 2
+    assert cursor.get_warnings(service_with_errors) == {}
+
+
 def test_task_family(task_definition):
     assert task_definition.family == TASK_DEFINITION_FAMILY_1
 
@@ -393,6 +433,55 @@ def test_task_get_overrides_environment(task_definition):
     assert environment[0] == dict(name='foo', value='bar')
 
 
+def test_task_content_hash(task_definition, task_definition_revision_2):
+    reordered = deepcopy(task_definition)
+    reordered.containers[0][u'environment'] = tuple(reversed(reordered.containers[0][u'environment']))
+    reordered.additional_properties[u'registeredAt'] = datetime.now()
+
+    assert task_definition.content_hash == reordered.content_hash
+    assert task_definition.content_hash != task_definition_revision_2.content_hash
+
+    task_definition.set_images(u'latest')
+    assert task_definition.content_hash != reordered.content_hash
+
+
+def test_task_definition_registry(task_definition, task_definition_revision_2):
+    registry = TaskDefinitionRegistry()
+    calls = []
+
+    def create():
+        calls.append(1)
+        return task_definition_revision_2
+
+    results = []
+    threads = [
+        Thread(target=lambda: results.append(registry.register(deepcopy(task_definition), create)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert [result.arn for result in results] == [TASK_DEFINITION_ARN_2] * 5
+
+    task_definition.set_images(u'latest')
+    registry.register(task_definition, create)
+    assert len(calls) == 2
+
+
+def test_task_definition_registry_error(task_definition):
+    registry = TaskDefinitionRegistry()
+    create = Mock(side_effect=EcsError(u'Something went wrong'))
+
+    with pytest.raises(EcsError):
+        registry.register(task_definition, create)
+    with pytest.raises(EcsError):
+        registry.register(task_definition, create)
+    assert create.call_count == 1
+
+
 def test_task_definition_diff():
     diff = EcsTaskDefinitionDiff(u'webserver', u'image', u'new', u'old')
     assert str(diff) == u'Changed image of container "webserver" to: "new" (was: "old")'
@@ -412,6 +501,64 @@ def test_client_init(mocked_init, mocked_client):
     mocked_client.assert_called_once_with(u'ecs')
 
 
+@patch.object(Session, 'client')
+@patch.object(Session, '__init__')
+def test_client_init_with_max_pool_connections(mocked_init, mocked_client):
+    mocked_init.return_value = None
+
+    EcsClient(max_pool_connections=17)
+
+    config = mocked_client.call_args[1][u'config']
+    assert config.max_pool_connections == 17
+    assert config.retries is None
+
+
+def test_client_with_rate_limiter_sends_throttled_calls_once():
+    client = EcsClient(u'access_key_id', u'secret_access_key', u'eu-central-1', rate_limiter=RateLimiter())
+    throttled = AWSResponse(
+        u'https://ecs.eu-central-1.amazonaws.com/', 400, {},
+        Mock(stream=Mock(return_value=[b'{"__type": "ThrottlingException", "message": "Rate exceeded"}']))
+    )
+
+    with patch.object(client.boto._endpoint, u'_send', return_value=throttled) as send:
+        with pytest.raises(ClientError) as excinfo:
+            client.boto.list_clusters()
+
+    assert excinfo.value.response[u'Error'][u'Code'] == u'ThrottlingException'
+    # retrying is left to the shared rate limiter
+    assert send.call_count == 1
+
+
+@patch.object(EcsClient, '__init__')
+def test_client_pool(ecs_client):
+    ecs_client.return_value = None
+    rate_limiter = RateLimiter()
+    pool = EcsClientPool(rate_limiter=rate_limiter, max_pool_connections=17)
+
+    client = pool.get_client(u'access_key_id', u'secret_access_key', u'region', u'profile')
+
+    assert pool.get_client(u'access_key_id', u'secret_access_key', u'region', u'profile') is client
+    assert pool.get_client(u'access_key_id', u'secret_access_key', u'other-region', u'profile') is not client
+    assert ecs_client.call_count == 2
+    ecs_client.assert_any_call(access_key_id=u'access_key_id', secret_access_key=u'secret_access_key',
+                               region=u'region', profile=u'profile', rate_limiter=rate_limiter,
+                               max_pool_connections=17, metrics=None, boto_client=None,
+                               recorder=None)
+
+
+@patch.object(EcsClient, '__init__')
+def test_client_pool_regional_rate_limits(ecs_client):
+    ecs_client.return_value = None
+    rate_limiter = RegionalRateLimiter()
+    pool = EcsClientPool(rate_limiter=rate_limiter)
+
+    pool.get_client(region=u'us-east-1')
+    pool.get_client(region=u'eu-west-1')
+
+    rate_limiters = [call[1][u'rate_limiter'] for call in ecs_client.call_args_list]
+    assert rate_limiters == [rate_limiter.get(u'us-east-1'), rate_limiter.get(u'eu-west-1')]
+
+
 @pytest.fixture
 @patch.object(Session, 'client')
 @patch.object(Session, '__init__')
@@ -420,11 +567,41 @@ def client(mocked_init, mocked_client):
     return EcsClient(u'access_key_id', u'secret_access_key', u'region', u'profile')
 
 
+def test_client_records_metrics(client):
+    client.metrics = DeployMetrics()
+    client.rate_limiter = RateLimiter(rate=1000)
+    throttling = ClientError({u'Error': {u'Code': u'ThrottlingException'}}, u'DescribeServices')
+    client.boto.describe_services.side_effect = [
+        throttling,
+        {u'services': [PAYLOAD_SERVICE], u'ResponseMetadata': {u'RetryAttempts': 2}},
+    ]
+
+    client.describe_services(u'test-cluster', u'test-service')
+
+    call = client.metrics.summary()[u'api_calls'][u'describe_services']
+    assert call[u'count'] == 1
+    assert call[u'retries'] == 3
+    assert call[u'throttles'] == 1
+    assert call[u'errors'] == 0
+
+
 def test_client_describe_services(client):
     client.describe_services(u'test-cluster', u'test-service')
     client.boto.describe_services.assert_called_once_with(cluster=u'test-cluster', services=[u'test-service'])
 
 
+def test_client_describe_services_batch(client):
+    service_names = [u'service-%d' % i for i in range(25)]
+    client.boto.describe_services.return_value = {u'services': [PAYLOAD_SERVICE], u'failures': []}
+
+    response = client.describe_services_batch(u'test-cluster', service_names)
+
+    assert client.boto.describe_services.call_count == 3
+    client.boto.describe_services.assert_any_call(cluster=u'test-cluster', services=service_names[0:10])
+    client.boto.describe_services.assert_any_call(cluster=u'test-cluster', services=service_names[20:25])
+    assert len(response[u'services']) == 3
+
+
 def test_client_describe_task_definition(client):
     client.describe_task_definition(u'task_definition_arn')
     client.boto.describe_task_definition.assert_called_once_with(taskDefinition=u'task_definition_arn')
@@ -442,11 +619,68 @@ def test_client_list_tasks(client):
     client.boto.list_tasks.assert_called_once_with(cluster=u'test-cluster', serviceName=u'test-service')
 
 
+def test_client_list_task_arns(client):
+    client.boto.list_tasks.side_effect = [
+        {u'taskArns': [TASK_ARN_1], u'nextToken': u'token'},
+        {u'taskArns': [TASK_ARN_2]},
+    ]
+    task_arns = list(client.list_task_arns(u'test-cluster', u'test-service'))
+
+    assert task_arns == [TASK_ARN_1, TASK_ARN_2]
+    client.boto.list_tasks.assert_any_call(cluster=u'test-cluster', serviceName=u'test-service')
+    client.boto.list_tasks.assert_any_call(cluster=u'test-cluster', serviceName=u'test-service', nextToken=u'token')
+
+
+def test_client_calls_through_rate_limiter(client):
+    client.rate_limiter = RateLimiter()
+    throttling_error = ClientError({u'Error': {u'Code': u'ThrottlingException', u'Message': u'Rate exceeded'}},
+                                   u'DescribeServices')
+    client.boto.describe_services.side_effect = [throttling_error, RESPONSE_DESCRIBE_SERVICES]
+
+    response = client.describe_services(u'test-cluster', u'test-service')
+
+    assert response == RESPONSE_DESCRIBE_SERVICES
+    assert client.boto.describe_services.call_count == 2
+    assert client.rate_limiter.rate < client.rate_limiter.max_rate
+
+
 def test_client_describe_tasks(client):
     client.describe_tasks(u'test-cluster', u'task-arns')
     client.boto.describe_tasks.assert_called_once_with(cluster=u'test-cluster', tasks=u'task-arns')
 
 
+def test_client_list_task_definition_arns(client):
+    client.boto.list_task_definitions.return_value = {u'taskDefinitionArns': [TASK_DEFINITION_ARN_2]}
+    task_definition_arns = client.list_task_definition_arns(u'test-task', 5)
+
+    assert task_definition_arns == [TASK_DEFINITION_ARN_2]
+    client.boto.list_task_definitions.assert_called_once_with(
+        familyPrefix=u'test-task',
+        status=u'ACTIVE',
+        sort=u'DESC',
+        maxResults=100
+    )
+
+
+def test_client_list_task_definition_arns_of_family(client):
+    other_family = u'arn:aws:ecs:eu-central-1:123456789012:task-definition/test-task-worker:%d'
+    client.boto.list_task_definitions.side_effect = [
+        {u'taskDefinitionArns': [other_family % revision for revision in range(100, 0, -1)], u'nextToken': u'next'},
+        {u'taskDefinitionArns': [TASK_DEFINITION_ARN_2, TASK_DEFINITION_ARN_1]},
+    ]
+    task_definition_arns = client.list_task_definition_arns(u'test-task', 1)
+
+    assert task_definition_arns == [TASK_DEFINITION_ARN_2]
+    assert client.boto.list_task_definitions.call_count == 2
+    client.boto.list_task_definitions.assert_called_with(
+        familyPrefix=u'test-task',
+        status=u'ACTIVE',
+        sort=u'DESC',
+        maxResults=100,
+        nextToken=u'next'
+    )
+
+
 def test_client_register_task_definition(client):
     containers = [{u'name': u'foo'}]
     volumes = [{u'foo': u'bar'}]
@@ -551,6 +785,76 @@ def test_ecs_action_get_service():
     assert service.cluster == u'test-cluster'
 
 
+@patch.object(EcsClient, '__init__')
+def test_ecs_action_get_service_with_poller(client):
+    client.describe_services_batch.return_value = RESPONSE_DESCRIBE_SERVICES
+    poller = EcsServicePoller(client, CLUSTER_NAME, batch_window=0).start()
+
+    action = EcsAction(client, CLUSTER_NAME, SERVICE_NAME, poller=poller)
+    service = action.get_service()
+    poller.stop()
+
+    assert service.name == SERVICE_NAME
+    assert service.cluster == CLUSTER_NAME
+    client.describe_services.assert_not_called()
+    client.describe_services_batch.assert_called_with(cluster_name=CLUSTER_NAME, service_names=[SERVICE_NAME])
+
+
+@patch.object(EcsClient, '__init__')
+def test_service_poller_batches_requests(client):
+    client.describe_services_batch.return_value = {
+        u'services': [dict(PAYLOAD_SERVICE, serviceName=u'service-a'), dict(PAYLOAD_SERVICE, serviceName=u'service-b')]
+    }
+    poller = EcsServicePoller(client, CLUSTER_NAME, batch_window=0.2).start()
+
+    services = {}
+    threads = [
+        Thread(target=lambda name: services.update({name: poller.get_service(name)}), args=(name,))
+        for name in (u'service-a', u'service-b')
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    poller.stop()
+
+    assert services[u'service-a'].name == u'service-a'
+    assert services[u'service-b'].name == u'service-b'
+    client.describe_services_batch.assert_called_once_with(
+        cluster_name=CLUSTER_NAME,
+        service_names=[u'service-a', u'service-b']
+    )
+
+
+@patch.object(EcsClient, '__init__')
+def test_service_poller_unknown_service(client):
+    client.describe_services_batch.return_value = {u'services': [], u'failures': []}
+    poller = EcsServicePoller(client, CLUSTER_NAME, batch_window=0).start()
+
+    with pytest.raises(EcsConnectionError) as excinfo:
+        EcsAction(client, CLUSTER_NAME, u'invalid-service', poller=poller)
+    poller.stop()
+
+    assert str(excinfo.value) == u'An error occurred when calling the DescribeServices operation: Service not found.'
+
+
+def test_polling_policy_backs_off_while_unchanged(service):
+    polling = PollingPolicy(min_interval=2, max_interval=10, backoff=2)
+    assert polling.next_interval(service) == 2
+    assert polling.next_interval(service) == 4
+    assert polling.next_interval(service) == 8
+    assert polling.next_interval(service) == 10
+    assert polling.next_interval(service) == 10
+
+
+def test_polling_policy_tightens_on_progress(service):
+    polling = PollingPolicy(min_interval=2, max_interval=30, backoff=2)
+    polling.next_interval(service)
+    polling.next_interval(service)
+    service[u'deployments'] = [dict(PAYLOAD_DEPLOYMENTS[0], runningCount=1, pendingCount=1)]
+    assert polling.next_interval(service) == 2
+
+
 @patch.object(EcsClient, '__init__')
 def test_ecs_action_get_current_task_definition(client, service):
     client.describe_task_definition.return_value = RESPONSE_TASK_DEFINITION
@@ -568,6 +872,93 @@ def test_ecs_action_get_current_task_definition(client, service):
     assert task_definition.arn == u'arn:aws:ecs:eu-central-1:123456789012:task-definition/test-task:1'
 
 
+@patch.object(EcsClient, '__init__')
+def test_ecs_action_get_task_definition_from_cache(client):
+    client.describe_task_definition.return_value = deepcopy(RESPONSE_TASK_DEFINITION)
+    cache = TaskDefinitionCache()
+
+    action = EcsAction(client, CLUSTER_NAME, SERVICE_NAME, task_definition_cache=cache)
+    task_definition = action.get_task_definition(TASK_DEFINITION_ARN_1)
+    task_definition.set_images(u'latest')
+    cached_task_definition = action.get_task_definition(TASK_DEFINITION_ARN_1)
+
+    client.describe_task_definition.assert_called_once_with(task_definition_arn=TASK_DEFINITION_ARN_1)
+    assert cached_task_definition.arn == TASK_DEFINITION_ARN_1
+    assert cached_task_definition.containers[0][u'image'] == u'webserver:123'
+
+
+@patch.object(EcsClient, '__init__')
+def test_ecs_action_get_task_definition_by_family_is_not_cached(client):
+    client.describe_task_definition.return_value = RESPONSE_TASK_DEFINITION_2
+    cache = TaskDefinitionCache()
+
+    action = EcsAction(client, CLUSTER_NAME, SERVICE_NAME, task_definition_cache=cache)
+    action.get_task_definition(u'test-task')
+    action.get_task_definition(u'test-task')
+    action.get_task_definition(TASK_DEFINITION_ARN_2)
+
+    assert client.describe_task_definition.call_count == 2
+
+
+def test_task_definition_cache_family_ttl():
+    cache = TaskDefinitionCache(family_ttl=60)
+    cache.set(u'test-task', PAYLOAD_TASK_DEFINITION_2)
+    assert cache.get(u'test-task')[u'revision'] == 2
+    assert cache.get(TASK_DEFINITION_ARN_2)[u'revision'] == 2
+
+
+def test_task_definition_cache_persistence(tmpdir):
+    path = str(tmpdir.join(u'cache.json'))
+    payload = dict(PAYLOAD_TASK_DEFINITION_1, registeredAt=datetime(2020, 1, 1, tzinfo=tzlocal()))
+    TaskDefinitionCache(path=path).set(TASK_DEFINITION_ARN_1, payload)
+
+    cached = TaskDefinitionCache(path=path).get(TASK_DEFINITION_ARN_1)
+
+    assert cached[u'taskDefinitionArn'] == TASK_DEFINITION_ARN_1
+    assert cached[u'containerDefinitions'][1] == TASK_DEFINITION_CONTAINERS_1[1]
+    assert cached[u'registeredAt'] == payload[u'registeredAt']
+
+
+def test_task_definition_cache_concurrent_writes(tmpdir):
+    path = str(tmpdir.join(u'cache.json'))
+    cache = TaskDefinitionCache(path=path)
+
+    def set_revisions(worker):
+        for revision in range(20):
+            arn = u'%s-%d-%d' % (TASK_DEFINITION_ARN_1, worker, revision)
+            cache.set(arn, dict(PAYLOAD_TASK_DEFINITION_1, taskDefinitionArn=arn))
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(set_revisions, range(16)))
+
+    reloaded = TaskDefinitionCache(path=path)
+    reloaded.load()
+    assert len(reloaded._payloads) == 16 * 20
+    assert tmpdir.listdir() == [tmpdir.join(u'cache.json')]
+
+
+def test_task_definition_cache_ignores_failed_writes(tmpdir):
+    cache = TaskDefinitionCache(path=str(tmpdir.join(u'missing', u'cache.json')))
+
+    cache.set(TASK_DEFINITION_ARN_1, PAYLOAD_TASK_DEFINITION_1)
+
+    assert cache.get(TASK_DEFINITION_ARN_1)[u'taskDefinitionArn'] == TASK_DEFINITION_ARN_1
+
+
+@pytest.mark.parametrize(u'content', [u'', u'{"arn:aws:ecs', u'[]'])
+def test_task_definition_cache_ignores_broken_file(tmpdir, capsys, content):
+    path = tmpdir.join(u'cache.json')
+    path.write(content)
+    cache = TaskDefinitionCache(path=str(path))
+    assert capsys.readouterr().out == u''
+
+    assert cache.get(TASK_DEFINITION_ARN_1) is None
+    assert u'Ignoring the task definition cache' in capsys.readouterr().out
+
+    cache.set(TASK_DEFINITION_ARN_1, PAYLOAD_TASK_DEFINITION_1)
+    assert TaskDefinitionCache(path=str(path)).get(TASK_DEFINITION_ARN_1) is not None
+
+
 @patch.object(EcsClient, '__init__')
 def test_update_task_definition(client, task_definition):
     client.register_task_definition.return_value = RESPONSE_TASK_DEFINITION
@@ -589,6 +980,33 @@ def test_update_task_definition(client, task_definition):
     )
 
 
+@patch.object(EcsClient, '__init__')
+def test_find_task_definition(client, task_definition):
+    client.list_task_definition_arns.return_value = [
+        TASK_DEFINITION_ARN_2,
+        TASK_DEFINITION_ARN_1,
+    ]
+    client.describe_task_definition.side_effect = lambda task_definition_arn: \
+        deepcopy(RESPONSE_TASK_DEFINITIONS[task_definition_arn])
+
+    action = EcsAction(client, CLUSTER_NAME, SERVICE_NAME)
+    existing = action.find_task_definition(task_definition, depth=3)
+
+    assert existing.arn == TASK_DEFINITION_ARN_1
+    client.list_task_definition_arns.assert_called_once_with(family=u'test-task', max_results=3)
+    assert client.describe_task_definition.call_count == 2
+
+
+@patch.object(EcsClient, '__init__')
+def test_find_task_definition_without_match(client, task_definition):
+    client.list_task_definition_arns.return_value = [TASK_DEFINITION_ARN_1]
+    client.describe_task_definition.return_value = deepcopy(RESPONSE_TASK_DEFINITION)
+    task_definition.set_images(u'latest')
+
+    action = EcsAction(client, CLUSTER_NAME, SERVICE_NAME)
+    assert action.find_task_definition(task_definition) is None
+
+
 @patch.object(EcsClient, '__init__')
 def test_deregister_task_definition(client, task_definition):
     action = EcsAction(client, u'test-cluster', u'test-service')
@@ -617,14 +1035,41 @@ def test_update_service(client, service):
 
 @patch.object(EcsClient, '__init__')
 def test_is_deployed(client, service):
-    client.list_tasks.return_value = RESPONSE_LIST_TASKS_1
-    client.describe_tasks.return_value = RESPONSE_DESCRIBE_TASKS
+    action = EcsAction(client, CLUSTER_NAME, SERVICE_NAME)
+    is_deployed = action.is_deployed(service)
 
+    assert is_deployed is True
+    client.list_tasks.assert_not_called()
+    client.describe_tasks.assert_not_called()
+
+
+@patch.object(EcsClient, '__init__')
+def test_is_not_deployed_if_tasks_pending(client, service):
+    service[u'deployments'] = [dict(PAYLOAD_DEPLOYMENTS[0], runningCount=1, pendingCount=1)]
     action = EcsAction(client, CLUSTER_NAME, SERVICE_NAME)
     is_deployed = action.is_deployed(service)
+    assert is_deployed is False
+
+
+@patch.object(EcsClient, '__init__')
+def test_is_not_deployed_if_rollout_failed(client, service):
+    service[u'deployments'] = [dict(PAYLOAD_DEPLOYMENTS[0], rolloutState=u'FAILED')]
+    action = EcsAction(client, CLUSTER_NAME, SERVICE_NAME)
+    is_deployed = action.is_deployed(service)
+    assert is_deployed is False
+
+
+@patch.object(EcsClient, '__init__')
+def test_is_deployed_strict(client, service):
+    client.list_task_arns.return_value = iter(RESPONSE_LIST_TASKS_2[u'taskArns'])
+    client.describe_tasks.return_value = RESPONSE_DESCRIBE_TASKS
+
+    action = EcsAction(client, CLUSTER_NAME, SERVICE_NAME)
+    is_deployed = action.is_deployed(service, strict=True)
 
     assert is_deployed is True
-    client.list_tasks.assert_called_once_with(
+    client.list_tasks.assert_not_called()
+    client.list_task_arns.assert_called_once_with(
         cluster_name=service.cluster,
         service_name=service.name
     )
@@ -645,18 +1090,18 @@ def test_is_not_deployed_with_more_than_one_deployment(client, service):
 
 @patch.object(EcsClient, '__init__')
 def test_is_deployed_if_no_tasks_should_be_running(client, service):
-    client.list_tasks.return_value = RESPONSE_LIST_TASKS_0
+    client.list_task_arns.return_value = iter(RESPONSE_LIST_TASKS_0[u'taskArns'])
     action = EcsAction(client, CLUSTER_NAME, SERVICE_NAME)
     service.set_desired_count(0)
-    is_deployed = action.is_deployed(service)
+    is_deployed = action.is_deployed(service, strict=True)
     assert is_deployed is True
 
 
 @patch.object(EcsClient, '__init__')
 def test_is_not_deployed_if_no_tasks_running(client, service):
-    client.list_tasks.return_value = RESPONSE_LIST_TASKS_0
+    client.list_task_arns.return_value = iter(RESPONSE_LIST_TASKS_0[u'taskArns'])
     action = EcsAction(client, CLUSTER_NAME, SERVICE_NAME)
-    is_deployed = action.is_deployed(service)
+    is_deployed = action.is_deployed(service, strict=True)
     assert is_deployed is False
 
 
@@ -668,6 +1113,21 @@ def test_get_running_tasks_count(client, service):
     assert running_count == 2
 
 
+@patch.object(EcsClient, '__init__')
+def test_get_running_tasks_count_in_chunks(client, service):
+    client.describe_tasks.side_effect = lambda cluster_name, task_arns: {
+        u'tasks': [dict(PAYLOAD_TASK_1, taskArn=task_arn) for task_arn in task_arns]
+    }
+    task_arns = (u'arn:aws:ecs:eu-central-1:123456789012:task/%d' % i for i in range(250))
+
+    action = EcsAction(client, CLUSTER_NAME, SERVICE_NAME)
+    running_count = action.get_running_tasks_count(service, task_arns)
+
+    assert running_count == 250
+    assert client.describe_tasks.call_count == 3
+    assert sorted(len(call[1][u'task_arns']) for call in client.describe_tasks.call_args_list) == [50, 100, 100]
+
+
 @patch.object(EcsClient, '__init__')
 def test_get_running_tasks_count_new_revision(client, service, task_definition_revision_2):
     client.describe_tasks.return_value = RESPONSE_DESCRIBE_TASKS
@@ -766,11 +1226,22 @@ class EcsTestClient(object):
                 u"services": [PAYLOAD_SERVICE_WITH_ERRORS],
                 u"failures": []
             }
+        if self.wait_until > datetime.now():
+            return {
+                u"services": [PAYLOAD_SERVICE_PENDING],
+                u"failures": []
+            }
         return {
             u"services": [PAYLOAD_SERVICE],
             u"failures": []
         }
 
+    def describe_services_batch(self, cluster_name, service_names):
+        services = []
+        for service_name in service_names:
+            services.extend(self.describe_services(cluster_name, service_name)[u'services'])
+        return {u'services': services, u'failures': []}
+
     def describe_task_definition(self, task_definition_arn):
         if task_definition_arn in RESPONSE_TASK_DEFINITIONS:
             return deepcopy(RESPONSE_TASK_DEFINITIONS[task_definition_arn])
@@ -781,9 +1252,15 @@ class EcsTestClient(object):
             return deepcopy(RESPONSE_LIST_TASKS_2)
         return deepcopy(RESPONSE_LIST_TASKS_0)
 
+    def list_task_arns(self, cluster_name, service_name):
+        return iter(self.list_tasks(cluster_name, service_name)[u'taskArns'])
+
     def describe_tasks(self, cluster_name, task_arns):
         return deepcopy(RESPONSE_DESCRIBE_TASKS)
 
+    def list_task_definition_arns(self, family, max_results):
+        return [TASK_DEFINITION_ARN_1]
+
     def register_task_definition(self, family, containers, volumes, role_arn, additional_properties):
         return deepcopy(RESPONSE_TASK_DEFINITION_2)
 
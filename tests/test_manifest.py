@@ -0,0 +1,217 @@
+import json
+from unittest.mock import patch
+
+import pytest
+from click.testing import CliRunner
+
+from benchmarks.fake_ecs import FakeEcsBackend
+from ecs_deploy import cli
+from ecs_deploy.manifest import Manifest, ManifestError, ManifestPlanner
+
+MANIFEST = {
+    u'region': u'us-east-1',
+    u'clusters': {
+        u'benchmark': {
+            u'tag': u'2',
+            u'services': {
+                u'service-0000': {},
+                u'service-0001': {
+                    u'images': {u'app': u'other:3'},
+                    u'env': {u'app': {u'DEBUG': False}},
+                },
+            }
+        }
+    }
+}
+
+MANIFEST_YAML = u"""
+region: us-east-1
+clusters:
+  benchmark:
+    tag: "2"
+    services:
+      service-0000:
+      service-0001:
+        images:
+          app: other:3
+        env:
+          app:
+            DEBUG: false
+"""
+
+
+@pytest.fixture
+def backend():
+    return FakeEcsBackend(services=3, rollout_seconds=0)
+
+
+def test_parse_manifest():
+    manifest = Manifest.parse(MANIFEST)
+
+    assert manifest.region == u'us-east-1'
+    assert manifest.profile is None
+    assert manifest.clusters == [u'benchmark']
+    assert [service.name for service in manifest.services] == [u'benchmark/service-0000', u'benchmark/service-0001']
+    assert manifest.services[0].tag == u'2'
+    assert manifest.services[1].tag == u'2'
+    assert manifest.services[1].images == {u'app': u'other:3'}
+    assert manifest.services[1].environment == ((u'app', u'DEBUG', u'false'),)
+
+
+def test_parse_manifest_environment():
+    env = {u'app': {u'DEBUG': True, u'WORKERS': 4, u'NAME': u'web'}}
+    manifest = Manifest.parse({u'clusters': {u'c': {u'services': {u's': {u'env': env}}}}})
+    assert manifest.services[0].environment == (
+        (u'app', u'DEBUG', u'true'), (u'app', u'NAME', u'web'), (u'app', u'WORKERS', u'4')
+    )
+
+    with pytest.raises(ManifestError) as e:
+        Manifest.parse({u'clusters': {u'c': {u'services': {u's': {u'env': {u'app': {u'HOSTS': [u'a']}}}}}}})
+    assert u'Environment variable HOSTS of container app in c/s must be a string' in str(e.value)
+
+
+def test_load_manifest(tmpdir):
+    json_path = tmpdir.join(u'manifest.json')
+    json_path.write(json.dumps(MANIFEST))
+    yaml_path = tmpdir.join(u'manifest.yml')
+    yaml_path.write(MANIFEST_YAML)
+
+    from_json = Manifest.load(str(json_path))
+    from_yaml = Manifest.load(str(yaml_path))
+
+    assert [vars(s) for s in from_json.services] == [vars(s) for s in from_yaml.services]
+
+
+def test_parse_manifest_merges_cluster_settings():
+    manifest = Manifest.parse({u'clusters': {u'c': {
+        u'tag': u'1',
+        u'images': {u'app': u'app:1', u'sidecar': u'sidecar:1'},
+        u'env': {u'app': {u'REGION': u'eu', u'DEBUG': u'false'}, u'sidecar': {u'PORT': u'80'}},
+        u'services': {
+            u'api': {u'env': {u'app': {u'DEBUG': u'true'}}, u'images': {u'app': u'api:2'}},
+            u'worker': {},
+        }
+    }}})
+
+    api, worker = manifest.services
+    assert api.tag == u'1'
+    assert api.images == {u'app': u'api:2', u'sidecar': u'sidecar:1'}
+    assert api.environment == (
+        (u'app', u'DEBUG', u'true'), (u'app', u'REGION', u'eu'), (u'sidecar', u'PORT', u'80')
+    )
+    assert worker.environment == (
+        (u'app', u'DEBUG', u'false'), (u'app', u'REGION', u'eu'), (u'sidecar', u'PORT', u'80')
+    )
+
+
+def test_parse_manifest_invalid_sections():
+    with pytest.raises(ManifestError) as e:
+        Manifest.parse({u'clusters': {u'c': {u'env': [u'DEBUG=true'], u'services': {u's': {}}}}})
+    assert u'env of cluster c must be a mapping of containers' in str(e.value)
+
+    with pytest.raises(ManifestError) as e:
+        Manifest.parse({u'clusters': {u'c': {u'services': {u's': {u'env': {u'app': u'DEBUG=true'}}}}}})
+    assert u'env of service c/s must map every container to its variables' in str(e.value)
+
+    with pytest.raises(ManifestError) as e:
+        Manifest.parse({u'clusters': {u'c': {u'services': {u's': [u'images']}}}})
+    assert u'Service c/s must be a mapping of settings' in str(e.value)
+
+
+def test_parse_manifest_unknown_settings():
+    with pytest.raises(ManifestError) as e:
+        Manifest.parse({u'clusters': {u'c': {u'services': {u's': {u'image': u'x'}}}}})
+    assert u'Unknown settings for service c/s: image' in str(e.value)
+
+    with pytest.raises(ManifestError):
+        Manifest.parse({u'clusters': {u'c': {u'services': {}}}})
+
+    with pytest.raises(ManifestError):
+        Manifest.parse({u'services': {}})
+
+
+def test_plan(backend):
+    manifest = Manifest.parse(dict(MANIFEST, clusters={u'benchmark': {u'services': {
+        u'service-0000': {u'tag': u'2'},
+        u'service-0001': {u'images': {u'app': u'app:1'}},
+        u'service-0002': {u'task': u'family-0000:1'},
+        u'missing': {},
+    }}}))
+    planner = ManifestPlanner(backend.client(), workers=4)
+    try:
+        plans = dict((planned.entry.service, planned) for planned in planner.plan(manifest))
+    finally:
+        planner.stop()
+
+    assert plans[u'service-0000'].changed
+    assert [d.value for d in plans[u'service-0000'].diff] == [u'app:2']
+    assert not plans[u'service-0001'].changed
+    assert not plans[u'service-0002'].diff
+    assert plans[u'service-0002'].changed
+    assert plans[u'missing'].error is not None
+    assert not plans[u'missing'].changed
+
+
+def test_plan_command(backend, tmpdir):
+    path = tmpdir.join(u'manifest.json')
+    path.write(json.dumps(MANIFEST))
+
+    with patch.object(cli, u'get_client', return_value=backend.client()):
+        result = CliRunner().invoke(cli.plan, [str(path)])
+
+    assert result.exit_code == 0
+    assert u'Plan: 2 to deploy, 0 unchanged, 0 failed' in result.output
+    assert backend.calls[u'RegisterTaskDefinition'] == 0
+
+
+def test_apply_command(backend, tmpdir, monkeypatch):
+    monkeypatch.setenv(u'SLACK_MUTED', u'1')
+    path = tmpdir.join(u'manifest.json')
+    path.write(json.dumps(MANIFEST))
+
+    with patch.object(cli, u'get_client', return_value=backend.client()), \
+            patch.object(cli, u'SLACK_LOGGER', None):
+        result = CliRunner().invoke(cli.apply, [str(path), u'--poll-interval', u'1', u'1'])
+
+    assert result.exit_code == 0, result.output
+    assert u'Deployment of benchmark/service-0000 successful' in result.output
+    assert u'Deployment of benchmark/service-0001 successful' in result.output
+    services = backend.describe_services(u'benchmark', [u'service-0000', u'service-0001', u'service-0002'])
+    assert [s[u'taskDefinition'].rsplit(u':', 1)[1] for s in services[u'services']] == [u'2', u'2', u'1']
+
+
+def test_apply_aborts_on_plan_errors(backend, tmpdir):
+    path = tmpdir.join(u'manifest.json')
+    path.write(json.dumps({u'clusters': {u'benchmark': {u'tag': u'2', u'services': {
+        u'service-0000': {}, u'missing': {}
+    }}}}))
+
+    with patch.object(cli, u'get_client', return_value=backend.client()):
+        result = CliRunner().invoke(cli.apply, [str(path)])
+
+    assert result.exit_code == 1
+    assert u'Plan: 1 to deploy, 0 unchanged, 1 failed' in result.output
+    assert backend.calls[u'RegisterTaskDefinition'] == 0
+    assert backend.calls[u'UpdateService'] == 0
+
+
+def test_apply_reports_client_errors_per_service(backend, tmpdir, monkeypatch):
+    monkeypatch.setenv(u'SLACK_MUTED', u'1')
+    path = tmpdir.join(u'manifest.json')
+    path.write(json.dumps(MANIFEST))
+    register_task_definition = backend.register_task_definition
+
+    def fail_family_0000(family, containerDefinitions, volumes, **kwargs):
+        if family == u'family-0000':
+            raise backend._error(u'AccessDeniedException', u'RegisterTaskDefinition')
+        return register_task_definition(family, containerDefinitions, volumes, **kwargs)
+
+    with patch.object(cli, u'get_client', return_value=backend.client()), \
+            patch.object(cli, u'SLACK_LOGGER', None), \
+            patch.object(backend, u'register_task_definition', side_effect=fail_family_0000):
+        result = CliRunner().invoke(cli.apply, [str(path), u'--poll-interval', u'1', u'1'])
+
+    assert result.exit_code == 1
+    assert u'benchmark/service-0000: An error occurred (AccessDeniedException)' in result.output
+    assert u'Deployment of benchmark/service-0001 successful' in result.output
+    assert u'Deployment failed: benchmark/service-0000' in result.output
@@ -0,0 +1,162 @@
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from mock.mock import patch
+
+from ecs_deploy.ecs import TaskPlacementError
+from ecs_deploy.metrics import DeployMetrics, StatsdSink, PrometheusSink, sinks_from_env
+
+
+def test_phases_are_aggregated():
+    metrics = DeployMetrics()
+    with patch('ecs_deploy.metrics.monotonic', side_effect=[0, 2, 10, 11]):
+        with metrics.phase(u'poll', u'service-a'):
+            pass
+        with metrics.phase(u'poll', u'service-b'):
+            pass
+
+    summary = metrics.summary()
+
+    assert summary[u'phases'][u'poll'] == {u'count': 2, u'total': 3.0, u'max': 2.0}
+    assert summary[u'services'] == {u'service-a': {u'poll': 2.0}, u'service-b': {u'poll': 1.0}}
+
+
+def test_phase_is_recorded_on_error():
+    metrics = DeployMetrics()
+    try:
+        with metrics.phase(u'update_service'):
+            raise ValueError()
+    except ValueError:
+        pass
+
+    assert metrics.summary()[u'phases'][u'update_service'][u'count'] == 1
+
+
+def test_calls_are_aggregated():
+    metrics = DeployMetrics()
+    metrics.record_call(u'describe_services', 0.5, retries=2, throttles=1)
+    metrics.record_call(u'describe_services', 1.5, error=True)
+
+    assert metrics.summary()[u'api_calls'][u'describe_services'] == {
+        u'count': 2, u'total': 2.0, u'max': 1.5, u'retries': 2, u'throttles': 1, u'errors': 1
+    }
+
+
+def test_write(tmpdir):
+    metrics = DeployMetrics()
+    metrics.record_phase(u'deploy', 1.0)
+    path = tmpdir.join(u'timings.json')
+
+    metrics.write(str(path))
+
+    assert json.loads(path.read())[u'phases'][u'deploy'][u'total'] == 1.0
+
+
+def test_write_to_stderr(capsys):
+    DeployMetrics().write(u'-')
+    assert u'"wall_time"' in capsys.readouterr().err
+
+
+def test_failures_are_counted():
+    metrics = DeployMetrics()
+    metrics.record_failure(u'service-a', TaskPlacementError(u'no capacity'))
+    metrics.record_failure(u'service-b', TaskPlacementError(u'no capacity'))
+
+    assert metrics.summary()[u'failures'] == {u'TaskPlacementError': 2}
+
+
+@pytest.fixture
+def statsd_listener():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind((u'127.0.0.1', 0))
+    listener.settimeout(5)
+    yield listener
+    listener.close()
+
+
+def test_statsd_sink(statsd_listener):
+    metrics = DeployMetrics(sinks=[StatsdSink(*statsd_listener.getsockname())])
+
+    metrics.record_call(u'describe_services', 0.25, retries=1, throttles=1)
+    metrics.record_convergence(u'my.service', 90, polls=12)
+    metrics.record_failure(u'my.service', TaskPlacementError(u'no capacity'))
+
+    packets = [statsd_listener.recv(1024).decode(u'utf-8') for _ in range(7)]
+    assert packets == [
+        u'ecs_deploy.api_call.describe_services:250|ms',
+        u'ecs_deploy.api_retries.describe_services:1|c',
+        u'ecs_deploy.api_throttles.describe_services:1|c',
+        u'ecs_deploy.phase.converge:90000|ms',
+        u'ecs_deploy.converge.my_service:90000|ms',
+        u'ecs_deploy.polls.my_service:12|c',
+        u'ecs_deploy.failures.my_service.TaskPlacementError:1|c',
+    ]
+
+
+def test_prometheus_render():
+    sink = PrometheusSink()
+    metrics = DeployMetrics(sinks=[sink])
+
+    metrics.record_call(u'describe_services', 0.25)
+    metrics.record_call(u'describe_services', 0.5, throttles=2, retries=2)
+    metrics.record_failure(u'service-a', TaskPlacementError(u'no capacity'))
+
+    lines = sink.render().splitlines()
+    assert u'# TYPE ecs_deploy_api_throttles_total counter' in lines
+    assert u'ecs_deploy_api_throttles_total{operation="describe_services"} 2' in lines
+    assert u'ecs_deploy_failures_total{service="service-a",type="TaskPlacementError"} 1' in lines
+    assert u'# TYPE ecs_deploy_api_call_seconds summary' in lines
+    assert u'ecs_deploy_api_call_seconds_count{operation="describe_services"} 2' in lines
+    assert u'ecs_deploy_api_call_seconds_sum{operation="describe_services"} 0.75' in lines
+
+
+def test_prometheus_textfile(tmpdir):
+    path = tmpdir.join(u'ecs_deploy.prom')
+    metrics = DeployMetrics(sinks=[PrometheusSink(textfile=str(path))])
+    metrics.record_convergence(u'service-a', 30, polls=5)
+
+    metrics.flush()
+
+    assert u'ecs_deploy_polls_total{service="service-a"} 5' in path.read().splitlines()
+    assert tmpdir.listdir() == [path]
+
+
+class PushgatewayHandler(BaseHTTPRequestHandler):
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers[u'Content-Length']))
+        self.server.pushes.append((self.path, body.decode(u'utf-8')))
+        self.send_response(202)
+        self.send_header(u'Content-Length', u'0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_prometheus_pushgateway():
+    server = HTTPServer((u'127.0.0.1', 0), PushgatewayHandler)
+    server.pushes = []
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+    sink = PrometheusSink(pushgateway=u'http://127.0.0.1:%d/' % server.server_port)
+    DeployMetrics(sinks=[sink]).record_call(u'update_service', 1.0, error=True)
+
+    sink.flush()
+    thread.join(5)
+    server.server_close()
+
+    path, body = server.pushes[0]
+    assert path == u'/metrics/job/ecs_deploy'
+    assert u'ecs_deploy_api_errors_total{operation="update_service"} 1' in body.splitlines()
+
+
+def test_sinks_from_env():
+    with patch.dict(u'os.environ', {u'ECS_DEPLOY_STATSD': u'127.0.0.1:9125',
+                                    u'ECS_DEPLOY_PROMETHEUS_TEXTFILE': u'/tmp/ecs_deploy.prom'}):
+        statsd, prometheus = sinks_from_env()
+
+    assert statsd.address == (u'127.0.0.1', 9125)
+    assert prometheus.textfile == u'/tmp/ecs_deploy.prom'
@@ -0,0 +1,102 @@
+import pytest
+from botocore.exceptions import ClientError
+from mock import Mock, patch
+
+from ecs_deploy.ratelimit import RateLimiter, RegionalRateLimiter, is_throttling_error
+
+THROTTLING_ERROR = ClientError({u'Error': {u'Code': u'ThrottlingException', u'Message': u'Rate exceeded'}},
+                               u'DescribeServices')
+CLIENT_ERROR = ClientError({u'Error': {u'Code': u'ClientException', u'Message': u'Something went wrong'}},
+                           u'DescribeServices')
+
+
+def test_is_throttling_error():
+    assert is_throttling_error(THROTTLING_ERROR)
+    assert not is_throttling_error(CLIENT_ERROR)
+    assert not is_throttling_error(ValueError())
+
+
+@patch('ecs_deploy.ratelimit.sleep')
+def test_acquire_within_capacity(sleep):
+    limiter = RateLimiter(rate=10, capacity=5)
+    for _ in range(5):
+        limiter.acquire()
+    sleep.assert_not_called()
+
+
+@patch('ecs_deploy.ratelimit.sleep')
+def test_acquire_waits_for_refill(sleep):
+    limiter = RateLimiter(rate=10, capacity=1)
+    limiter.acquire()
+    sleep.side_effect = lambda seconds: setattr(limiter, '_tokens', 1.0)
+    limiter.acquire()
+    assert sleep.call_count == 1
+    assert 0 < sleep.call_args[0][0] <= 0.1
+
+
+def test_throttled_halves_rate():
+    limiter = RateLimiter(rate=20, min_rate=8)
+    limiter.throttled()
+    assert limiter.rate == 10
+    limiter.throttled()
+    assert limiter.rate == 8
+
+
+@patch('ecs_deploy.ratelimit.sleep')
+def test_throttled_waits_retry_after(sleep):
+    limiter = RateLimiter(rate=10, capacity=1)
+    limiter.throttled(retry_after=2)
+    sleep.side_effect = lambda seconds: setattr(limiter, '_tokens', 1.0)
+    limiter.acquire()
+    assert limiter.rate == 10
+    assert 1.9 < sleep.call_args[0][0] <= 2
+
+
+def test_succeeded_ramps_up_to_max_rate():
+    limiter = RateLimiter(rate=20, recovery=5)
+    limiter.throttled()
+    limiter.succeeded()
+    assert limiter.rate == 15
+    limiter.succeeded()
+    limiter.succeeded()
+    assert limiter.rate == 20
+
+
+@patch('ecs_deploy.ratelimit.sleep')
+def test_call_retries_throttled_calls(sleep):
+    limiter = RateLimiter()
+    method = Mock(side_effect=[THROTTLING_ERROR, THROTTLING_ERROR, {u'foo': u'bar'}])
+
+    assert limiter.call(method, cluster=u'test-cluster') == {u'foo': u'bar'}
+    assert method.call_count == 3
+    method.assert_called_with(cluster=u'test-cluster')
+
+
+@patch('ecs_deploy.ratelimit.sleep')
+def test_call_gives_up_after_max_retries(sleep):
+    limiter = RateLimiter(max_retries=2)
+    method = Mock(side_effect=THROTTLING_ERROR)
+
+    with pytest.raises(ClientError):
+        limiter.call(method)
+    assert method.call_count == 3
+
+
+def test_call_raises_other_errors():
+    limiter = RateLimiter()
+    method = Mock(side_effect=CLIENT_ERROR)
+
+    with pytest.raises(ClientError):
+        limiter.call(method)
+    assert method.call_count == 1
+
+
+def test_regional_rate_limiter():
+    rate_limiter = RegionalRateLimiter(rate=5, capacity=10)
+
+    assert rate_limiter.get(u'us-east-1') is rate_limiter.get(u'us-east-1')
+    assert rate_limiter.get(u'us-east-1') is not rate_limiter.get(u'eu-west-1')
+    assert rate_limiter.get(None).max_rate == 5
+
+    rate_limiter.get(u'us-east-1').throttled()
+    assert rate_limiter.get(u'eu-west-1').rate == 5
@@ -0,0 +1,147 @@
+import pytest
+from botocore.exceptions import ClientError
+from click.testing import CliRunner
+from mock.mock import Mock, patch
+
+from benchmarks.fake_ecs import FakeEcsBackend
+from ecs_deploy import cli
+from ecs_deploy.ecs import EcsClient, UnknownTaskDefinitionError
+from ecs_deploy.replay import TrafficRecorder, ReplayClient, ReplayError
+from tests.test_ecs import PAYLOAD_SERVICE, PAYLOAD_SERVICE_WITH_ERRORS, RESPONSE_TASK_DEFINITION, \
+    CLUSTER_NAME, SERVICE_NAME, TASK_DEFINITION_ARN_1
+
+
+def record(path, calls):
+    boto = Mock()
+    recorder = TrafficRecorder(path)
+    client = EcsClient(boto_client=boto, recorder=recorder)
+    for started_at, operation, response in calls:
+        getattr(boto, operation).side_effect = [response]
+        with patch('ecs_deploy.replay.monotonic', side_effect=[started_at, started_at + 0.1]):
+            try:
+                getattr(client, operation)(CLUSTER_NAME, SERVICE_NAME)
+            except ClientError:
+                pass
+    recorder.close()
+
+
+@pytest.fixture(params=[u'traffic.jsonl', u'traffic.jsonl.gz'])
+def recording(request, tmpdir):
+    path = str(tmpdir.join(request.param))
+    record(path, [
+        (100, u'describe_services', {u'services': [PAYLOAD_SERVICE_WITH_ERRORS], u'ResponseMetadata': {}}),
+        (105, u'describe_services', {u'services': [PAYLOAD_SERVICE], u'ResponseMetadata': {}}),
+        (106, u'list_tasks', ClientError({u'Error': {u'Code': u'ClusterNotFoundException'}}, u'ListTasks')),
+    ])
+    return path
+
+
+def test_replay_responses(recording):
+    client = EcsClient(boto_client=ReplayClient(recording, speed=1000))
+
+    response = client.describe_services(CLUSTER_NAME, SERVICE_NAME)
+
+    assert response == {u'services': [PAYLOAD_SERVICE_WITH_ERRORS], u'failures': []}
+    with pytest.raises(ClientError) as excinfo:
+        client.list_tasks(CLUSTER_NAME, SERVICE_NAME)
+    assert excinfo.value.response[u'Error'][u'Code'] == u'ClusterNotFoundException'
+
+
+def test_replay_follows_recorded_timing(recording):
+    replay = ReplayClient(recording, speed=2)
+    client = EcsClient(boto_client=replay)
+
+    with patch('ecs_deploy.replay.monotonic', side_effect=[0, 2]), patch('ecs_deploy.replay.sleep') as sleep:
+        assert client.describe_services(CLUSTER_NAME, SERVICE_NAME)[u'services'][0] == PAYLOAD_SERVICE_WITH_ERRORS
+        # 2 seconds at double speed are 4 seconds of the recording
+        assert client.describe_services(CLUSTER_NAME, SERVICE_NAME)[u'services'][0] == PAYLOAD_SERVICE_WITH_ERRORS
+    sleep.assert_called_with(0.05)
+
+    with patch('ecs_deploy.replay.monotonic', return_value=3), patch('ecs_deploy.replay.sleep'):
+        assert client.describe_services(CLUSTER_NAME, SERVICE_NAME)[u'services'][0] == PAYLOAD_SERVICE
+
+
+def test_replay_unknown_call(recording):
+    client = EcsClient(boto_client=ReplayClient(recording))
+
+    with pytest.raises(ReplayError):
+        client.describe_services(CLUSTER_NAME, u'other-service')
+
+
+def test_replay_skips_throttling_errors(tmpdir):
+    path = str(tmpdir.join(u'traffic.jsonl'))
+    throttled = ClientError({u'Error': {u'Code': u'ThrottlingException'}}, u'DescribeTaskDefinition')
+    boto = Mock()
+    boto.describe_task_definition.side_effect = [throttled, RESPONSE_TASK_DEFINITION]
+    recorder = TrafficRecorder(path)
+    client = EcsClient(boto_client=boto, recorder=recorder)
+    with pytest.raises(UnknownTaskDefinitionError):
+        client.describe_task_definition(TASK_DEFINITION_ARN_1)
+    client.describe_task_definition(TASK_DEFINITION_ARN_1)
+    recorder.close()
+
+    client = EcsClient(boto_client=ReplayClient(path, speed=1000))
+
+    response = client.describe_task_definition(TASK_DEFINITION_ARN_1)
+    assert response[u'taskDefinition'][u'taskDefinitionArn'] == TASK_DEFINITION_ARN_1
+
+
+def test_replay_answers_batches_per_service(tmpdir):
+    path = str(tmpdir.join(u'traffic.jsonl'))
+    backend = FakeEcsBackend(services=3)
+    recorder = TrafficRecorder(path)
+    client = backend.client(recorder=recorder)
+    client.describe_services_batch(backend.cluster, [u'service-0000', u'service-0001'])
+    client.describe_services_batch(backend.cluster, [u'service-0002', u'missing'])
+    recorder.close()
+
+    client = EcsClient(boto_client=ReplayClient(path, speed=1000))
+
+    response = client.describe_services_batch(backend.cluster, [u'service-0002', u'service-0000', u'unknown'])
+    assert [service[u'serviceName'] for service in response[u'services']] == [u'service-0002', u'service-0000']
+    assert [failure[u'arn'] for failure in response[u'failures']] == [u'unknown']
+    response = client.describe_services_batch(backend.cluster, [u'missing'])
+    assert response[u'services'] == []
+    assert response[u'failures'][0][u'reason'] == u'MISSING'
+
+
+def deploy_many(client, services):
+    with patch.object(cli, u'get_client', return_value=client), patch.object(cli, u'SLACK_LOGGER', None):
+        return CliRunner().invoke(cli.deploy_many, [
+            u'--cluster', u'benchmark', u'--services', u','.join(services),
+            u'-i', u'app', u'app:2', u'--poll-interval', u'1', u'2',
+        ])
+
+
+def test_record_and_replay_deploy_many(tmpdir, monkeypatch):
+    monkeypatch.setenv(u'SLACK_MUTED', u'1')
+    path = str(tmpdir.join(u'traffic.jsonl.gz'))
+    backend = FakeEcsBackend(services=25, rollout_seconds=1, rate=1000, burst=1000)
+    recorder = TrafficRecorder(path)
+    result = deploy_many(backend.client(recorder=recorder), backend.service_names)
+    recorder.close()
+    assert result.output.count(u'Deployment successful') == 25, result.output
+
+    # the faster replay polls in other batches than the recording
+    result = deploy_many(EcsClient(boto_client=ReplayClient(path, speed=5)), backend.service_names)
+
+    assert result.exit_code == 0, result.output
+    assert u'Traceback' not in result.output
+    assert result.output.count(u'Deployment successful') == 25, result.output
+
+
+@pytest.mark.parametrize(u'speed', [u'1', u'fast'])
+def test_invalid_replay_configuration(tmpdir, monkeypatch, speed):
+    path = tmpdir.join(u'traffic.jsonl')
+    if speed == u'fast':
+        path.write(u'{"version": 1}\n')
+    monkeypatch.setenv(u'ECS_DEPLOY_REPLAY', str(path))
+    monkeypatch.setenv(u'ECS_DEPLOY_REPLAY_SPEED', speed)
+    monkeypatch.setattr(cli, u'TRAFFIC_CONFIGURED', False)
+
+    result = CliRunner().invoke(cli.scale, [u'my-cluster', u'my-service', u'2'])
+
+    assert result.exit_code == 2
+    assert u'Cannot replay ECS_DEPLOY_REPLAY=%s' % path in result.output
+    assert not cli.TRAFFIC_CONFIGURED
+    assert cli.CLIENT_POOL.boto_client is None
@@ -0,0 +1,320 @@
+import json
+import threading
+from time import monotonic
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+from mock.mock import Mock, patch
+
+from ecs_deploy.ecs import EcsService
+from ecs_deploy.slack import SlackLogger, SlackMessage, SlackDashboard, SlackWebhookLogger, _flush_loggers
+from tests.test_ecs import PAYLOAD_SERVICE
+
+
+@pytest.fixture
+def slack():
+    with patch.dict('os.environ', {'SLACK_TOKEN': 'token', 'SLACK_CHANNEL': 'deployments'}), \
+            patch('slacker.Slacker'):
+        logger = SlackLogger()
+        logger.slack.chat.post_message.return_value = Mock(body={'channel': 'C123', 'ts': '1.0'})
+        logger.slack.chat.update.return_value = Mock(body={'channel': 'C123', 'ts': '1.0'})
+        yield logger
+
+
+def test_post_to_slack_does_not_wait_for_delivery(slack):
+    delivered = threading.Event()
+    slack.slack.chat.post_message.side_effect = lambda *args, **kwargs: \
+        delivered.wait(5) and Mock(body={'channel': 'C123', 'ts': '1.0'})
+
+    slack_message = slack.post_to_slack('Deploying', None)
+
+    assert isinstance(slack_message, SlackMessage)
+    assert 'ts' not in slack_message
+    delivered.set()
+    assert slack.flush(timeout=5)
+    assert slack_message['ts'] == '1.0'
+
+
+def test_update_uses_queued_message(slack):
+    slack_message = slack.post_to_slack('Progress', [])
+    assert slack.post_to_slack('Progress', [{'text': 'foo'}], slack_message) is slack_message
+    assert slack.flush(timeout=5)
+
+    slack.slack.chat.post_message.assert_called_once_with('deployments', text='Progress', attachments=[], as_user=True)
+    slack.slack.chat.update.assert_called_once_with('C123', text='Progress', attachments=[{'text': 'foo'}],
+                                                    as_user=True, ts='1.0')
+
+
+def test_update_of_failed_message_is_skipped(slack):
+    slack.slack.chat.post_message.side_effect = Exception('Slack is down')
+    slack_message = slack.post_to_slack('Progress', [])
+    slack.post_to_slack('Progress', [], slack_message)
+    assert slack.flush(timeout=5)
+    slack.slack.chat.update.assert_not_called()
+
+
+def test_full_queue_drops_messages():
+    with patch.dict('os.environ', {'SLACK_TOKEN': 'token'}), patch('slacker.Slacker'):
+        logger = SlackLogger(queue_size=1)
+    blocked = threading.Event()
+    logger.slack.chat.post_message.side_effect = lambda *args, **kwargs: blocked.wait(5) and Mock(body={})
+
+    logger.post_to_slack('first', None)
+    # wait until the sender picked up the first message, the queue is empty again
+    while logger._queue.qsize():
+        pass
+    logger.post_to_slack('second', None)
+    logger.post_to_slack('third', None)
+    blocked.set()
+
+    assert logger.flush(timeout=5)
+    assert logger.slack.chat.post_message.call_count == 2
+
+
+def test_muted_logger_does_not_post():
+    with patch.dict('os.environ', {'SLACK_TOKEN': 'token', 'SLACK_MUTED': '1'}), patch('slacker.Slacker'):
+        logger = SlackLogger()
+    assert logger.post_to_slack('Deploying', None) is None
+    logger.slack.chat.post_message.assert_not_called()
+
+
+def test_unchanged_update_is_skipped(slack):
+    slack_message = slack.post_to_slack('Progress', [{'text': 'foo'}])
+    slack.post_to_slack('Progress', [{'text': 'foo'}], slack_message)
+    assert slack.flush(timeout=5)
+
+    slack.slack.chat.update.assert_not_called()
+
+
+def test_queued_updates_are_coalesced(slack):
+    slack_message = slack.post_to_slack('Progress', [])
+    for running in range(5):
+        slack.post_to_slack('Progress', [{'text': 'Running: %d' % running}], slack_message)
+    assert slack.flush(timeout=5)
+
+    slack.slack.chat.update.assert_called_once_with('C123', text='Progress', attachments=[{'text': 'Running: 4'}],
+                                                    as_user=True, ts='1.0')
+
+
+def test_rate_limited_update_is_retried(slack):
+    response = Mock(status_code=429)
+    slack.slack.chat.update.side_effect = [requests.HTTPError(response=response),
+                                           Mock(body={'channel': 'C123', 'ts': '1.0'})]
+    slack.messages_per_second = 20
+    slack_message = slack.post_to_slack('Progress', [])
+    slack.post_to_slack('Progress', [{'text': 'foo'}], slack_message)
+    assert slack.flush(timeout=5)
+
+    assert slack.slack.chat.update.call_count == 2
+
+
+def test_update_waits_for_rate_limited_message(slack):
+    rate_limited = requests.HTTPError(response=Mock(status_code=429, headers={}))
+    slack.slack.chat.post_message.side_effect = [rate_limited, Mock(body={'channel': 'C123', 'ts': '1.0'})]
+    slack.messages_per_second = 20
+    slack_message = slack.post_to_slack('Progress', [])
+    slack.post_to_slack('Progress', [{'text': 'foo'}], slack_message)
+    assert slack.flush(timeout=5)
+
+    assert slack.slack.chat.post_message.call_count == 2
+    slack.slack.chat.update.assert_called_once_with('C123', text='Progress', attachments=[{'text': 'foo'}],
+                                                    as_user=True, ts='1.0')
+
+
+def test_loggers_are_flushed_once_at_exit(slack):
+    with patch('atexit.register') as register, \
+            patch.dict('os.environ', {'SLACK_TOKEN': 'token'}), patch('slacker.Slacker'):
+        loggers = [SlackLogger() for _ in range(3)]
+    register.assert_not_called()
+
+    for logger in loggers:
+        logger.slack.chat.post_message.return_value = Mock(body={'channel': 'C123', 'ts': '1.0'})
+        logger.post_to_slack('Deploying', None)
+    with patch.object(SlackLogger, 'flush', autospec=True) as flush:
+        _flush_loggers()
+    flushed = [call.args[0] for call in flush.call_args_list]
+    assert all(logger in flushed for logger in loggers)
+
+
+def test_channel_rate_recovers_after_rate_limit(slack):
+    rate_limited = requests.HTTPError(response=Mock(status_code=429, headers={}))
+    slack.slack.chat.post_message.side_effect = [rate_limited] * 3 + \
+        [Mock(body={'channel': 'C123', 'ts': '1.0'})] * 30
+    slack.messages_per_second = 20
+    for i in range(3):
+        slack.post_to_slack('Message %d' % i, [])
+    assert slack.flush(timeout=5)
+    limiter = slack._get_channel_limiter(None)
+    assert limiter.rate < limiter.max_rate
+
+    for i in range(20):
+        slack.post_to_slack('Message %d' % i, [])
+    assert slack.flush(timeout=5)
+
+    assert limiter.rate == limiter.max_rate
+
+
+def test_rate_limit_respects_retry_after(slack):
+    rate_limited = requests.HTTPError(response=Mock(status_code=429, headers={'Retry-After': '0.5'}))
+    slack.slack.chat.post_message.side_effect = [rate_limited, Mock(body={'channel': 'C123', 'ts': '1.0'})]
+    slack.messages_per_second = 1000
+
+    started_at = monotonic()
+    slack.post_to_slack('Message', [])
+    assert slack.flush(timeout=5)
+
+    assert monotonic() - started_at >= 0.5
+    limiter = slack._get_channel_limiter(None)
+    assert limiter.rate == limiter.max_rate
+
+
+def test_dashboard_posts_one_message(slack):
+    services = [EcsService(u'test-cluster', dict(PAYLOAD_SERVICE, serviceName=u'service-%d' % i)) for i in range(50)]
+    dashboard = SlackDashboard(slack, [(None, u'test-cluster')], [s.name for s in services], update_interval=60)
+    dashboard.start()
+    for service in services:
+        dashboard.log_deploy_start(service, None)
+        dashboard.log_deploy_progress(service, None, None)
+        dashboard.log_deploy_finish(service, None)
+    dashboard.log_deploy_failure(u'service-0')
+    dashboard.stop()
+    assert slack.flush(timeout=5)
+
+    slack.slack.chat.post_message.assert_called_once()
+    slack.slack.chat.update.assert_called_once()
+    message = slack.slack.chat.update.call_args[1]['text']
+    assert u'Deploying 50 services' in message
+    assert u'49 finished, 1 failed, 0 deploying, 0 queued' in message
+
+
+def test_dashboard_render():
+    logger = Mock(progress_bar=SlackLogger.progress_bar.__get__(Mock()),
+                  cluster_url=lambda cluster, region=None: cluster)
+    dashboard = SlackDashboard(logger, [(None, u'test-cluster')], [u'web', u'worker'])
+    dashboard.log_deploy_progress(EcsService(u'test-cluster', dict(PAYLOAD_SERVICE, serviceName=u'web')), None, None)
+
+    message, attachments = dashboard.render()
+
+    assert message.endswith(u'0 finished, 0 failed, 1 deploying, 1 queued')
+    rows = attachments[0]['text'].split('\n')[1:-1]
+    assert rows[0].startswith(u'web    ' + 20 * chr(9608))
+    assert rows[0].endswith(u'2/2   deploying')
+    assert rows[1].startswith(u'worker ' + 20 * chr(9617))
+
+
+def test_dashboard_rows_of_several_regions():
+    logger = SlackLogger()
+    dashboard = SlackDashboard(
+        logger,
+        [(u'us-east-1', u'web'), (u'eu-west-1', u'web')],
+        [u'us-east-1/web/app', u'eu-west-1/web/app']
+    )
+    service = EcsService(u'web', dict(PAYLOAD_SERVICE, serviceName=u'app'))
+    dashboard.row(u'us-east-1/web/app').log_deploy_finish(service, None)
+    dashboard.row(u'eu-west-1/web/app').log_deploy_progress(service, None, None)
+
+    message, attachments = dashboard.render()
+
+    assert message.startswith(
+        u'Deploying 2 services to '
+        u'<https://us-east-1.console.aws.amazon.com/ecs/home?region=us-east-1#/clusters/web|us-east-1/web>, '
+        u'<https://eu-west-1.console.aws.amazon.com/ecs/home?region=eu-west-1#/clusters/web|eu-west-1/web>: '
+        u'1 finished, 0 failed, 1 deploying, 0 queued'
+    )
+    rows = attachments[0]['text'].split('\n')[1:-1]
+    assert rows[0].startswith(u'us-east-1/web/app') and rows[0].endswith(u'finished')
+    assert rows[1].startswith(u'eu-west-1/web/app') and rows[1].endswith(u'deploying')
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.posts.append((self.client_address, json.loads(body.decode('utf-8'))))
+        status = self.server.responses.pop(0) if self.server.responses else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def webhook_server():
+    server = HTTPServer(('127.0.0.1', 0), WebhookHandler)
+    server.posts = []
+    server.responses = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_webhook_reuses_connection(webhook_server):
+    url = 'http://127.0.0.1:%d/hook' % webhook_server.server_port
+    with patch.dict('os.environ', {'SLACK_WEBHOOK_ENDPOINT': url}):
+        webhook = SlackWebhookLogger()
+
+    webhook.post_to_slack('first', None)
+    webhook.post_to_slack('second', [{'text': 'foo'}])
+    webhook.post_to_slack('third', None)
+
+    assert [post for _, post in webhook_server.posts] == [
+        {'text': 'first'},
+        {'text': 'second', 'attachments': [{'text': 'foo'}]},
+        {'text': 'third'},
+    ]
+    assert len(set(address for address, _ in webhook_server.posts)) == 1
+
+
+def test_webhook_retries_server_errors(webhook_server):
+    url = 'http://127.0.0.1:%d/hook' % webhook_server.server_port
+    webhook_server.responses = [503, 503]
+    with patch.dict('os.environ', {'SLACK_WEBHOOK_ENDPOINT': url}):
+        webhook = SlackWebhookLogger(backoff_factor=0)
+
+    webhook.post_to_slack('first', None)
+
+    assert len(webhook_server.posts) == 3
+
+
+def test_webhook_raises_rate_limit(webhook_server):
+    url = 'http://127.0.0.1:%d/hook' % webhook_server.server_port
+    webhook_server.responses = [429]
+    with patch.dict('os.environ', {'SLACK_WEBHOOK_ENDPOINT': url}):
+        webhook = SlackWebhookLogger()
+
+    with pytest.raises(requests.HTTPError):
+        webhook.post_to_slack('first', None)
+
+
+def test_webhook_progress_is_batched():
+    with patch.dict('os.environ', {'SLACK_WEBHOOK_ENDPOINT': 'http://localhost/hook'}):
+        logger = SlackLogger(progress_interval=60)
+    logger.slack_webhook_endpoint = Mock()
+    services = [EcsService(u'test-cluster', dict(PAYLOAD_SERVICE, serviceName=u'service-%d' % i)) for i in range(10)]
+
+    with patch('ecs_deploy.slack.monotonic', return_value=0):
+        for service in services:
+            logger.log_deploy_progress(service, None, None)
+    with patch('ecs_deploy.slack.monotonic', return_value=30):
+        for service in services:
+            logger.log_deploy_progress(service, None, None)
+    logger.log_deploy_finish(services[0], Mock(containers=[]))
+    with patch('ecs_deploy.slack.monotonic', return_value=61):
+        for service in services[1:]:
+            logger.log_deploy_progress(service, None, None)
+    with patch('ecs_deploy.slack.monotonic', return_value=130):
+        for service in services[1:]:
+            logger.log_deploy_progress(service, None, None)
+    assert logger.flush(timeout=5)
+
+    messages = [c[0][0] for c in logger.slack_webhook_endpoint.post_to_slack.call_args_list]
+    assert messages[0].startswith('Deploy finished')
+    assert messages[1:] == ['Deploy progress: 9 services in progress']
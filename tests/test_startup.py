@@ -0,0 +1,31 @@
+import subprocess
+import sys
+
+# modules, which are only loaded on first use
+LAZY_MODULES = ('boto3', 'botocore.session', 'requests', 'slacker', 'asyncio', 'dateutil.parser')
+# generous, importing the CLI takes about a tenth of it on a developer machine
+IMPORT_TIME_BUDGET = 0.5
+
+
+def import_times(module):
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        stderr=subprocess.STDOUT
+    ).decode('utf-8')
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1000000.0
+    return times
+
+
+def test_cli_does_not_import_heavy_modules():
+    times = import_times('ecs_deploy.cli')
+    assert [module for module in LAZY_MODULES if module in times] == []
+
+
+def test_cli_import_time():
+    times = import_times('ecs_deploy.cli')
+    assert times['ecs_deploy.cli'] < IMPORT_TIME_BUDGET